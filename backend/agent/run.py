@@ -14,6 +14,7 @@ from utils.config import config
 from agent.agent_builder_prompt import get_agent_builder_prompt
 from agentpress.thread_manager import ThreadManager
 from agentpress.response_processor import ProcessorConfig
+from agentpress.prompt_builder import build_system_message
 from agent.tools.sb_shell_tool import SandboxShellTool
 from agent.tools.sb_files_tool import SandboxFilesTool
 from agent.tools.data_providers_tool import DataProvidersTool
@@ -352,10 +353,9 @@ IMPORTANT: Always reference and utilize the knowledge base information above whe
         datetime_info += f"Current month: {now.strftime('%B')}\n"
         datetime_info += f"Current day: {now.strftime('%A')}\n"
         datetime_info += "Use this information for any time-sensitive tasks, research, or when current date/time context is needed.\n"
-        
-        system_content += datetime_info
 
-        return {"role": "system", "content": system_content}
+        # The date/time changes every run, keep it out of the cacheable prefix
+        return build_system_message(system_content, datetime_info)
 
 
 class MessageManager:
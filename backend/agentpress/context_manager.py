@@ -2,18 +2,52 @@
 Context Management for AgentPress Threads.
 
 This module handles token counting and thread summarization to prevent
-reaching the context window limitations of LLM models.
+reaching the context window limitations of LLM models. Token counts go
+through the token cache so each message is tokenized once.
 """
 
 import json
-from typing import List, Dict, Any, Optional, Union
+import asyncio
+from bisect import bisect_right
+from dataclasses import dataclass, field
+from typing import List, Dict, Any, Optional, Union, Tuple, Callable
 
-from litellm.utils import token_counter
 from services.supabase import DBConnection
+from services.llm import make_llm_api_call
+from utils.config import config
 from utils.logger import logger
 from utils.constants import get_model_context_window
+from agentpress.token_cache import count_message_tokens, count_messages_tokens, REPLY_PRIMING_TOKENS
+from agentpress.message_cache import CHECKPOINT_MESSAGE_TYPE
 
 DEFAULT_TOKEN_THRESHOLD = 120000
+SUMMARY_TARGET_TOKENS = 10000
+
+# Checkpoints being created in this process per thread
+_checkpoints: Dict[str, asyncio.Task] = {}
+
+SUMMARY_SYSTEM_PROMPT = """You are a specialized summarization assistant. Your task is to create a concise but comprehensive summary of the conversation history.
+
+The summary should:
+1. Preserve all key information including decisions, conclusions, and important context
+2. Include any tools that were used and their results
+3. Maintain chronological order of events
+4. Be presented as a narrated list of key points with section headers
+5. Include only factual information from the conversation (no new information)
+6. Be concise but detailed enough that the conversation can continue with this summary as context
+
+VERY IMPORTANT: This summary will replace older parts of the conversation in the LLM's context window, so ensure it contains ALL key information and LATEST STATE OF THE CONVERSATION - SO WE WILL KNOW HOW TO PICK UP WHERE WE LEFT OFF."""
+
+
+@dataclass
+class CompressionReport:
+    """What a compression pass did to a message list."""
+    budget: int
+    tokens_before: int
+    tokens_after: int
+    threshold: Optional[int] = None
+    truncated: List[str] = field(default_factory=list)
+    dropped: int = 0
 
 class ContextManager:
     """Manages thread context including token counting and summarization."""
@@ -26,6 +60,7 @@ class ContextManager:
         """
         self.db = DBConnection()
         self.token_threshold = token_threshold
+        self.last_report: Optional[CompressionReport] = None
 
     def is_tool_result_message(self, msg: Dict[str, Any]) -> bool:
         """Check if a message is a tool result message."""
@@ -61,12 +96,16 @@ class ContextManager:
                 # Special handling for edit_file tool result to preserve JSON structure
                 tool_execution = msg_content.get("tool_execution", {})
                 if tool_execution.get("function_name") == "edit_file":
-                    output = tool_execution.get("result", {}).get("output", {})
+                    result = tool_execution.get("result", {})
+                    output = result.get("output", {})
                     if isinstance(output, dict):
-                        # Truncate file contents within the JSON
+                        # Truncate file contents within the JSON, on copies as the
+                        # content may be shared with the message cache
+                        output = dict(output)
                         for key in ["original_content", "updated_content"]:
                             if isinstance(output.get(key), str) and len(output[key]) > max_length // 4:
                                 output[key] = output[key][:max_length // 4] + "\n... (truncated)"
+                        msg_content = {**msg_content, "tool_execution": {**tool_execution, "result": {**result, "output": output}}}
                 
                 # After potential truncation, check size again
                 if len(json.dumps(msg_content)) > max_length:
@@ -108,79 +147,6 @@ class ContextManager:
             else:
                 return msg_content
   
-    def compress_tool_result_messages(self, messages: List[Dict[str, Any]], llm_model: str, max_tokens: Optional[int], token_threshold: int = 1000) -> List[Dict[str, Any]]:
-        """Compress the tool result messages except the most recent one."""
-        uncompressed_total_token_count = token_counter(model=llm_model, messages=messages)
-        max_tokens_value = max_tokens or (100 * 1000)
-
-        if uncompressed_total_token_count > max_tokens_value:
-            _i = 0  # Count the number of ToolResult messages
-            for msg in reversed(messages):  # Start from the end and work backwards
-                if not isinstance(msg, dict):
-                    continue  # Skip non-dict messages
-                if self.is_tool_result_message(msg):  # Only compress ToolResult messages
-                    _i += 1  # Count the number of ToolResult messages
-                    msg_token_count = token_counter(messages=[msg])  # Count the number of tokens in the message
-                    if msg_token_count > token_threshold:  # If the message is too long
-                        if _i > 1:  # If this is not the most recent ToolResult message
-                            message_id = msg.get('message_id')  # Get the message_id
-                            if message_id:
-                                msg["content"] = self.compress_message(msg["content"], message_id, token_threshold * 3)
-                            else:
-                                logger.warning(f"UNEXPECTED: Message has no message_id {str(msg)[:100]}")
-                        else:
-                            msg["content"] = self.safe_truncate(msg["content"], int(max_tokens_value * 2))
-        return messages
-
-    def compress_user_messages(self, messages: List[Dict[str, Any]], llm_model: str, max_tokens: Optional[int], token_threshold: int = 1000) -> List[Dict[str, Any]]:
-        """Compress the user messages except the most recent one."""
-        uncompressed_total_token_count = token_counter(model=llm_model, messages=messages)
-        max_tokens_value = max_tokens or (100 * 1000)
-
-        if uncompressed_total_token_count > max_tokens_value:
-            _i = 0  # Count the number of User messages
-            for msg in reversed(messages):  # Start from the end and work backwards
-                if not isinstance(msg, dict):
-                    continue  # Skip non-dict messages
-                if msg.get('role') == 'user':  # Only compress User messages
-                    _i += 1  # Count the number of User messages
-                    msg_token_count = token_counter(messages=[msg])  # Count the number of tokens in the message
-                    if msg_token_count > token_threshold:  # If the message is too long
-                        if _i > 1:  # If this is not the most recent User message
-                            message_id = msg.get('message_id')  # Get the message_id
-                            if message_id:
-                                msg["content"] = self.compress_message(msg["content"], message_id, token_threshold * 3)
-                            else:
-                                logger.warning(f"UNEXPECTED: Message has no message_id {str(msg)[:100]}")
-                        else:
-                            msg["content"] = self.safe_truncate(msg["content"], int(max_tokens_value * 2))
-        return messages
-
-    def compress_assistant_messages(self, messages: List[Dict[str, Any]], llm_model: str, max_tokens: Optional[int], token_threshold: int = 1000) -> List[Dict[str, Any]]:
-        """Compress the assistant messages except the most recent one."""
-        uncompressed_total_token_count = token_counter(model=llm_model, messages=messages)
-        max_tokens_value = max_tokens or (100 * 1000)
-        
-        if uncompressed_total_token_count > max_tokens_value:
-            _i = 0  # Count the number of Assistant messages
-            for msg in reversed(messages):  # Start from the end and work backwards
-                if not isinstance(msg, dict):
-                    continue  # Skip non-dict messages
-                if msg.get('role') == 'assistant':  # Only compress Assistant messages
-                    _i += 1  # Count the number of Assistant messages
-                    msg_token_count = token_counter(messages=[msg])  # Count the number of tokens in the message
-                    if msg_token_count > token_threshold:  # If the message is too long
-                        if _i > 1:  # If this is not the most recent Assistant message
-                            message_id = msg.get('message_id')  # Get the message_id
-                            if message_id:
-                                msg["content"] = self.compress_message(msg["content"], message_id, token_threshold * 3)
-                            else:
-                                logger.warning(f"UNEXPECTED: Message has no message_id {str(msg)[:100]}")
-                        else:
-                            msg["content"] = self.safe_truncate(msg["content"], int(max_tokens_value * 2))
-                            
-        return messages
-
     def remove_meta_messages(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         """Remove meta messages from the messages."""
         result: List[Dict[str, Any]] = []
@@ -208,128 +174,198 @@ class ContextManager:
                 result.append(msg)
         return result
 
-    def compress_messages(self, messages: List[Dict[str, Any]], llm_model: str, max_tokens: Optional[int] = 41000, token_threshold: int = 4096, max_iterations: int = 5) -> List[Dict[str, Any]]:
-        """Compress the messages.
-        
-        Args:
-            messages: List of messages to compress
-            llm_model: Model name for token counting
-            max_tokens: Maximum allowed tokens
-            token_threshold: Token threshold for individual message compression (must be a power of 2)
-            max_iterations: Maximum number of compression iterations
-        """
-        # Get model-specific token limits from constants
+    def get_token_budget(self, llm_model: str) -> int:
+        """Get the prompt token budget for a model, reserving room for output."""
         context_window = get_model_context_window(llm_model)
-        
+
         # Reserve tokens for output generation and safety margin
         if context_window >= 1_000_000:  # Very large context models (Gemini)
-            max_tokens = context_window - 300_000  # Large safety margin for huge contexts
+            return context_window - 300_000  # Large safety margin for huge contexts
         elif context_window >= 400_000:  # Large context models (GPT-5)
-            max_tokens = context_window - 64_000  # Reserve for output + margin
+            return context_window - 64_000  # Reserve for output + margin
         elif context_window >= 200_000:  # Medium context models (Claude Sonnet)
-            max_tokens = context_window - 32_000  # Reserve for output + margin
+            return context_window - 32_000  # Reserve for output + margin
         elif context_window >= 100_000:  # Standard large context models
-            max_tokens = context_window - 16_000  # Reserve for output + margin
+            return context_window - 16_000  # Reserve for output + margin
         else:  # Smaller context models
-            max_tokens = context_window - 8_000   # Reserve for output + margin
-        
-        logger.debug(f"Model {llm_model}: context_window={context_window}, effective_limit={max_tokens}")
+            return context_window - 8_000   # Reserve for output + margin
+
+    def compress_messages(self, messages: List[Dict[str, Any]], llm_model: str, max_tokens: Optional[int] = None, token_threshold: int = 4096, max_iterations: int = 5) -> List[Dict[str, Any]]:
+        """Compress the messages to fit the model's context window.
+
+        Args:
+            messages: List of messages to compress
+            llm_model: Model name for token counting
+            max_tokens: Maximum allowed tokens, defaults to the model's budget
+            token_threshold: Largest per-message token threshold to try (must be a power of 2)
+            max_iterations: Number of times the threshold may be halved
+        """
+        result, report = self.plan_compression(messages, llm_model, max_tokens, token_threshold, max_iterations)
+        self.last_report = report
+        return result
 
-        result = messages
-        result = self.remove_meta_messages(result)
+    def plan_compression(
+            self,
+            messages: List[Dict[str, Any]],
+            llm_model: str,
+            max_tokens: Optional[int] = None,
+            token_threshold: int = 4096,
+            max_iterations: int = 5
+        ) -> Tuple[List[Dict[str, Any]], CompressionReport]:
+        """Decide in one pass which messages to keep, truncate or drop.
 
-        uncompressed_total_token_count = token_counter(model=llm_model, messages=result)
+        Every message is tokenized once. Truncation levels (token_threshold
+        halved up to max_iterations times) are evaluated against sorted
+        per-message costs; if even the smallest level does not fit, messages
+        are dropped from the middle of the conversation using the planned
+        costs, without re-tokenizing the list.
 
-        result = self.compress_tool_result_messages(result, llm_model, max_tokens, token_threshold)
-        result = self.compress_user_messages(result, llm_model, max_tokens, token_threshold)
-        result = self.compress_assistant_messages(result, llm_model, max_tokens, token_threshold)
+        Returns:
+            The compressed messages and a report of what was done.
+        """
+        budget = max_tokens or self.get_token_budget(llm_model)
+        logger.debug(f"Model {llm_model}: effective_limit={budget}")
 
-        compressed_token_count = token_counter(model=llm_model, messages=result)
+        result = self.remove_meta_messages(messages)
+        costs = [count_message_tokens(llm_model, msg) for msg in result]
+        tokens_before = sum(costs) + REPLY_PRIMING_TOKENS
+        report = CompressionReport(budget=budget, tokens_before=tokens_before, tokens_after=tokens_before)
 
-        logger.debug(f"compress_messages: {uncompressed_total_token_count} -> {compressed_token_count}")  # Log the token compression for debugging later
+        if tokens_before > budget:
+            candidates, protected = self._find_compressible(result)
 
-        if max_iterations <= 0:
-            logger.warning(f"compress_messages: Max iterations reached, omitting messages")
-            result = self.compress_messages_by_omitting_messages(messages, llm_model, max_tokens)
-            return result
+            # Costs of compressible messages, sorted once so each level only
+            # needs a bisect to find the messages above its threshold
+            order = sorted(candidates, key=lambda i: costs[i])
+            sorted_costs = [costs[i] for i in order]
 
-        if compressed_token_count > max_tokens:
-            logger.warning(f"Further token compression is needed: {compressed_token_count} > {max_tokens}")
-            result = self.compress_messages(messages, llm_model, max_tokens, token_threshold // 2, max_iterations - 1)
+            threshold = token_threshold
+            planned = None
+            for level in range(max_iterations + 1):
+                threshold = token_threshold >> level
+                if threshold <= 0:
+                    break
+                over = order[bisect_right(sorted_costs, threshold):]
+                planned = self._plan_level(result, costs, over, protected, threshold, budget, llm_model)
+                if planned[2] <= budget:
+                    break
 
-        return self.middle_out_messages(result)
-    
-    def compress_messages_by_omitting_messages(
-            self, 
-            messages: List[Dict[str, Any]], 
-            llm_model: str, 
-            max_tokens: Optional[int] = 41000,
-            removal_batch_size: int = 10,
-            min_messages_to_keep: int = 10
-        ) -> List[Dict[str, Any]]:
-        """Compress the messages by omitting messages from the middle.
-        
-        Args:
-            messages: List of messages to compress
-            llm_model: Model name for token counting
-            max_tokens: Maximum allowed tokens
-            removal_batch_size: Number of messages to remove per iteration
-            min_messages_to_keep: Minimum number of messages to preserve
+            if planned:
+                result, costs, total, truncated = planned
+                report.threshold = threshold
+                report.truncated = truncated
+                report.tokens_after = total
+
+            if report.tokens_after > budget:
+                logger.warning(f"Further token compression is needed: {report.tokens_after} > {budget}, omitting messages")
+                result, report.dropped, report.tokens_after = self._drop_middle_messages(result, costs, budget)
+
+        before_middle_out = len(result)
+        result = self.middle_out_messages(result)
+        if len(result) < before_middle_out:
+            report.dropped += before_middle_out - len(result)
+            report.tokens_after = count_messages_tokens(llm_model, result)
+
+        logger.debug(f"compress_messages: {report.tokens_before} -> {report.tokens_after} tokens (threshold={report.threshold}, truncated={len(report.truncated)}, dropped={report.dropped})")
+        return result, report
+
+    def _find_compressible(self, messages: List[Dict[str, Any]]) -> Tuple[List[int], set]:
+        """Return indexes of compressible messages and of the most recent one per kind.
+
+        Tool results, user and assistant messages can be compressed. The most
+        recent message of each kind is only middle-truncated, never summarized
+        down to the threshold.
         """
-        if not messages:
-            return messages
-            
-        result = messages
-        result = self.remove_meta_messages(result)
+        candidates = []
+        protected = set()
+        seen_kinds = set()
+        for i in range(len(messages) - 1, -1, -1):
+            msg = messages[i]
+            if not isinstance(msg, dict) or not isinstance(msg.get('content'), (str, dict)):
+                continue
+            if self.is_tool_result_message(msg):
+                kind = 'tool_result'
+            elif msg.get('role') in ('user', 'assistant'):
+                kind = msg['role']
+            else:
+                continue
+            if kind not in seen_kinds:
+                seen_kinds.add(kind)
+                protected.add(i)
+            candidates.append(i)
+        return candidates, protected
 
-        # Early exit if no compression needed
-        initial_token_count = token_counter(model=llm_model, messages=result)
-        max_allowed_tokens = max_tokens or (100 * 1000)
-        
-        if initial_token_count <= max_allowed_tokens:
-            return result
+    def _plan_level(
+            self,
+            messages: List[Dict[str, Any]],
+            costs: List[int],
+            over_threshold: List[int],
+            protected: set,
+            threshold: int,
+            budget: int,
+            llm_model: str
+        ) -> Tuple[List[Dict[str, Any]], List[int], int, List[str]]:
+        """Compress the messages above a threshold and return the planned costs and total."""
+        planned = list(messages)
+        planned_costs = list(costs)
+        total = sum(costs) + REPLY_PRIMING_TOKENS
+        truncated = []
+        for i in over_threshold:
+            msg = messages[i]
+            message_id = msg.get('message_id')
+            if i in protected:
+                new_content = self.safe_truncate(msg["content"], int(budget * 2))
+            elif message_id:
+                new_content = self.compress_message(msg["content"], message_id, threshold * 3)
+            else:
+                logger.warning(f"UNEXPECTED: Message has no message_id {str(msg)[:100]}")
+                continue
+            if new_content is msg["content"]:
+                continue
+            new_msg = msg.copy()
+            new_msg["content"] = new_content
+            planned[i] = new_msg
+            planned_costs[i] = count_message_tokens(llm_model, new_msg)
+            total += planned_costs[i] - costs[i]
+            truncated.append(message_id)
+        return planned, planned_costs, total, truncated
 
-        # Separate system message (assumed to be first) from conversation messages
-        system_message = messages[0] if messages and isinstance(messages[0], dict) and messages[0].get('role') == 'system' else None
-        conversation_messages = result[1:] if system_message else result
-        
-        safety_limit = 500
-        current_token_count = initial_token_count
-        
-        while current_token_count > max_allowed_tokens and safety_limit > 0:
-            safety_limit -= 1
-            
-            if len(conversation_messages) <= min_messages_to_keep:
-                logger.warning(f"Cannot compress further: only {len(conversation_messages)} messages remain (min: {min_messages_to_keep})")
-                break
-
-            # Calculate removal strategy based on current message count
-            if len(conversation_messages) > (removal_batch_size * 2):
-                # Remove from middle, keeping recent and early context
-                middle_start = len(conversation_messages) // 2 - (removal_batch_size // 2)
-                middle_end = middle_start + removal_batch_size
-                conversation_messages = conversation_messages[:middle_start] + conversation_messages[middle_end:]
+    def _drop_middle_messages(
+            self,
+            messages: List[Dict[str, Any]],
+            costs: List[int],
+            budget: int,
+            min_messages_to_keep: int = 10
+        ) -> Tuple[List[Dict[str, Any]], int, int]:
+        """Drop conversation messages from the middle outwards until the budget fits."""
+        has_system = bool(messages) and isinstance(messages[0], dict) and messages[0].get('role') == 'system'
+        first = 1 if has_system else 0
+        total = sum(costs) + REPLY_PRIMING_TOKENS
+
+        keep = [True] * len(messages)
+        remaining = len(messages) - first
+        middle = first + remaining // 2
+        left, right = middle - 1, middle
+        take_right = True
+
+        while total > budget and remaining > min_messages_to_keep and (left >= first or right < len(messages)):
+            if (take_right and right < len(messages)) or left < first:
+                i = right
+                right += 1
             else:
-                # Remove from earlier messages, preserving recent context
-                messages_to_remove = min(removal_batch_size, len(conversation_messages) // 2)
-                if messages_to_remove > 0:
-                    conversation_messages = conversation_messages[messages_to_remove:]
-                else:
-                    # Can't remove any more messages
-                    break
+                i = left
+                left -= 1
+            take_right = not take_right
+            keep[i] = False
+            total -= costs[i]
+            remaining -= 1
 
-            # Recalculate token count
-            messages_to_count = ([system_message] + conversation_messages) if system_message else conversation_messages
-            current_token_count = token_counter(model=llm_model, messages=messages_to_count)
+        if total > budget:
+            logger.warning(f"Cannot compress further: only {remaining} messages remain (min: {min_messages_to_keep})")
+
+        result = [msg for msg, kept in zip(messages, keep) if kept]
+        return result, len(messages) - len(result), total
 
-        # Prepare final result
-        final_messages = ([system_message] + conversation_messages) if system_message else conversation_messages
-        final_token_count = token_counter(model=llm_model, messages=final_messages)
-        
-        logger.debug(f"compress_messages_by_omitting_messages: {initial_token_count} -> {final_token_count} tokens ({len(messages)} -> {len(final_messages)} messages)")
-            
-        return final_messages
-    
     def middle_out_messages(self, messages: List[Dict[str, Any]], max_messages: int = 320) -> List[Dict[str, Any]]:
         """Remove messages from the middle of the list, keeping max_messages total."""
         if len(messages) <= max_messages:
@@ -339,4 +375,171 @@ class ContextManager:
         keep_start = max_messages // 2
         keep_end = max_messages - keep_start
         
-        return messages[:keep_start] + messages[-keep_end:] 
\ No newline at end of file
+        return messages[:keep_start] + messages[-keep_end:]
+
+    def _format_transcript(self, messages: List[Dict[str, Any]]) -> str:
+        """Render messages as a plain-text transcript for summarization."""
+        lines = []
+        for msg in messages:
+            if not isinstance(msg, dict):
+                continue
+            content = msg.get('content')
+            if isinstance(content, list):
+                content = "\n".join(item.get('text', '[image]') for item in content if isinstance(item, dict))
+            elif not isinstance(content, str):
+                content = json.dumps(content)
+            lines.append(f"[{msg.get('role', 'unknown')}]\n{content}")
+        return "\n\n".join(lines)
+
+    def _checkpoint_split(self, messages: List[Dict[str, Any]]) -> int:
+        """Index of the first message a checkpoint keeps: the last user message."""
+        for i in range(len(messages) - 1, -1, -1):
+            if isinstance(messages[i], dict) and messages[i].get('role') == 'user':
+                return i
+        return 0
+
+    def schedule_checkpoint(
+            self,
+            thread_id: str,
+            messages: List[Dict[str, Any]],
+            llm_model: str,
+            add_message_callback: Callable
+        ) -> bool:
+        """Create a checkpoint of a thread in the background, once at a time per thread.
+
+        The current turn goes on with the compressed messages, later turns
+        load the checkpoint. Returns False if one is already being created.
+        """
+        if thread_id in _checkpoints:
+            return False
+        task = asyncio.create_task(self.create_checkpoint(thread_id, messages, llm_model, add_message_callback))
+        _checkpoints[thread_id] = task
+
+        def _done(task: asyncio.Task):
+            _checkpoints.pop(thread_id, None)
+            if not task.cancelled() and task.exception():
+                logger.error(f"Failed to create a checkpoint for thread {thread_id}: {str(task.exception())}")
+
+        task.add_done_callback(_done)
+        return True
+
+    async def create_checkpoint(
+            self,
+            thread_id: str,
+            messages: List[Dict[str, Any]],
+            llm_model: str,
+            add_message_callback: Callable
+        ) -> Optional[Dict[str, Any]]:
+        """Summarize the older messages of a thread and store it as a checkpoint.
+
+        The messages before the last user message are summarized, the last user
+        message and what follows it are kept as they are. The summary is stored
+        as a ``summary`` LLM message, with the ID of the last summarized message
+        in its ``summarized_until`` metadata. When loading a thread, the latest
+        checkpoint replaces the messages up to that one.
+
+        Args:
+            thread_id: The thread to summarize.
+            messages: The thread's current LLM messages (without the system prompt).
+            llm_model: Model of the thread, writes the summary if CONTEXT_SUMMARY_MODEL is empty.
+            add_message_callback: ThreadManager.add_message, used to store the checkpoint
+                and the usage of the summary.
+
+        Returns:
+            The saved summary message, or None if there was too little to
+            summarize or summarization failed.
+        """
+        summary_model = config.CONTEXT_SUMMARY_MODEL or llm_model
+        messages = messages[:self._checkpoint_split(messages)]
+        # Summarizing fewer tokens than the length of a summary saves nothing
+        if not messages or count_messages_tokens(summary_model, messages) <= SUMMARY_TARGET_TOKENS:
+            logger.debug(f"Too little to summarize before the last user message of thread {thread_id}, no checkpoint")
+            return None
+
+        logger.info(f"Creating summary checkpoint for thread {thread_id} ({len(messages)} messages)")
+
+        # Keep the summarization prompt itself within the model's window
+        budget = self.get_token_budget(summary_model) - SUMMARY_TARGET_TOKENS
+        history, _ = self.plan_compression(messages, summary_model, max_tokens=budget)
+
+        summary_prompt = [
+            {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+            {"role": "user", "content": f"Summarize the following conversation:\n\n{self._format_transcript(history)}"}
+        ]
+
+        try:
+            response = await make_llm_api_call(
+                summary_prompt,
+                summary_model,
+                temperature=0,
+                max_tokens=SUMMARY_TARGET_TOKENS,
+                stream=False
+            )
+            summary_text = response.choices[0].message.content
+        except Exception as e:
+            logger.error(f"Failed to generate summary for thread {thread_id}: {str(e)}", exc_info=True)
+            return None
+
+        if not summary_text:
+            logger.warning(f"Empty summary generated for thread {thread_id}, skipping checkpoint")
+            return None
+
+        formatted_summary = f"""
+======== CONVERSATION HISTORY SUMMARY ========
+
+{summary_text}
+
+======== END OF SUMMARY ========
+
+The above is a summary of the earlier conversation history. The conversation continues below.
+"""
+        summary_message = {"role": "user", "content": formatted_summary}
+
+        saved_summary = await add_message_callback(
+            thread_id=thread_id,
+            type=CHECKPOINT_MESSAGE_TYPE,
+            content=summary_message,
+            is_llm_message=True,
+            metadata={
+                "summarized_messages": len(messages),
+                "summarized_until": messages[-1].get('message_id'),
+                "token_count": count_message_tokens(summary_model, summary_message)
+            }
+        )
+        await self._save_checkpoint_usage(thread_id, response, summary_model, saved_summary, add_message_callback)
+        return saved_summary
+
+    async def _save_checkpoint_usage(
+            self,
+            thread_id: str,
+            response: Any,
+            summary_model: str,
+            saved_summary: Optional[Dict[str, Any]],
+            add_message_callback: Callable
+        ):
+        """Save the usage of a summary call like that of a turn, as an ``assistant_response_end``.
+
+        Saving it records the usage in the usage ledger, which bills it, and
+        lists it in the usage logs the monthly usage is computed from.
+        """
+        usage = getattr(response, 'usage', None)
+        if not usage:
+            logger.warning(f"No usage returned for the summary of thread {thread_id}, not billed")
+            return
+        try:
+            await add_message_callback(
+                thread_id=thread_id,
+                type="assistant_response_end",
+                content={
+                    "model": summary_model,
+                    "usage": {
+                        "prompt_tokens": getattr(usage, 'prompt_tokens', 0) or 0,
+                        "completion_tokens": getattr(usage, 'completion_tokens', 0) or 0,
+                        "total_tokens": getattr(usage, 'total_tokens', 0) or 0,
+                    },
+                },
+                is_llm_message=False,
+                metadata={"checkpoint_message_id": saved_summary.get('message_id') if saved_summary else None}
+            )
+        except Exception as e:
+            logger.error(f"Failed to save the usage of the summary of thread {thread_id}: {str(e)}", exc_info=True)
@@ -0,0 +1,240 @@
+"""
+Incremental per-thread message cache for AgentPress.
+
+Keeps the parsed LLM message list of recently used threads in process memory
+so that repeated calls to ``ThreadManager.get_llm_messages`` (one per
+auto-continue iteration) only fetch rows newer than the last seen
+``created_at`` / ``message_id`` instead of re-reading the whole thread.
+
+If the thread has a summary checkpoint (a ``summary`` message written by the
+ContextManager), only the latest checkpoint and the messages created after the
+last one it summarized (its ``summarized_until`` metadata) are loaded; the
+messages up to that one are represented by the summary.
+
+Coherence across processes is handled through a per-thread generation counter
+stored in Redis. Anything that removes or rewrites LLM messages outside of
+the append path must call ``invalidate_thread_messages`` which bumps the
+counter; every process holding a stale local copy drops it on next read.
+"""
+
+import json
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import List, Dict, Any, Optional, Set
+
+from services import redis
+from utils.logger import logger
+
+# Number of threads kept in the per-process LRU
+MESSAGE_CACHE_MAX_THREADS = 64
+# TTL of the Redis generation key; it only needs to outlive an agent run
+MESSAGE_CACHE_GENERATION_TTL = 3600 * 24
+# Page size used when (re)loading messages from the database
+MESSAGE_FETCH_BATCH_SIZE = 1000
+# Message type of rolling-summary checkpoints
+CHECKPOINT_MESSAGE_TYPE = "summary"
+
+
+def _generation_key(thread_id: str) -> str:
+    return f"thread_messages:{thread_id}:generation"
+
+
+@dataclass
+class _ThreadEntry:
+    """Cached state for a single thread."""
+    generation: Optional[str]
+    messages: List[Dict[str, Any]] = field(default_factory=list)
+    message_ids: Set[str] = field(default_factory=set)
+    # The cursor query is inclusive (gte), rows sharing the cursor timestamp
+    # are de-duplicated through ``message_ids``
+    last_created_at: Optional[str] = None
+
+
+class ThreadMessageCache:
+    """In-process LRU of parsed LLM messages, kept coherent through Redis."""
+
+    def __init__(self, max_threads: int = MESSAGE_CACHE_MAX_THREADS):
+        self.max_threads = max_threads
+        self._entries: "OrderedDict[str, _ThreadEntry]" = OrderedDict()
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    def _lock_for(self, thread_id: str) -> asyncio.Lock:
+        lock = self._locks.get(thread_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[thread_id] = lock
+        return lock
+
+    async def _get_generation(self, thread_id: str) -> Optional[str]:
+        try:
+            return await redis.get(_generation_key(thread_id))
+        except Exception as e:
+            logger.warning(f"Failed to read message cache generation for thread {thread_id}: {str(e)}")
+            return None
+
+    def _store(self, thread_id: str, entry: _ThreadEntry):
+        self._entries[thread_id] = entry
+        self._entries.move_to_end(thread_id)
+        while len(self._entries) > self.max_threads:
+            evicted_id, _ = self._entries.popitem(last=False)
+            self._locks.pop(evicted_id, None)
+
+    def discard(self, thread_id: str):
+        """Drop the local copy of a thread without touching Redis."""
+        self._entries.pop(thread_id, None)
+        self._locks.pop(thread_id, None)
+
+    async def get_messages(self, client, thread_id: str) -> List[Dict[str, Any]]:
+        """Return the parsed LLM messages of a thread, fetching only new rows.
+
+        Args:
+            client: Supabase async client.
+            thread_id: The ID of the thread to get messages for.
+
+        Returns:
+            A list of shallow copies of the cached message dicts: callers may
+            replace their keys, but must copy nested content before changing it.
+        """
+        async with self._lock_for(thread_id):
+            generation = await self._get_generation(thread_id)
+            entry = self._entries.get(thread_id)
+
+            if entry is None or entry.generation != generation:
+                if entry is not None:
+                    logger.debug(f"Message cache for thread {thread_id} is stale, reloading")
+                entry = _ThreadEntry(generation=generation)
+                checkpoint = await self._fetch_latest_checkpoint(client, thread_id)
+                if checkpoint:
+                    self._apply_rows(entry, [checkpoint])
+                    # The messages kept by the checkpoint were created before it
+                    summarized_until = await self._fetch_summarized_until(client, checkpoint)
+                    if summarized_until:
+                        entry.message_ids.add(summarized_until['message_id'])
+                        entry.last_created_at = summarized_until['created_at']
+
+            rows = await self._fetch_rows(client, thread_id, entry.last_created_at)
+            new_count = self._apply_rows(entry, rows)
+            self._store(thread_id, entry)
+
+            logger.debug(f"Message cache for thread {thread_id}: {new_count} new, {len(entry.messages)} total")
+            return [dict(message) for message in entry.messages]
+
+    async def _fetch_latest_checkpoint(self, client, thread_id: str) -> Optional[Dict[str, Any]]:
+        """Fetch the most recent summary checkpoint row of a thread, if any."""
+        result = await client.table('messages').select('message_id, type, content, metadata, created_at').eq('thread_id', thread_id).eq('type', CHECKPOINT_MESSAGE_TYPE).eq('is_llm_message', True).order('created_at', desc=True).limit(1).execute()
+        return result.data[0] if result.data else None
+
+    async def _fetch_summarized_until(self, client, checkpoint: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Fetch the row of the last message a checkpoint summarized, if it has one."""
+        message_id = (checkpoint.get('metadata') or {}).get('summarized_until')
+        if not message_id:
+            return None
+        result = await client.table('messages').select('message_id, created_at').eq('message_id', message_id).limit(1).execute()
+        return result.data[0] if result.data else None
+
+    async def _fetch_rows(self, client, thread_id: str, since: Optional[str]) -> List[Dict[str, Any]]:
+        """Fetch LLM message rows, optionally only those at or after ``since``."""
+        all_rows = []
+        offset = 0
+
+        while True:
+            query = client.table('messages').select('message_id, type, content, metadata, created_at').eq('thread_id', thread_id).eq('is_llm_message', True)
+            if since:
+                query = query.gte('created_at', since)
+            result = await query.order('created_at').range(offset, offset + MESSAGE_FETCH_BATCH_SIZE - 1).execute()
+
+            if not result.data:
+                break
+
+            all_rows.extend(result.data)
+
+            if len(result.data) < MESSAGE_FETCH_BATCH_SIZE:
+                break
+
+            offset += MESSAGE_FETCH_BATCH_SIZE
+
+        return all_rows
+
+    def _apply_rows(self, entry: _ThreadEntry, rows: List[Dict[str, Any]]) -> int:
+        """Parse and append rows that are not cached yet. Returns the number appended.
+
+        A checkpoint row replaces the cached messages up to the last one it
+        summarized, or all of them if it does not say which.
+        """
+        appended = 0
+        for item in rows:
+            message_id = item['message_id']
+            created_at = item.get('created_at')
+
+            if created_at:
+                entry.last_created_at = created_at
+
+            if message_id in entry.message_ids:
+                continue
+            entry.message_ids.add(message_id)
+
+            if isinstance(item['content'], str):
+                try:
+                    parsed_item = json.loads(item['content'])
+                except json.JSONDecodeError:
+                    logger.error(f"Failed to parse message: {item['content']}")
+                    continue
+            else:
+                parsed_item = item['content']
+            parsed_item['message_id'] = message_id
+
+            if item.get('type') == CHECKPOINT_MESSAGE_TYPE:
+                summarized_until = (item.get('metadata') or {}).get('summarized_until')
+                kept = []
+                for i, message in enumerate(entry.messages):
+                    if summarized_until and message.get('message_id') == summarized_until:
+                        kept = entry.messages[i + 1:]
+                        break
+                entry.messages = [parsed_item] + kept
+            else:
+                entry.messages.append(parsed_item)
+            appended += 1
+        return appended
+
+    def note_inserted(self, thread_id: str, message: Dict[str, Any]):
+        """Record that an LLM message was inserted through ``add_message``.
+
+        Rows with a timestamp at or after the cursor are picked up by the next
+        incremental fetch. A row stamped before the cursor would be missed, so
+        the local copy is dropped in that case.
+        """
+        entry = self._entries.get(thread_id)
+        if entry is None or not entry.last_created_at:
+            return
+        created_at = message.get('created_at')
+        if created_at and created_at < entry.last_created_at:
+            logger.debug(f"Out-of-order insert in thread {thread_id}, dropping cached messages")
+            self.discard(thread_id)
+
+    async def invalidate(self, thread_id: str):
+        """Invalidate a thread's cached messages in every process."""
+        self.discard(thread_id)
+        try:
+            redis_client = await redis.get_client()
+            key = _generation_key(thread_id)
+            await redis_client.incr(key)
+            await redis_client.expire(key, MESSAGE_CACHE_GENERATION_TTL)
+        except Exception as e:
+            logger.warning(f"Failed to bump message cache generation for thread {thread_id}: {str(e)}")
+
+
+_message_cache: Optional[ThreadMessageCache] = None
+
+
+def get_message_cache() -> ThreadMessageCache:
+    """Get the process-wide thread message cache."""
+    global _message_cache
+    if _message_cache is None:
+        _message_cache = ThreadMessageCache()
+    return _message_cache
+
+
+async def invalidate_thread_messages(thread_id: str):
+    """Invalidate cached LLM messages for a thread after a delete or rewrite."""
+    await get_message_cache().invalidate(thread_id)
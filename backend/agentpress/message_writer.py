@@ -0,0 +1,193 @@
+"""
+Write-behind message writer for AgentPress.
+
+A streamed turn saves a series of status rows (``thread_run_start``,
+``assistant_response_start``, ``tool_started`` / ``tool_completed``,
+``finish``, ``thread_run_end``). Awaiting an insert for each of them puts a
+database round trip between the LLM and the client.
+
+``MessageWriter`` sits in front of the ``add_message`` callback. Status-like
+rows get a client-side ``message_id``, are returned immediately and are
+bulk-inserted in order on a short timer. Every other message (assistant, tool
+results, ``assistant_response_end``, ...) is written directly, after
+flushing the buffer. Both kinds of rows get their ``created_at`` from the
+database clock when they are inserted, so the order of the thread is the
+order they were written in.
+"""
+
+import uuid
+import asyncio
+from datetime import datetime, timezone
+from typing import List, Dict, Any, Optional, Callable, Union
+
+from utils.logger import logger
+
+# Message types that are written behind. None of them are read back by the LLM,
+# and losing one loses no usage: saving assistant_response_end bills the turn
+BUFFERED_MESSAGE_TYPES = frozenset({"status"})
+# Delay between the first buffered row and the flush that writes it
+MESSAGE_WRITE_FLUSH_INTERVAL = 0.25
+# Buffer size that triggers a flush without waiting for the timer
+MESSAGE_WRITE_MAX_BATCH = 50
+# Number of failed flushes after which buffered rows are written one by one,
+# and those that still fail are dropped
+MESSAGE_WRITE_MAX_ATTEMPTS = 3
+# Delay before retrying a failed flush, doubled after each failure
+MESSAGE_WRITE_RETRY_BACKOFF = 0.5
+
+
+class MessageWriter:
+    """Buffers status rows and bulk-inserts them off the streaming path."""
+
+    def __init__(
+        self,
+        add_message_callback: Callable,
+        insert_messages_callback: Optional[Callable] = None,
+        flush_interval: float = MESSAGE_WRITE_FLUSH_INTERVAL,
+        max_batch: int = MESSAGE_WRITE_MAX_BATCH,
+    ):
+        """Initialize the MessageWriter.
+
+        Args:
+            add_message_callback: ThreadManager.add_message, used for direct writes.
+            insert_messages_callback: ThreadManager.insert_messages, used for
+                bulk writes. Without it every message is written directly.
+            flush_interval: Seconds a buffered row may wait before being written.
+            max_batch: Number of buffered rows that triggers an immediate flush.
+        """
+        self._add_message = add_message_callback
+        self._insert_messages = insert_messages_callback
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._buffer: List[Dict[str, Any]] = []
+        self._failed_attempts = 0
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def add_message(
+        self,
+        thread_id: str,
+        type: str,
+        content: Union[Dict[str, Any], List[Any], str],
+        is_llm_message: bool = False,
+        metadata: Optional[Dict[str, Any]] = None,
+        agent_id: Optional[str] = None,
+        agent_version_id: Optional[str] = None
+    ) -> Optional[Dict[str, Any]]:
+        """Save a message, buffering it when its type allows.
+
+        Same signature and return value as ``ThreadManager.add_message``.
+        """
+        # Only plain dict payloads are buffered, so one unserializable row
+        # (e.g. a raw provider response object) cannot fail a whole batch
+        buffered = (
+            self._insert_messages is not None
+            and not is_llm_message
+            and type in BUFFERED_MESSAGE_TYPES
+            and isinstance(content, dict)
+        )
+        if not buffered:
+            await self.flush()
+            return await self._add_message(
+                thread_id=thread_id, type=type, content=content,
+                is_llm_message=is_llm_message, metadata=metadata,
+                agent_id=agent_id, agent_version_id=agent_version_id
+            )
+
+        row = {
+            'message_id': str(uuid.uuid4()),
+            'thread_id': thread_id,
+            'type': type,
+            'content': content,
+            'is_llm_message': is_llm_message,
+            'metadata': metadata or {},
+            'agent_id': agent_id,
+            'agent_version_id': agent_version_id,
+        }
+        self._buffer.append(row)
+        self._schedule_flush(0 if len(self._buffer) >= self.max_batch else self.flush_interval)
+        # The stored created_at is set on insert, this one is only for the stream
+        now = datetime.now(timezone.utc).isoformat()
+        return {**row, 'created_at': now, 'updated_at': now}
+
+    def _schedule_flush(self, delay: float):
+        if delay > 0 and self._flush_task is not None and not self._flush_task.done():
+            return
+        self._flush_task = asyncio.create_task(self._flush_after(delay))
+
+    def _retry_delay(self) -> float:
+        return MESSAGE_WRITE_RETRY_BACKOFF * 2 ** max(0, self._failed_attempts - 1)
+
+    def _flush_failed(self) -> bool:
+        return bool(self._buffer) and self._failed_attempts > 0
+
+    async def _flush_after(self, delay: float):
+        while True:
+            try:
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                return
+            # Rows are taken out of the buffer once the flush starts, so it must
+            # not be interrupted half-way
+            await asyncio.shield(self.flush())
+            if not self._flush_failed():
+                return
+            delay = self._retry_delay()
+
+    async def flush(self):
+        """Write all buffered rows, in the order they were added.
+
+        Failures are logged and the rows are kept for the next flush, which
+        the timer and ``close`` retry after ``MESSAGE_WRITE_RETRY_BACKOFF``
+        seconds, doubled after each failure. After
+        ``MESSAGE_WRITE_MAX_ATTEMPTS`` consecutive failures they are written
+        one by one, so that one bad row cannot hold back the others, and the
+        rows that still fail are dropped. Inserts are idempotent on
+        ``message_id``, so retrying is safe.
+        """
+        async with self._flush_lock:
+            if not self._buffer:
+                return
+            rows, self._buffer = self._buffer, []
+            try:
+                await self._insert_messages(rows)
+                self._failed_attempts = 0
+                logger.debug(f"Flushed {len(rows)} buffered messages")
+            except Exception as e:
+                self._failed_attempts += 1
+                if self._failed_attempts >= MESSAGE_WRITE_MAX_ATTEMPTS:
+                    logger.warning(f"Failed to flush {len(rows)} buffered messages {self._failed_attempts} times, writing them one by one: {str(e)}")
+                    self._failed_attempts = 0
+                    await self._write_one_by_one(rows)
+                else:
+                    logger.warning(f"Failed to flush {len(rows)} buffered messages (attempt {self._failed_attempts}): {str(e)}")
+                    self._buffer = rows + self._buffer
+
+    async def _write_one_by_one(self, rows: List[Dict[str, Any]]):
+        for row in rows:
+            try:
+                await self._insert_messages([row])
+            except Exception as e:
+                logger.error(f"Dropping buffered {row['type']} message {row['message_id']} of thread {row['thread_id']}: {str(e)}", exc_info=True)
+
+    async def close(self):
+        """Flush everything that is still buffered, retrying failed writes.
+
+        Shielded so that a cancelled agent run still persists its final rows.
+        """
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        self._flush_task = None
+
+        async def _drain():
+            while self._buffer:
+                await self.flush()
+                if self._flush_failed():
+                    await asyncio.sleep(self._retry_delay())
+
+        try:
+            await asyncio.shield(_drain())
+        except asyncio.CancelledError:
+            logger.warning("Cancelled while closing message writer, pending rows are still being written")
+            raise
@@ -0,0 +1,130 @@
+"""
+System prompt assembly for AgentPress.
+
+Provider prompt caches match on an exact prefix. The system prompt is therefore
+kept as two text blocks: an immutable prefix (base prompt, knowledge base, MCP
+tool list and the tool schema block) followed by a small volatile suffix
+(current date and time). Only the prefix carries a cache breakpoint.
+
+The tool schema block is rendered once per distinct tool set and memoized by
+the ToolRegistry fingerprint, instead of re-serializing every schema on every
+turn.
+"""
+
+import copy
+from collections import OrderedDict
+from typing import Dict, Any
+
+from utils.logger import logger
+
+# Number of rendered tool schema blocks kept in memory
+TOOL_BLOCK_CACHE_MAX_ENTRIES = 32
+
+TOOL_EXAMPLES_TEMPLATE = """
+In this environment you have access to a set of tools you can use to answer the user's question.
+
+You can invoke functions by writing a <function_calls> block like the following as part of your reply to the user:
+
+<function_calls>
+<invoke name="function_name">
+<parameter name="param_name">param_value</parameter>
+...
+</invoke>
+</function_calls>
+
+String and scalar parameters should be specified as-is, while lists and objects should use JSON format.
+
+Here are the functions available in JSON Schema format:
+
+```json
+{schemas_json}
+```
+
+When using the tools:
+- Use the exact function names from the JSON schema above
+- Include all required parameters as specified in the schema
+- Format complex data (objects, arrays) as JSON strings within the parameter tags
+- Boolean values should be "true" or "false" (lowercase)
+{usage_examples_section}"""
+
+_tool_blocks: "OrderedDict[str, str]" = OrderedDict()
+
+
+def supports_cache_blocks(llm_model: str) -> bool:
+    """Whether the provider caches individual system prompt blocks (Anthropic)."""
+    model = (llm_model or "").lower()
+    return "claude" in model or "anthropic" in model
+
+
+def build_system_message(prefix: str, suffix: str = "") -> Dict[str, Any]:
+    """Build a system message from its immutable prefix and volatile suffix."""
+    content = [{"type": "text", "text": prefix}]
+    if suffix:
+        content.append({"type": "text", "text": suffix})
+    return {"role": "system", "content": content}
+
+
+def get_tool_examples_block(tool_registry) -> str:
+    """Render the XML tool calling instructions and schemas for a registry.
+
+    Returns an empty string when no tools are registered.
+    """
+    compiled = tool_registry.compile()
+    fingerprint = compiled.fingerprint
+    block = _tool_blocks.get(fingerprint)
+    if block is not None:
+        _tool_blocks.move_to_end(fingerprint)
+        return block
+
+    block = ""
+    if compiled.openapi_schemas:
+        # Build usage examples section if any exist
+        usage_examples_section = ""
+        if compiled.usage_examples:
+            usage_examples_section = "\n\nUsage Examples:\n"
+            for func_name, example in compiled.usage_examples.items():
+                usage_examples_section += f"\n{func_name}:\n{example}\n"
+
+        block = TOOL_EXAMPLES_TEMPLATE.format(
+            schemas_json=compiled.schemas_json,
+            usage_examples_section=usage_examples_section
+        )
+        logger.debug(f"Rendered tool schema block for {len(compiled.openapi_schemas)} tools ({len(block)} chars)")
+
+    _tool_blocks[fingerprint] = block
+    if len(_tool_blocks) > TOOL_BLOCK_CACHE_MAX_ENTRIES:
+        _tool_blocks.popitem(last=False)
+    return block
+
+
+def append_to_prefix(system_prompt: Dict[str, Any], text: str) -> Dict[str, Any]:
+    """Return a copy of the system message with text appended to its prefix block."""
+    working = copy.deepcopy(system_prompt)
+    content = working.get('content')
+
+    if isinstance(content, str):
+        working['content'] = content + text
+    elif isinstance(content, list):
+        for item in content:
+            if isinstance(item, dict) and item.get('type') == 'text' and 'text' in item:
+                item['text'] += text
+                break
+        else:
+            logger.warning("System prompt content is a list but no text block found to append to.")
+    else:
+        logger.warning(f"System prompt content is of unexpected type ({type(content)}), cannot append to it.")
+    return working
+
+
+def finalize_system_prompt(system_prompt: Dict[str, Any], llm_model: str) -> Dict[str, Any]:
+    """Adapt the system message to the provider.
+
+    Providers without block-level caching get a single string, which keeps the
+    prefix byte-identical for their automatic prefix caching.
+    """
+    content = system_prompt.get('content')
+    if supports_cache_blocks(llm_model) or not isinstance(content, list):
+        return system_prompt
+    if not all(isinstance(item, dict) and item.get('type') == 'text' for item in content):
+        return system_prompt
+    return {**system_prompt, 'content': "".join(item.get('text', '') for item in content)}
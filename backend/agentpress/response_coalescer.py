@@ -0,0 +1,176 @@
+"""
+Coalescing of streamed agent responses.
+
+Every token delta of a streamed LLM response reaches the agent worker as its
+own assistant chunk, and every response the worker receives is written to
+Redis, announced to viewers and read back by each of them.
+
+``ResponseCoalescer`` merges consecutive assistant content chunks of the same
+thread run into a single chunk, which is emitted once a short time window has
+passed since its first delta or once it reaches a size limit. Any other
+response first flushes the pending chunk and is then passed through
+immediately, so tool and status events are never delayed and the order of the
+stream is preserved. A merged chunk keeps the ``sequence`` of its first delta.
+"""
+
+import json
+import asyncio
+from typing import AsyncIterator, AsyncGenerator, Dict, Any, List, Optional
+
+from utils.json_helpers import to_json_string
+from utils.logger import logger
+
+# Time a content chunk may be held back to be merged with the following ones
+DEFAULT_COALESCE_WINDOW_MS = 30
+# Size of merged chunk content (UTF-8) that triggers an immediate flush
+DEFAULT_COALESCE_MAX_BYTES = 2048
+# Responses read from the agent while the consumer is busy
+COALESCE_READ_AHEAD = 32
+
+_END = object()
+
+
+class _Failure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class ResponseCoalescer:
+    """Merges consecutive assistant content chunks of a response stream."""
+
+    def __init__(
+        self,
+        window_ms: int = DEFAULT_COALESCE_WINDOW_MS,
+        max_bytes: int = DEFAULT_COALESCE_MAX_BYTES
+    ):
+        """Initialize the coalescer.
+
+        Args:
+            window_ms: Maximum time a chunk is held back, 0 disables coalescing
+            max_bytes: Merged content size that flushes the chunk right away
+        """
+        self.window = max(window_ms, 0) / 1000
+        self.max_bytes = max_bytes
+        # Responses received from the agent and emitted to the consumer
+        self.received = 0
+        self.emitted = 0
+
+        self._pending: Optional[Dict[str, Any]] = None
+        self._pending_parts: List[str] = []
+        self._pending_bytes = 0
+        self._pending_run: Optional[str] = None
+        self._pending_last: Optional[Dict[str, Any]] = None
+
+    @staticmethod
+    def _chunk_text(response: Dict[str, Any]):
+        """Return (thread_run_id, text) of a mergeable content chunk, or None."""
+        if response.get('type') != 'assistant' or response.get('message_id') is not None:
+            return None
+        try:
+            metadata = json.loads(response.get('metadata') or '{}')
+            content = json.loads(response.get('content') or '{}')
+        except (TypeError, json.JSONDecodeError):
+            return None
+        if not isinstance(metadata, dict) or metadata.get('stream_status') != 'chunk':
+            return None
+        if not isinstance(content, dict) or set(content) != {'role', 'content'} or not isinstance(content['content'], str):
+            return None
+        return metadata.get('thread_run_id'), content['content']
+
+    def _take_pending(self) -> Dict[str, Any]:
+        merged = self._pending
+        if len(self._pending_parts) > 1:
+            merged = dict(merged)
+            merged['content'] = to_json_string({"role": "assistant", "content": "".join(self._pending_parts)})
+            merged['updated_at'] = self._pending_last.get('updated_at', merged.get('updated_at'))
+        self._pending = None
+        self._pending_parts = []
+        self._pending_bytes = 0
+        self._pending_run = None
+        self._pending_last = None
+        self.emitted += 1
+        return merged
+
+    async def coalesce(self, responses: AsyncIterator[Dict[str, Any]]) -> AsyncGenerator[Dict[str, Any], None]:
+        """Yield the responses of an agent run with content chunks merged.
+
+        The agent is read by a separate task so that a pending chunk can be
+        flushed when its window expires while the agent is still working.
+        Errors raised by the agent are re-raised after the pending chunk.
+        """
+        if self.window <= 0:
+            async for response in responses:
+                self.received += 1
+                self.emitted += 1
+                yield response
+            return
+
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=COALESCE_READ_AHEAD)
+
+        async def pump():
+            try:
+                async for response in responses:
+                    await queue.put(response)
+                await queue.put(_END)
+            except asyncio.CancelledError:
+                raise
+            except BaseException as e:
+                await queue.put(_Failure(e))
+
+        pump_task = asyncio.create_task(pump())
+        # Kept across timeouts; asyncio.wait never cancels it, so no item is lost
+        getter: Optional[asyncio.Future] = None
+        deadline = 0.0
+        try:
+            while True:
+                if getter is None:
+                    getter = asyncio.ensure_future(queue.get())
+                if self._pending is not None:
+                    await asyncio.wait({getter}, timeout=max(deadline - loop.time(), 0))
+                    if not getter.done():
+                        yield self._take_pending()
+                        continue
+                item = await getter
+                getter = None
+
+                if item is _END or isinstance(item, _Failure):
+                    if self._pending is not None:
+                        yield self._take_pending()
+                    if isinstance(item, _Failure):
+                        raise item.error
+                    return
+
+                self.received += 1
+                chunk = self._chunk_text(item)
+                if chunk is None:
+                    if self._pending is not None:
+                        yield self._take_pending()
+                    self.emitted += 1
+                    yield item
+                    continue
+
+                thread_run_id, text = chunk
+                if self._pending is not None and self._pending_run != thread_run_id:
+                    yield self._take_pending()
+                if self._pending is None:
+                    self._pending = item
+                    self._pending_run = thread_run_id
+                    deadline = loop.time() + self.window
+                self._pending_parts.append(text)
+                self._pending_bytes += len(text.encode('utf-8'))
+                self._pending_last = item
+                if self._pending_bytes >= self.max_bytes:
+                    yield self._take_pending()
+        finally:
+            if getter is not None and not getter.done():
+                getter.cancel()
+            if not pump_task.done():
+                pump_task.cancel()
+            # gather() returns the reader's own cancellation instead of raising it
+            await asyncio.gather(pump_task, return_exceptions=True)
+            if hasattr(responses, 'aclose'):
+                try:
+                    await responses.aclose()
+                except Exception as e:
+                    logger.warning(f"Error while closing response stream: {str(e)}")
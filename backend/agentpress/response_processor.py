@@ -19,6 +19,8 @@ from utils.logger import logger
 from agentpress.tool import ToolResult
 from agentpress.tool_registry import ToolRegistry
 from agentpress.xml_tool_parser import XMLToolParser
+from agentpress.xml_stream_scanner import XMLToolCallScanner
+from agentpress.message_writer import MessageWriter
 from langfuse.client import StatefulTraceClient
 from services.langfuse import langfuse
 from utils.json_helpers import (
@@ -26,6 +28,7 @@ from utils.json_helpers import (
     to_json_string, format_for_yield
 )
 from litellm.utils import token_counter
+from agentpress.token_cache import count_messages_tokens
 
 # Type alias for XML result adding strategy
 XmlAddingStrategy = Literal["user_message", "assistant_message", "inline_edit"]
@@ -86,7 +89,7 @@ class ProcessorConfig:
 class ResponseProcessor:
     """Processes LLM responses, extracting and executing tool calls."""
     
-    def __init__(self, tool_registry: ToolRegistry, add_message_callback: Callable, trace: Optional[StatefulTraceClient] = None, is_agent_builder: bool = False, target_agent_id: Optional[str] = None, agent_config: Optional[dict] = None):
+    def __init__(self, tool_registry: ToolRegistry, add_message_callback: Callable, trace: Optional[StatefulTraceClient] = None, is_agent_builder: bool = False, target_agent_id: Optional[str] = None, agent_config: Optional[dict] = None, insert_messages_callback: Optional[Callable] = None):
         """Initialize the ResponseProcessor.
         
         Args:
@@ -94,9 +97,14 @@ class ResponseProcessor:
             add_message_callback: Callback function to add messages to the thread.
                 MUST return the full saved message object (dict) or None.
             agent_config: Optional agent configuration with version information
+            insert_messages_callback: Optional callback to bulk-insert prepared rows.
+                When provided, status messages are written behind in batches.
         """
         self.tool_registry = tool_registry
-        self.add_message = add_message_callback
+        # Status rows are buffered and written off the streaming path, everything
+        # else goes straight to add_message_callback
+        self.message_writer = MessageWriter(add_message_callback, insert_messages_callback)
+        self.add_message = self.message_writer.add_message
         self.trace = trace or langfuse.trace(name="anonymous:response_processor")
         # Initialize the XML parser
         self.xml_parser = XMLToolParser()
@@ -169,7 +177,8 @@ class ResponseProcessor:
         continuous_state = continuous_state or {}
         accumulated_content = continuous_state.get('accumulated_content', "")
         tool_calls_buffer = {}
-        current_xml_content = accumulated_content   # equal to accumulated_content if auto-continuing, else blank
+        # Incremental scanner for XML tool calls, primed with accumulated_content if auto-continuing
+        xml_scanner = XMLToolCallScanner(accumulated_content)
         xml_chunks_buffer = []
         pending_tool_executions = []
         yielded_tool_indices = set() # Stores indices of tools whose *status* has been yielded
@@ -266,7 +275,6 @@ class ResponseProcessor:
                         chunk_content = delta.content
                         # print(chunk_content, end='', flush=True)
                         accumulated_content += chunk_content
-                        current_xml_content += chunk_content
 
                         if not (config.max_xml_tool_calls > 0 and xml_tool_call_count >= config.max_xml_tool_calls):
                             # Yield ONLY content chunk (don't save)
@@ -286,9 +294,8 @@ class ResponseProcessor:
 
                         # --- Process XML Tool Calls (if enabled and limit not reached) ---
                         if config.xml_tool_calling and not (config.max_xml_tool_calls > 0 and xml_tool_call_count >= config.max_xml_tool_calls):
-                            xml_chunks = self._extract_xml_chunks(current_xml_content)
+                            xml_chunks = xml_scanner.feed(chunk_content)
                             for xml_chunk in xml_chunks:
-                                current_xml_content = current_xml_content.replace(xml_chunk, "", 1)
                                 xml_chunks_buffer.append(xml_chunk)
                                 result = self._parse_xml_tool_call(xml_chunk)
                                 if result:
@@ -398,10 +405,7 @@ class ResponseProcessor:
                 
                 try:
                     # prompt side
-                    prompt_tokens = token_counter(
-                        model=llm_model,
-                        messages=prompt_messages               # chat or plain; token_counter handles both
-                    )
+                    prompt_tokens = count_messages_tokens(llm_model, prompt_messages)
 
                     # completion side
                     completion_tokens = token_counter(
@@ -575,7 +579,7 @@ class ResponseProcessor:
                 parsed_xml_data = []
                 if config.xml_tool_calling:
                     # Reparse remaining content just in case (should be empty if processed correctly)
-                    xml_chunks = self._extract_xml_chunks(current_xml_content)
+                    xml_chunks = self._extract_xml_chunks(xml_scanner.pending)
                     xml_chunks_buffer.extend(xml_chunks)
                     # Process only chunks not already handled in the stream loop
                     remaining_limit = config.max_xml_tool_calls - xml_tool_call_count if config.max_xml_tool_calls > 0 else len(xml_chunks_buffer)
@@ -833,24 +837,28 @@ class ResponseProcessor:
             raise # Use bare 'raise' to preserve the original exception with its traceback
 
         finally:
-            # Update continuous state for potential auto-continue
-            if should_auto_continue:
-                continuous_state['accumulated_content'] = accumulated_content
-                continuous_state['sequence'] = __sequence
-                
-                logger.debug(f"Updated continuous state for auto-continue with {len(accumulated_content)} chars")
-            else:
-                # Save and Yield the final thread_run_end status (only if not auto-continuing and finish_reason is not 'length')
-                try:
-                    end_content = {"status_type": "thread_run_end"}
-                    end_msg_obj = await self.add_message(
-                        thread_id=thread_id, type="status", content=end_content, 
-                        is_llm_message=False, metadata={"thread_run_id": thread_run_id if 'thread_run_id' in locals() else None}
-                    )
-                    if end_msg_obj: yield format_for_yield(end_msg_obj)
-                except Exception as final_e:
-                    logger.error(f"Error in finally block: {str(final_e)}", exc_info=True)
-                    self.trace.event(name="error_in_finally_block", level="ERROR", status_message=(f"Error in finally block: {str(final_e)}"))
+            try:
+                # Update continuous state for potential auto-continue
+                if should_auto_continue:
+                    continuous_state['accumulated_content'] = accumulated_content
+                    continuous_state['sequence'] = __sequence
+                    
+                    logger.debug(f"Updated continuous state for auto-continue with {len(accumulated_content)} chars")
+                else:
+                    # Save and Yield the final thread_run_end status (only if not auto-continuing and finish_reason is not 'length')
+                    try:
+                        end_content = {"status_type": "thread_run_end"}
+                        end_msg_obj = await self.add_message(
+                            thread_id=thread_id, type="status", content=end_content, 
+                            is_llm_message=False, metadata={"thread_run_id": thread_run_id if 'thread_run_id' in locals() else None}
+                        )
+                        if end_msg_obj: yield format_for_yield(end_msg_obj)
+                    except Exception as final_e:
+                        logger.error(f"Error in finally block: {str(final_e)}", exc_info=True)
+                        self.trace.event(name="error_in_finally_block", level="ERROR", status_message=(f"Error in finally block: {str(final_e)}"))
+            finally:
+                # Turn boundary: persist buffered status rows, also on error or cancellation
+                await self.message_writer.close()
 
     async def process_non_streaming_response(
         self,
@@ -1039,13 +1047,16 @@ class ResponseProcessor:
              raise # Use bare 'raise' to preserve the original exception with its traceback
 
         finally:
-             # Save and Yield the final thread_run_end status
-            end_content = {"status_type": "thread_run_end"}
-            end_msg_obj = await self.add_message(
-                thread_id=thread_id, type="status", content=end_content, 
-                is_llm_message=False, metadata={"thread_run_id": thread_run_id if 'thread_run_id' in locals() else None}
-            )
-            if end_msg_obj: yield format_for_yield(end_msg_obj)
+            try:
+                # Save and Yield the final thread_run_end status
+                end_content = {"status_type": "thread_run_end"}
+                end_msg_obj = await self.add_message(
+                    thread_id=thread_id, type="status", content=end_content, 
+                    is_llm_message=False, metadata={"thread_run_id": thread_run_id if 'thread_run_id' in locals() else None}
+                )
+                if end_msg_obj: yield format_for_yield(end_msg_obj)
+            finally:
+                await self.message_writer.close()
 
 
     def _extract_xml_chunks(self, content: str) -> List[str]:
@@ -1080,26 +1091,15 @@ class ResponseProcessor:
             # If no new format found, fall back to old format for backwards compatibility
             if not chunks:
                 pos = 0
-                while pos < len(content):
-                    # Find the next tool tag
-                    next_tag_start = -1
-                    current_tag = None
-                    
-                    # Find the earliest occurrence of any registered tool function name
-                    # Check for available function names
-                    available_functions = self.tool_registry.get_available_functions()
-                    for func_name in available_functions.keys():
-                        # Convert function name to potential tag name (underscore to dash)
-                        tag_name = func_name.replace('_', '-')
-                        start_pattern = f'<{tag_name}'
-                        tag_pos = content.find(start_pattern, pos)
-                        
-                        if tag_pos != -1 and (next_tag_start == -1 or tag_pos < next_tag_start):
-                            next_tag_start = tag_pos
-                            current_tag = tag_name
-                    
-                    if next_tag_start == -1 or not current_tag:
+                # Precompiled pattern matching the opening of any registered tool tag
+                tag_pattern = self.tool_registry.compile().tag_pattern
+                while tag_pattern and pos < len(content):
+                    # Find the earliest occurrence of any registered tool tag
+                    tag_match = tag_pattern.search(content, pos)
+                    if not tag_match:
                         break
+                    next_tag_start = tag_match.start()
+                    current_tag = tag_match.group(1)
                     
                     # Find the matching end tag
                     end_pattern = f'</{current_tag}>'
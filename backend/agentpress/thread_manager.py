@@ -10,12 +10,15 @@ This module provides comprehensive conversation management, including:
 - Context summarization to manage token limits
 """
 
+import copy
 import json
 from typing import List, Dict, Any, Optional, Type, Union, AsyncGenerator, Literal, cast
 from services.llm import make_llm_api_call
 from agentpress.tool import Tool
 from agentpress.tool_registry import ToolRegistry
 from agentpress.context_manager import ContextManager
+from agentpress.message_cache import get_message_cache
+from agentpress.prompt_builder import get_tool_examples_block, append_to_prefix, finalize_system_prompt
 from agentpress.response_processor import (
     ResponseProcessor,
     ProcessorConfig
@@ -24,8 +27,8 @@ from services.supabase import DBConnection
 from utils.logger import logger
 from langfuse.client import StatefulGenerationClient, StatefulTraceClient
 from services.langfuse import langfuse
-from litellm.utils import token_counter
-from services.billing import calculate_token_cost, handle_usage_with_credits
+from agentpress.token_cache import count_messages_tokens
+from services.usage_ledger import record_usage
 import re
 from datetime import datetime, timezone, timedelta
 import aiofiles
@@ -62,12 +65,14 @@ class ThreadManager:
         self.response_processor = ResponseProcessor(
             tool_registry=self.tool_registry,
             add_message_callback=self.add_message,
+            insert_messages_callback=self.insert_messages,
             trace=self.trace,
             is_agent_builder=self.is_agent_builder,
             target_agent_id=self.target_agent_id,
             agent_config=self.agent_config
         )
         self.context_manager = ContextManager()
+        self.message_cache = get_message_cache()
 
     def add_tool(self, tool_class: Type[Tool], function_names: Optional[List[str]] = None, **kwargs):
         """Add a tool to the ThreadManager."""
@@ -174,30 +179,7 @@ class ThreadManager:
 
             if result.data and len(result.data) > 0 and isinstance(result.data[0], dict) and 'message_id' in result.data[0]:
                 saved_message = result.data[0]
-                # If this is an assistant_response_end, attempt to deduct credits if over limit
-                if type == "assistant_response_end" and isinstance(content, dict):
-                    try:
-                        usage = content.get("usage", {}) if isinstance(content, dict) else {}
-                        prompt_tokens = int(usage.get("prompt_tokens", 0) or 0)
-                        completion_tokens = int(usage.get("completion_tokens", 0) or 0)
-                        model = content.get("model") if isinstance(content, dict) else None
-                        # Compute token cost
-                        token_cost = calculate_token_cost(prompt_tokens, completion_tokens, model or "unknown")
-                        # Fetch account_id for this thread, which equals user_id for personal accounts
-                        thread_row = await client.table('threads').select('account_id').eq('thread_id', thread_id).limit(1).execute()
-                        user_id = thread_row.data[0]['account_id'] if thread_row.data and len(thread_row.data) > 0 else None
-                        if user_id and token_cost > 0:
-                            # Deduct credits if applicable and record usage against this message
-                            await handle_usage_with_credits(
-                                client,
-                                user_id,
-                                token_cost,
-                                thread_id=thread_id,
-                                message_id=saved_message['message_id'],
-                                model=model or "unknown"
-                            )
-                    except Exception as billing_e:
-                        logger.error(f"Error handling credit usage for message {saved_message.get('message_id')}: {str(billing_e)}", exc_info=True)
+                await self._on_message_saved(saved_message)
                 return saved_message
             else:
                 logger.error(f"Insert operation failed or did not return expected data structure for thread {thread_id}. Result data: {result.data}")
@@ -206,11 +188,58 @@ class ThreadManager:
             logger.error(f"Failed to add message to thread {thread_id}: {str(e)}", exc_info=True)
             raise
 
+    async def insert_messages(self, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Bulk-insert prepared message rows, in order.
+
+        Used by the write-behind MessageWriter. Rows carry their own
+        ``message_id``; rows that already exist are skipped, so a retried batch
+        is not written (or billed) twice. The ``insert_messages_batch`` function
+        stamps them with the database clock, in order, like single inserts.
+
+        Args:
+            rows: Complete message rows, as built by ``MessageWriter``.
+
+        Returns:
+            The rows that were actually inserted.
+        """
+        if not rows:
+            return []
+        logger.debug(f"Bulk inserting {len(rows)} messages")
+        client = await self.db.client
+
+        result = await client.rpc('insert_messages_batch', {'p_rows': rows}).execute()
+
+        for saved_message in result.data or []:
+            await self._on_message_saved(saved_message)
+        return result.data or []
+
+    async def _on_message_saved(self, saved_message: Dict[str, Any]):
+        """Post-insert bookkeeping shared by single and bulk inserts."""
+        thread_id = saved_message.get('thread_id')
+        content = saved_message.get('content')
+        if saved_message.get('is_llm_message'):
+            self.message_cache.note_inserted(thread_id, saved_message)
+        # Usage is billed asynchronously by the usage ledger worker
+        if saved_message.get('type') == "assistant_response_end" and isinstance(content, dict):
+            try:
+                usage = content.get("usage", {}) or {}
+                await record_usage(
+                    thread_id,
+                    saved_message['message_id'],
+                    content.get("model"),
+                    int(usage.get("prompt_tokens", 0) or 0),
+                    int(usage.get("completion_tokens", 0) or 0)
+                )
+            except Exception as billing_e:
+                logger.error(f"Error recording usage for message {saved_message.get('message_id')}: {str(billing_e)}", exc_info=True)
+
     async def get_llm_messages(self, thread_id: str) -> List[Dict[str, Any]]:
         """Get all messages for a thread.
 
-        This method uses the SQL function which handles context truncation
-        by considering summary messages.
+        Messages are served from the incremental per-thread message cache,
+        which only fetches rows added since the previous call. If the thread
+        has a summary checkpoint, only the latest checkpoint and the messages
+        after it are returned.
 
         Args:
             thread_id: The ID of the thread to get messages for.
@@ -223,49 +252,10 @@ class ThreadManager:
 
         try:
             # result = await client.rpc('get_llm_formatted_messages', {'p_thread_id': thread_id}).execute()
-            
-            # Fetch messages in batches of 1000 to avoid overloading the database
-            all_messages = []
-            batch_size = 1000
-            offset = 0
-            
-            while True:
-                result = await client.table('messages').select('message_id, content').eq('thread_id', thread_id).eq('is_llm_message', True).order('created_at').range(offset, offset + batch_size - 1).execute()
-                
-                if not result.data or len(result.data) == 0:
-                    break
-                    
-                all_messages.extend(result.data)
-                
-                # If we got fewer than batch_size records, we've reached the end
-                if len(result.data) < batch_size:
-                    break
-                    
-                offset += batch_size
-            
-            # Use all_messages instead of result.data in the rest of the method
-            result_data = all_messages
-
-            # Parse the returned data which might be stringified JSON
-            if not result_data:
-                return []
-
-            # Return properly parsed JSON objects
-            messages = []
-            for item in result_data:
-                if isinstance(item['content'], str):
-                    try:
-                        parsed_item = json.loads(item['content'])
-                        parsed_item['message_id'] = item['message_id']
-                        messages.append(parsed_item)
-                    except json.JSONDecodeError:
-                        logger.error(f"Failed to parse message: {item['content']}")
-                else:
-                    content = item['content']
-                    content['message_id'] = item['message_id']
-                    messages.append(content)
 
-            return messages
+            # Only rows newer than the last seen created_at are fetched and parsed;
+            # the rest of the thread comes from the per-thread message cache
+            return await self.message_cache.get_messages(client, thread_id)
 
         except Exception as e:
             logger.error(f"Failed to get messages for thread {thread_id}: {str(e)}", exc_info=True)
@@ -331,76 +321,17 @@ class ThreadManager:
             config.max_xml_tool_calls = max_xml_tool_calls
 
         # Create a working copy of the system prompt to potentially modify
-        working_system_prompt = system_prompt.copy()
+        working_system_prompt = copy.deepcopy(system_prompt)
 
-        # Add XML tool calling instructions to system prompt if requested
+        # Add XML tool calling instructions to the immutable prefix of the system prompt,
+        # the block is rendered once per tool set and reused across turns
         if include_xml_examples and config.xml_tool_calling:
-            openapi_schemas = self.tool_registry.get_openapi_schemas()
-            usage_examples = self.tool_registry.get_usage_examples()
-            
-            if openapi_schemas:
-                # Convert schemas to JSON string
-                schemas_json = json.dumps(openapi_schemas, indent=2)
-                
-                # Build usage examples section if any exist
-                usage_examples_section = ""
-                if usage_examples:
-                    usage_examples_section = "\n\nUsage Examples:\n"
-                    for func_name, example in usage_examples.items():
-                        usage_examples_section += f"\n{func_name}:\n{example}\n"
-                
-                examples_content = f"""
-In this environment you have access to a set of tools you can use to answer the user's question.
-
-You can invoke functions by writing a <function_calls> block like the following as part of your reply to the user:
-
-<function_calls>
-<invoke name="function_name">
-<parameter name="param_name">param_value</parameter>
-...
-</invoke>
-</function_calls>
-
-String and scalar parameters should be specified as-is, while lists and objects should use JSON format.
-
-Here are the functions available in JSON Schema format:
-
-```json
-{schemas_json}
-```
-
-When using the tools:
-- Use the exact function names from the JSON schema above
-- Include all required parameters as specified in the schema
-- Format complex data (objects, arrays) as JSON strings within the parameter tags
-- Boolean values should be "true" or "false" (lowercase)
-{usage_examples_section}"""
-
-                # # Save examples content to a file
-                # try:
-                #     with open('xml_examples.txt', 'w') as f:
-                #         f.write(examples_content)
-                #     logger.debug("Saved XML examples to xml_examples.txt")
-                # except Exception as e:
-                #     logger.error(f"Failed to save XML examples to file: {e}")
-
-                system_content = working_system_prompt.get('content')
-
-                if isinstance(system_content, str):
-                    working_system_prompt['content'] += examples_content
-                    logger.debug("Appended XML examples to string system prompt content.")
-                elif isinstance(system_content, list):
-                    appended = False
-                    for item in working_system_prompt['content']: # Modify the copy
-                        if isinstance(item, dict) and item.get('type') == 'text' and 'text' in item:
-                            item['text'] += examples_content
-                            logger.debug("Appended XML examples to the first text block in list system prompt content.")
-                            appended = True
-                            break
-                    if not appended:
-                        logger.warning("System prompt content is a list but no text block found to append XML examples.")
-                else:
-                    logger.warning(f"System prompt content is of unexpected type ({type(system_content)}), cannot add XML examples.")
+            examples_content = get_tool_examples_block(self.tool_registry)
+            if examples_content:
+                working_system_prompt = append_to_prefix(working_system_prompt, examples_content)
+                logger.debug("Appended XML examples to the system prompt prefix.")
+
+        working_system_prompt = finalize_system_prompt(working_system_prompt, llm_model)
         
         # Control whether we need to auto-continue due to tool_calls finish reason
         auto_continue = True
@@ -426,13 +357,19 @@ When using the tools:
                 token_count = 0
                 try:
                     # Use the potentially modified working_system_prompt for token counting
-                    token_count = token_counter(model=llm_model, messages=[working_system_prompt] + messages)
+                    token_count = count_messages_tokens(llm_model, [working_system_prompt] + messages)
                     token_threshold = self.context_manager.token_threshold
                     logger.debug(f"Thread {thread_id} token count: {token_count}/{token_threshold} ({(token_count/token_threshold)*100:.1f}%)")
 
                 except Exception as e:
                     logger.error(f"Error counting tokens or summarizing: {str(e)}")
 
+                # Past the threshold, checkpoint the older history into a summary in
+                # the background, so later turns only load the summary and what
+                # follows it. This turn goes on with the compressed messages.
+                if enable_context_manager and token_count >= self.context_manager.token_threshold:
+                    self.context_manager.schedule_checkpoint(thread_id, messages, llm_model, self.add_message)
+
                 # 3. Prepare messages for LLM call + add temporary message if it exists
                 # Use the working_system_prompt which may contain the XML examples
                 prepared_messages = [working_system_prompt]
@@ -0,0 +1,92 @@
+"""
+Token accounting cache for AgentPress.
+
+Counting tokens with litellm re-tokenizes every message on every call, and a
+single context-building pass used to count the full thread many times over.
+This module tokenizes each message once and memoizes the count under the
+message_id, a hash of the message as sent and the model's tokenizer family.
+List totals are computed by summing cached per-message counts, which matches
+``litellm.token_counter(model=..., messages=...)`` exactly.
+"""
+
+import json
+import hashlib
+from collections import OrderedDict
+from functools import lru_cache
+from typing import List, Dict, Any, Optional, Tuple
+
+from litellm.utils import token_counter, _select_tokenizer
+
+from utils.logger import logger
+
+# Maximum number of per-message counts kept in memory
+TOKEN_CACHE_MAX_ENTRIES = 50_000
+
+# litellm adds this many tokens to every message list to prime the reply
+REPLY_PRIMING_TOKENS = 3
+
+_token_counts: "OrderedDict[Tuple[str, Optional[str], str], int]" = OrderedDict()
+_stats = {"hits": 0, "misses": 0}
+
+
+@lru_cache(maxsize=256)
+def get_tokenizer_family(model: Optional[str]) -> str:
+    """Return a stable identifier of the tokenizer litellm uses for a model."""
+    if not model:
+        return "default"
+    try:
+        tokenizer = _select_tokenizer(model)
+        if tokenizer["type"] == "openai_tokenizer":
+            # Models sharing a tiktoken encoding produce identical counts
+            return f"tiktoken:{tokenizer['tokenizer'].name}"
+        return f"hf:{model}"
+    except Exception as e:
+        logger.debug(f"Could not resolve tokenizer for {model}: {str(e)}")
+        return f"model:{model}"
+
+
+def _content_hash(message: Dict[str, Any]) -> str:
+    serialized = json.dumps(message, sort_keys=True, default=str)
+    return hashlib.blake2b(serialized.encode("utf-8", "surrogatepass"), digest_size=16).hexdigest()
+
+
+def count_message_tokens(model: Optional[str], message: Dict[str, Any]) -> int:
+    """Count the tokens of a single message, using the cache when possible.
+
+    Args:
+        model: Model name used to select the tokenizer. ``None`` falls back to litellm's default.
+        message: The message dict as it will be sent to the LLM.
+
+    Returns:
+        The token count of the message, excluding reply priming tokens.
+    """
+    if not isinstance(message, dict):
+        return token_counter(model=model or "", messages=[message], count_response_tokens=True)
+
+    key = (get_tokenizer_family(model), message.get("message_id"), _content_hash(message))
+    cached = _token_counts.get(key)
+    if cached is not None:
+        _token_counts.move_to_end(key)
+        _stats["hits"] += 1
+        return cached
+
+    _stats["misses"] += 1
+    count = token_counter(model=model or "", messages=[message], count_response_tokens=True)
+
+    _token_counts[key] = count
+    if len(_token_counts) > TOKEN_CACHE_MAX_ENTRIES:
+        _token_counts.popitem(last=False)
+    return count
+
+
+def count_messages_tokens(model: Optional[str], messages: List[Dict[str, Any]]) -> int:
+    """Count the tokens of a message list by summing cached per-message counts.
+
+    Equivalent to ``token_counter(model=model, messages=messages)``.
+    """
+    return sum(count_message_tokens(model, msg) for msg in messages) + REPLY_PRIMING_TOKENS
+
+
+def get_token_cache_stats() -> Dict[str, int]:
+    """Return hit/miss counters and the current size of the token cache."""
+    return {**_stats, "size": len(_token_counts)}
@@ -1,7 +1,78 @@
-from typing import Dict, Type, Any, List, Optional, Callable
+from typing import Dict, Type, Any, List, Optional, Callable, Mapping, Tuple
+from dataclasses import dataclass
+from types import MappingProxyType
 from agentpress.tool import Tool, SchemaType
 from utils.logger import logger
+import re
 import json
+import hashlib
+
+
+@dataclass(frozen=True)
+class CompiledToolRegistry:
+    """Immutable dispatch tables derived from the registered tools.
+
+    Built lazily on first use and discarded whenever the registry changes.
+
+    Attributes:
+        functions: Function name -> bound tool method
+        tag_to_function: XML tag name (dashes) -> function name
+        openapi_schemas: OpenAPI schemas, in registration order
+        schemas_json: Pretty-printed JSON of openapi_schemas, as used in prompts
+        usage_examples: Function name -> usage example
+        tag_pattern: Regex matching the opening of any legacy XML tool tag
+        fingerprint: Stable digest of schemas and usage examples
+    """
+    functions: Mapping[str, Callable]
+    tag_to_function: Mapping[str, str]
+    openapi_schemas: Tuple[Dict[str, Any], ...]
+    schemas_json: str
+    usage_examples: Mapping[str, str]
+    tag_pattern: Optional["re.Pattern[str]"]
+    fingerprint: str
+
+
+class _ToolTable(dict):
+    """Dict of registered tools that notifies its registry of any change.
+
+    Some callers (MCP registration) write to ``ToolRegistry.tools`` directly,
+    so invalidation has to happen at the table level.
+    """
+
+    def __init__(self, on_change: Callable[[], None]):
+        super().__init__()
+        self._on_change = on_change
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._on_change()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._on_change()
+
+    def pop(self, *args):
+        result = super().pop(*args)
+        self._on_change()
+        return result
+
+    def popitem(self):
+        result = super().popitem()
+        self._on_change()
+        return result
+
+    def setdefault(self, key, default=None):
+        result = super().setdefault(key, default)
+        self._on_change()
+        return result
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._on_change()
+
+    def clear(self):
+        super().clear()
+        self._on_change()
 
 
 class ToolRegistry:
@@ -10,6 +81,9 @@ class ToolRegistry:
     Maintains a collection of tool instances and their schemas, allowing for
     selective registration of tool functions and easy access to tool capabilities.
     
+    Lookups are served from a compiled, immutable snapshot of the registry
+    which is rebuilt only after tools are added or removed.
+    
     Attributes:
         tools (Dict[str, Dict[str, Any]]): OpenAPI-style tools and schemas
         
@@ -17,12 +91,17 @@ class ToolRegistry:
         register_tool: Register a tool with optional function filtering
         get_tool: Get a specific tool by name
         get_openapi_schemas: Get OpenAPI schemas for function calling
+        compile: Get the compiled dispatch tables
     """
     
     def __init__(self):
         """Initialize a new ToolRegistry instance."""
-        self.tools = {}
+        self._compiled: Optional[CompiledToolRegistry] = None
+        self.tools = _ToolTable(self._invalidate)
         logger.debug("Initialized new ToolRegistry instance")
+
+    def _invalidate(self):
+        self._compiled = None
     
     def register_tool(self, tool_class: Type[Tool], function_names: Optional[List[str]] = None, **kwargs):
         """Register a tool with optional function filtering.
@@ -57,23 +136,77 @@ class ToolRegistry:
         
         logger.debug(f"Tool registration complete for {tool_class.__name__}: {registered_openapi} OpenAPI functions")
 
-    def get_available_functions(self) -> Dict[str, Callable]:
-        """Get all available tool functions.
-        
+    def compile(self) -> CompiledToolRegistry:
+        """Get the compiled dispatch tables, building them if the registry changed.
+
         Returns:
-            Dict mapping function names to their implementations
+            CompiledToolRegistry snapshot of the currently registered tools
         """
-        available_functions = {}
-        
-        # Get OpenAPI tool functions
+        if self._compiled is not None:
+            return self._compiled
+
+        functions = {}
+        tag_to_function = {}
+        openapi_schemas = []
+        usage_examples = {}
+        # get_schemas() of a shared instance (e.g. the MCP wrapper) is looked up once
+        instance_schemas = {}
+
         for tool_name, tool_info in self.tools.items():
             tool_instance = tool_info['instance']
-            function_name = tool_name
-            function = getattr(tool_instance, function_name)
-            available_functions[function_name] = function
-            
-        logger.debug(f"Retrieved {len(available_functions)} available functions")
-        return available_functions
+            functions[tool_name] = getattr(tool_instance, tool_name)
+            tag_to_function[tool_name.replace('_', '-')] = tool_name
+
+            if tool_info['schema'].schema_type == SchemaType.OPENAPI:
+                openapi_schemas.append(tool_info['schema'].schema)
+
+            all_schemas = instance_schemas.get(id(tool_instance))
+            if all_schemas is None:
+                all_schemas = tool_instance.get_schemas()
+                instance_schemas[id(tool_instance)] = all_schemas
+            for schema in all_schemas.get(tool_name, []):
+                if schema.schema_type == SchemaType.USAGE_EXAMPLE:
+                    usage_examples[tool_name] = schema.schema.get('example', '')
+                    break
+
+        tag_pattern = None
+        if tag_to_function:
+            # Longest tags first so that a tag is not shadowed by one of its prefixes
+            alternatives = sorted(tag_to_function.keys(), key=len, reverse=True)
+            tag_pattern = re.compile("<(" + "|".join(re.escape(tag) for tag in alternatives) + ")")
+
+        fingerprint_payload = json.dumps([openapi_schemas, usage_examples], sort_keys=True, default=str)
+
+        self._compiled = CompiledToolRegistry(
+            functions=MappingProxyType(functions),
+            tag_to_function=MappingProxyType(tag_to_function),
+            openapi_schemas=tuple(openapi_schemas),
+            schemas_json=json.dumps(openapi_schemas, indent=2),
+            usage_examples=MappingProxyType(usage_examples),
+            tag_pattern=tag_pattern,
+            fingerprint=hashlib.blake2b(fingerprint_payload.encode("utf-8"), digest_size=16).hexdigest(),
+        )
+        logger.debug(f"Compiled tool registry: {len(functions)} functions, {len(openapi_schemas)} OpenAPI schemas, {len(usage_examples)} usage examples")
+        return self._compiled
+
+    def get_fingerprint(self) -> str:
+        """Get a stable fingerprint of the registered tool set.
+
+        Two registries with the same functions, schemas and usage examples share
+        a fingerprint, so anything derived from them can be reused across runs.
+
+        Returns:
+            Hex digest identifying the registered tools
+        """
+        return self.compile().fingerprint
+
+    def get_available_functions(self) -> Mapping[str, Callable]:
+        """Get all available tool functions.
+
+        Returns:
+            Read-only mapping of function names to their implementations
+        """
+        return self.compile().functions
 
     def get_tool(self, tool_name: str) -> Dict[str, Any]:
         """Get a specific tool by name.
@@ -95,13 +228,7 @@ class ToolRegistry:
         Returns:
             List of OpenAPI-compatible schema definitions
         """
-        schemas = [
-            tool_info['schema'].schema 
-            for tool_info in self.tools.values()
-            if tool_info['schema'].schema_type == SchemaType.OPENAPI
-        ]
-        logger.debug(f"Retrieved {len(schemas)} OpenAPI schemas")
-        return schemas
+        return list(self.compile().openapi_schemas)
 
     def get_usage_examples(self) -> Dict[str, str]:
         """Get usage examples for tools.
@@ -109,21 +236,4 @@ class ToolRegistry:
         Returns:
             Dict mapping function names to their usage examples
         """
-        examples = {}
-        
-        # Get all registered tools and their schemas
-        for tool_name, tool_info in self.tools.items():
-            tool_instance = tool_info['instance']
-            all_schemas = tool_instance.get_schemas()
-            
-            # Look for usage examples for this function
-            if tool_name in all_schemas:
-                for schema in all_schemas[tool_name]:
-                    if schema.schema_type == SchemaType.USAGE_EXAMPLE:
-                        examples[tool_name] = schema.schema.get('example', '')
-                        logger.debug(f"Found usage example for {tool_name}")
-                        break
-        
-        logger.debug(f"Retrieved {len(examples)} usage examples")
-        return examples
-
+        return dict(self.compile().usage_examples)
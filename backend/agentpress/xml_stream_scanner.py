@@ -0,0 +1,87 @@
+"""
+Incremental scanner for XML tool calls in streamed LLM output.
+
+``ResponseProcessor`` used to append every content delta to a buffer, re-scan
+the whole buffer for ``<function_calls>`` blocks and cut found blocks out with
+``str.replace``, which is quadratic in the length of the response.
+
+``XMLToolCallScanner`` keeps its state across deltas instead. Outside a block
+it only remembers the few trailing characters that could be the beginning of a
+split ``<function_calls>`` tag; inside a block it collects the deltas and only
+searches the newly received text (plus a small overlap) for the closing tag.
+Each complete block is emitted once, as soon as it closes, with exactly the
+text ``_extract_xml_chunks`` would have returned for it.
+"""
+
+from typing import List
+
+
+class XMLToolCallScanner:
+    """Resumable scanner emitting complete ``<function_calls>`` blocks."""
+
+    START_TAG = '<function_calls>'
+    END_TAG = '</function_calls>'
+
+    def __init__(self, initial_content: str = ""):
+        """Initialize the scanner.
+
+        Args:
+            initial_content: Text received before this stream (auto-continue),
+                scanned together with the first delta.
+        """
+        self._inside = False
+        # Outside a block: trailing text that may hold a split start tag
+        self._tail = initial_content
+        # Inside a block: received pieces, starting with the start tag
+        self._parts: List[str] = []
+        self._block_length = 0
+        self._overlap = ""
+
+    @property
+    def pending(self) -> str:
+        """Text received but not emitted as part of a complete block yet.
+
+        Outside a block this is only the short tail that may start a tag.
+        """
+        return "".join(self._parts) if self._inside else self._tail
+
+    def feed(self, delta: str) -> List[str]:
+        """Consume a content delta and return the blocks it completed, in order."""
+        chunks = []
+        text = delta
+
+        while text:
+            if not self._inside:
+                text = self._tail + text
+                self._tail = ""
+                start_pos = text.find(self.START_TAG)
+                if start_pos == -1:
+                    # Only the last len(START_TAG) - 1 characters can begin a split tag
+                    self._tail = text[-(len(self.START_TAG) - 1):]
+                    break
+                self._inside = True
+                self._parts = []
+                self._block_length = 0
+                self._overlap = ""
+                text = text[start_pos:]
+
+            window = self._overlap + text
+            end_pos = window.find(self.END_TAG)
+            if end_pos == -1:
+                self._parts.append(text)
+                self._block_length += len(text)
+                self._overlap = window[-(len(self.END_TAG) - 1):]
+                break
+
+            # Offset of the block end, relative to the start of the block
+            block_end = self._block_length - len(self._overlap) + end_pos + len(self.END_TAG)
+            block = "".join(self._parts) + text
+            chunks.append(block[:block_end])
+
+            self._inside = False
+            self._parts = []
+            self._block_length = 0
+            self._overlap = ""
+            text = block[block_end:]
+
+        return chunks
@@ -3,25 +3,65 @@ XML Tool Call Parser Module
 
 This module provides a reliable XML tool call parsing system that supports
 the XML format with structured function_calls blocks.
+
+Content is tokenized by a single-pass lexer instead of regular expressions:
+tag keywords are located with ``str.find`` on a case-folded copy of the
+content, and each tool call keeps the offsets of its raw XML rather than a
+copy of it.
 """
 
 import re
 import xml.etree.ElementTree as ET
-from typing import List, Dict, Any, Optional, Tuple
-from dataclasses import dataclass
+from typing import List, Dict, Any, Optional, Tuple, Iterator
+from dataclasses import dataclass, field
 import json
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Length-preserving case folding of the tag keywords. Besides ASCII letters,
+# these are the characters IGNORECASE matching treats as i, s and k.
+_KEYWORD_FOLD = str.maketrans({
+    **{chr(code): chr(code + 32) for code in range(ord('A'), ord('Z') + 1)},
+    '\u0130': 'i',  # LATIN CAPITAL LETTER I WITH DOT ABOVE
+    '\u0131': 'i',  # LATIN SMALL LETTER DOTLESS I
+    '\u017f': 's',  # LATIN SMALL LETTER LONG S
+    '\u212a': 'k',  # KELVIN SIGN
+})
+
+
+def _fold_keywords(content: str) -> str:
+    """Case-fold content for keyword lookups, keeping every offset unchanged."""
+    if content.isascii():
+        return content.lower()
+    return content.translate(_KEYWORD_FOLD)
+
+
+def _names_match(candidate: str, name: str) -> bool:
+    """Case-insensitive name comparison, as done by IGNORECASE matching."""
+    if candidate == name:
+        return True
+    return len(candidate) == len(name) and re.fullmatch(re.escape(name), candidate, re.IGNORECASE) is not None
+
 
 @dataclass
 class XMLToolCall:
-    """Represents a parsed XML tool call."""
+    """Represents a parsed XML tool call.
+    
+    The raw XML is not copied out of the parsed content; ``raw_span`` holds its
+    start and end offsets in ``source``.
+    """
     function_name: str
     parameters: Dict[str, Any]
-    raw_xml: str
     parsing_details: Dict[str, Any]
+    source: str = field(default="", repr=False)
+    raw_span: Tuple[int, int] = (0, 0)
+    
+    @property
+    def raw_xml(self) -> str:
+        """The raw XML of this invoke block."""
+        start, end = self.raw_span
+        return self.source[start:end]
 
 
 class XMLToolParser:
@@ -34,23 +74,18 @@ class XMLToolParser:
     ...
     </invoke>
     </function_calls>
-    """
-    
-    # Regex patterns for extracting XML blocks
-    FUNCTION_CALLS_PATTERN = re.compile(
-        r'<function_calls>(.*?)</function_calls>',
-        re.DOTALL | re.IGNORECASE
-    )
     
-    INVOKE_PATTERN = re.compile(
-        r'<invoke\s+name=["\']([^"\']+)["\']>(.*?)</invoke>',
-        re.DOTALL | re.IGNORECASE
-    )
+    Tag keywords are case-insensitive. An invoke or parameter ends at the first
+    matching closing tag, and attribute names run up to the first quote.
+    """
     
-    PARAMETER_PATTERN = re.compile(
-        r'<parameter\s+name=["\']([^"\']+)["\']>(.*?)</parameter>',
-        re.DOTALL | re.IGNORECASE
-    )
+    # Tag keywords, lowercase
+    FUNCTION_CALLS_START = '<function_calls>'
+    FUNCTION_CALLS_END = '</function_calls>'
+    INVOKE_START = '<invoke'
+    INVOKE_END = '</invoke>'
+    PARAMETER_START = '<parameter'
+    PARAMETER_END = '</parameter>'
     
     def __init__(self):
         """Initialize the XML tool parser."""
@@ -67,33 +102,162 @@ class XMLToolParser:
             List of parsed XMLToolCall objects
         """
         tool_calls = []
+        folded = _fold_keywords(content)
         
         # Find function_calls blocks
-        function_calls_matches = self.FUNCTION_CALLS_PATTERN.findall(content)
-        
-        for fc_content in function_calls_matches:
-            # Find all invoke blocks within this function_calls block
-            invoke_matches = self.INVOKE_PATTERN.findall(fc_content)
+        for block_start, block_end in self._iter_function_calls_blocks(folded):
+            earlier_names: List[str] = []
+            nested_invoke = False
             
-            for function_name, invoke_content in invoke_matches:
+            # Find all invoke blocks within this function_calls block
+            for tag_start, function_name, body_start, body_end in self._iter_elements(
+                content, folded, block_start, block_end, self.INVOKE_START, self.INVOKE_END
+            ):
                 try:
+                    raw_span = (tag_start, body_end + len(self.INVOKE_END))
+                    # The raw XML is that of the first invoke tag with this name in the
+                    # block, which is only not this one for repeated or nested names
+                    if nested_invoke or any(_names_match(name, function_name) for name in earlier_names):
+                        raw_span = self._find_raw_span(content, folded, block_start, block_end, function_name, raw_span)
+                    
                     tool_call = self._parse_invoke_block(
-                        function_name, 
-                        invoke_content,
-                        fc_content
+                        content,
+                        folded,
+                        function_name,
+                        body_start,
+                        body_end,
+                        raw_span
                     )
                     if tool_call:
                         tool_calls.append(tool_call)
                 except Exception as e:
                     logger.error(f"Error parsing invoke block for {function_name}: {e}")
+                
+                earlier_names.append(function_name)
+                if not nested_invoke:
+                    nested_invoke = folded.find(self.INVOKE_START, tag_start + 1, body_end) != -1
         
         return tool_calls
     
+    def _iter_function_calls_blocks(self, folded: str) -> Iterator[Tuple[int, int]]:
+        """Yield the (start, end) offsets of the contents of each function_calls block."""
+        pos = 0
+        while True:
+            start = folded.find(self.FUNCTION_CALLS_START, pos)
+            if start == -1:
+                return
+            start += len(self.FUNCTION_CALLS_START)
+            end = folded.find(self.FUNCTION_CALLS_END, start)
+            if end == -1:
+                return
+            yield start, end
+            pos = end + len(self.FUNCTION_CALLS_END)
+    
+    def _lex_open_tag(
+        self,
+        content: str,
+        folded: str,
+        pos: int,
+        limit: int,
+        keyword: str
+    ) -> Optional[Tuple[str, int]]:
+        """
+        Lex an opening tag such as ``<invoke name="...">`` at pos.
+        
+        Returns:
+            Tuple of (name, offset after the tag), or None if there is no tag at pos
+        """
+        cursor = pos + len(keyword)
+        while cursor < limit and content[cursor].isspace():
+            cursor += 1
+        if cursor == pos + len(keyword) or not folded.startswith('name=', cursor, limit):
+            return None
+        
+        cursor += len('name=')
+        if cursor >= limit or content[cursor] not in '"\'':
+            return None
+        
+        name_start = cursor + 1
+        double_quote = content.find('"', name_start, limit)
+        single_quote = content.find("'", name_start, limit)
+        if double_quote == -1 or single_quote == -1:
+            name_end = max(double_quote, single_quote)
+        else:
+            name_end = min(double_quote, single_quote)
+        if name_end <= name_start or name_end + 1 >= limit or content[name_end + 1] != '>':
+            return None
+        
+        return content[name_start:name_end], name_end + 2
+    
+    def _iter_elements(
+        self,
+        content: str,
+        folded: str,
+        start: int,
+        end: int,
+        open_keyword: str,
+        close_keyword: str
+    ) -> Iterator[Tuple[int, str, int, int]]:
+        """
+        Yield the named elements found in content[start:end], in order.
+        
+        Yields:
+            Tuples of (tag start, name, body start, body end)
+        """
+        pos = start
+        # No closing tag exists at or after this offset
+        no_close_from = end
+        while True:
+            tag_start = folded.find(open_keyword, pos, end)
+            if tag_start == -1:
+                return
+            
+            tag = self._lex_open_tag(content, folded, tag_start, end, open_keyword)
+            if tag is not None:
+                name, body_start = tag
+                body_end = -1
+                if body_start < no_close_from:
+                    body_end = folded.find(close_keyword, body_start, end)
+                    if body_end == -1:
+                        no_close_from = body_start
+                if body_end != -1:
+                    yield tag_start, name, body_start, body_end
+                    pos = body_end + len(close_keyword)
+                    continue
+            
+            pos = tag_start + 1
+    
+    def _find_raw_span(
+        self,
+        content: str,
+        folded: str,
+        block_start: int,
+        block_end: int,
+        function_name: str,
+        own_span: Tuple[int, int]
+    ) -> Tuple[int, int]:
+        """Find the span of the first invoke tag named function_name in the block."""
+        pos = block_start
+        while True:
+            tag_start = folded.find(self.INVOKE_START, pos, own_span[0])
+            if tag_start == -1:
+                return own_span
+            
+            tag = self._lex_open_tag(content, folded, tag_start, block_end, self.INVOKE_START)
+            if tag is not None and _names_match(tag[0], function_name):
+                body_end = folded.find(self.INVOKE_END, tag[1], block_end)
+                if body_end != -1:
+                    return tag_start, body_end + len(self.INVOKE_END)
+            pos = tag_start + 1
+    
     def _parse_invoke_block(
         self, 
+        content: str,
+        folded: str,
         function_name: str, 
-        invoke_content: str,
-        full_block: str
+        body_start: int,
+        body_end: int,
+        raw_span: Tuple[int, int]
     ) -> Optional[XMLToolCall]:
         """Parse a single invoke block into an XMLToolCall."""
         parameters = {}
@@ -103,11 +267,11 @@ class XMLToolParser:
         }
         
         # Extract all parameters
-        param_matches = self.PARAMETER_PATTERN.findall(invoke_content)
-        
-        for param_name, param_value in param_matches:
+        for _, param_name, value_start, value_end in self._iter_elements(
+            content, folded, body_start, body_end, self.PARAMETER_START, self.PARAMETER_END
+        ):
             # Clean up the parameter value
-            param_value = param_value.strip()
+            param_value = content[value_start:value_end].strip()
             
             # Try to parse as JSON if it looks like JSON
             parsed_value = self._parse_parameter_value(param_value)
@@ -115,19 +279,12 @@ class XMLToolParser:
             parameters[param_name] = parsed_value
             parsing_details["raw_parameters"][param_name] = param_value
         
-        # Extract the raw XML for this specific invoke
-        invoke_pattern = re.compile(
-            rf'<invoke\s+name=["\']{re.escape(function_name)}["\']>.*?</invoke>',
-            re.DOTALL | re.IGNORECASE
-        )
-        raw_xml_match = invoke_pattern.search(full_block)
-        raw_xml = raw_xml_match.group(0) if raw_xml_match else f"<invoke name=\"{function_name}\">...</invoke>"
-        
         return XMLToolCall(
             function_name=function_name,
             parameters=parameters,
-            raw_xml=raw_xml,
-            parsing_details=parsing_details
+            parsing_details=parsing_details,
+            source=content,
+            raw_span=raw_span
         )
     
     def _parse_parameter_value(self, value: str) -> Any:
@@ -142,8 +299,8 @@ class XMLToolParser:
         """
         value = value.strip()
         
-        # Try to parse as JSON first
-        if value.startswith(('{', '[')):
+        # Try to parse as JSON first, only if it is bracketed on both ends
+        if value.startswith(('{', '[')) and value.endswith(('}', ']')):
             try:
                 return json.loads(value)
             except json.JSONDecodeError:
@@ -4,7 +4,7 @@ load_dotenv()
 from fastapi import FastAPI, Request, HTTPException, Response, Depends, APIRouter
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, StreamingResponse
-from services import redis
+from services import redis, run_registry, run_dispatcher, usage_counters, usage_ledger
 import sentry
 from contextlib import asynccontextmanager
 from agentpress.thread_manager import ThreadManager
@@ -18,6 +18,8 @@ from collections import OrderedDict
 
 from pydantic import BaseModel
 import uuid
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from utils.auth_utils import verify_admin_api_key
 
 from agent import api as agent_api
 from agent.config_helper import initialize_tool_db_connection
@@ -69,6 +71,10 @@ async def lifespan(app: FastAPI):
         
         # Start background tasks
         # asyncio.create_task(agent_api.restore_running_agent_runs())
+        reaper = asyncio.create_task(run_registry.reap_loop())
+        dispatcher = asyncio.create_task(run_dispatcher.dispatch_loop())
+        usage_reconciler = asyncio.create_task(usage_counters.reconcile_loop())
+        usage_reclaimer = asyncio.create_task(usage_ledger.reclaim_loop())
         
         triggers_api.initialize(db)
         pipedream_api.initialize(db)
@@ -78,6 +84,11 @@ async def lifespan(app: FastAPI):
         
         yield
         
+        reaper.cancel()
+        dispatcher.cancel()
+        usage_reconciler.cancel()
+        usage_reclaimer.cancel()
+
         # Clean up agent resources
         logger.debug("Cleaning up agent resources")
         await agent_api.cleanup()
@@ -207,6 +218,11 @@ async def health_check():
         "instance_id": instance_id
     }
 
+@api_router.get("/metrics")
+async def metrics(_: bool = Depends(verify_admin_api_key)):
+    """Prometheus metrics of this process (cache lookups, ...), scraped with the admin API key."""
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 @api_router.get("/health-docker")
 async def health_check():
     logger.debug("Health docker check endpoint called")
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Simulation of LLM calls against a rate limited provider (services/llm_governor.py).
+
+A fake provider stands in for litellm.acompletion. It admits requests within
+its own requests/min and input tokens/min and answers the others with a rate
+limit error, which the stand-in retries up to MAX_RETRIES times with a short
+backoff, as LiteLLM does. Concurrent agent runs each make LLM calls through
+make_llm_api_call for a fixed time, once without the governor and once with
+it. The benchmark reports the calls that succeeded and failed, the rate limit
+errors the provider returned, and the latency of the calls.
+
+The governor keeps its buckets under llm_governor:* in Redis: run against a
+scratch Redis server (REDIS_HOST / REDIS_PORT / REDIS_PASSWORD), or with
+--fake to use fakeredis if it is installed.
+
+Usage: python benchmark_llm_governor.py [--fake] [runs] [seconds]
+"""
+
+import sys
+import os
+import time
+import random
+import asyncio
+import statistics
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+# Every rate limited call is logged, keep the report readable
+os.environ.setdefault("LOGGING_LEVEL", "CRITICAL")
+
+import litellm
+
+from services import redis, llm, llm_governor
+from utils.config import config
+
+MODEL = "anthropic/claude-sonnet-4-20250514"
+PROVIDER_RPM = 600
+PROVIDER_TPM = 400_000
+PROVIDER_LATENCY = 0.3
+RETRY_BACKOFF = 0.5
+# Size of the calls of the runs, in words of about a token
+CALL_WORDS = (500, 3000)
+
+
+class FakeProvider:
+    """Stand-in for litellm.acompletion, rate limited like a provider API key."""
+
+    def __init__(self, rpm: int, tpm: int):
+        self.limits = {"requests": rpm, "tokens": tpm}
+        self.levels = dict(self.limits)
+        self.updated = time.monotonic()
+        self.rate_limited = 0
+
+    def _admit(self, tokens: int) -> bool:
+        now = time.monotonic()
+        for field, limit in self.limits.items():
+            self.levels[field] = min(limit, self.levels[field] + (now - self.updated) * limit / 60)
+        self.updated = now
+        if self.levels["requests"] < 1 or self.levels["tokens"] < tokens:
+            self.rate_limited += 1
+            return False
+        self.levels["requests"] -= 1
+        self.levels["tokens"] -= tokens
+        return True
+
+    async def acompletion(self, **params):
+        tokens = len(params["messages"][0]["content"][0]["text"].split())
+        for attempt in range(params.get("num_retries", 0) + 1):
+            if attempt:
+                await asyncio.sleep(RETRY_BACKOFF * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+            if self._admit(tokens):
+                await asyncio.sleep(PROVIDER_LATENCY)
+                return {"model": params["model"]}
+        raise litellm.exceptions.RateLimitError(message="Rate limit exceeded", llm_provider="anthropic", model=params["model"])
+
+
+async def simulate(name: str, runs: int, seconds: float):
+    provider = FakeProvider(PROVIDER_RPM, PROVIDER_TPM)
+    llm.litellm.acompletion = provider.acompletion
+    rng = random.Random(3)
+    latencies = []
+    failed = 0
+    deadline = time.monotonic() + seconds
+
+    async def run():
+        nonlocal failed
+        while time.monotonic() < deadline:
+            messages = [{"role": "user", "content": "word " * rng.randint(*CALL_WORDS)}]
+            started = time.monotonic()
+            try:
+                await llm.make_llm_api_call(messages, MODEL)
+                latencies.append(time.monotonic() - started)
+            except llm.LLMError:
+                failed += 1
+                await asyncio.sleep(1)
+
+    await asyncio.gather(*[run() for _ in range(runs)])
+    latencies.sort()
+    print(
+        f"{name:>14}: {len(latencies):5} calls ok, {failed:4} failed, {provider.rate_limited:5} rate limit errors"
+        f" | latency p50 {statistics.median(latencies):5.2f}s p99 {latencies[int(len(latencies) * 0.99)]:5.2f}s"
+    )
+
+
+async def run_benchmark(runs: int, seconds: float):
+    await redis.initialize_async()
+    redis_client = await redis.get_client()
+    # Without a fallback, calls only wait for capacity
+    llm.get_openrouter_fallback = lambda model_name: None
+
+    print(f"{runs} runs for {seconds:.0f}s against a provider limited to {PROVIDER_RPM} requests and {PROVIDER_TPM} tokens per minute")
+    config.LLM_RATE_LIMITS = {}
+    await simulate("no governor", runs, seconds)
+    config.LLM_RATE_LIMITS = {"anthropic": {"rpm": PROVIDER_RPM, "tpm": PROVIDER_TPM}}
+    await simulate("governor", runs, seconds)
+
+    stale = [key async for key in redis_client.scan_iter(match=f"{llm_governor.GOVERNOR_PREFIX}*")]
+    if stale:
+        await redis_client.delete(*stale)
+    await redis.close()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args and args[0] == "--fake":
+        import fakeredis
+        args = args[1:]
+        redis.client = fakeredis.FakeAsyncRedis(decode_responses=True)
+        redis._initialized = True
+    runs = int(args[0]) if len(args) > 0 else 64
+    seconds = float(args[1]) if len(args) > 1 else 20
+    asyncio.run(run_benchmark(runs, seconds))
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the agent run response transports (services/response_transport.py).
+
+Simulates agent runs writing responses while viewers follow them, once per
+transport with and without compression (services/response_compression.py),
+against the Redis server configured in the environment (REDIS_HOST /
+REDIS_PORT / REDIS_PASSWORD). Reports the notification latency seen by
+viewers (write to delivery), the Redis CPU time and number of commands used
+per run, as reported by INFO, and the memory taken by the stored responses
+of a run (MEMORY USAGE).
+
+Usage: python benchmark_response_transport.py [runs] [viewers_per_run] [responses_per_run]
+"""
+
+import sys
+import os
+import time
+import json
+import random
+import asyncio
+import statistics
+import uuid
+from datetime import datetime, timezone
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from services import redis
+from services.response_transport import (
+    ListResponseTransport, StreamResponseTransport, TransportEvent,
+    response_list_key, response_stream_key
+)
+from services.response_compression import ResponseCompressor
+from services.response_writer import ResponseWriter
+
+RESPONSE_INTERVAL = 0.005
+WORDS = (
+    "the agent will now create a file with the requested content and then run the tests to "
+    "verify that everything works as expected before reporting back to the user"
+).split()
+
+
+async def redis_usage():
+    redis_client = await redis.get_client()
+    cpu = await redis_client.info("cpu")
+    stats = await redis_client.info("stats")
+    return cpu["used_cpu_sys"] + cpu["used_cpu_user"], stats["total_commands_processed"]
+
+
+def make_response(thread_id: str, thread_run_id: str, sequence: int) -> dict:
+    """A coalesced assistant content chunk, as written by run_agent_background."""
+    now = datetime.now(timezone.utc).isoformat()
+    text = " ".join(random.choices(WORDS, k=random.randint(5, 40)))
+    return {
+        "sequence": sequence, "message_id": None, "thread_id": thread_id, "type": "assistant",
+        "is_llm_message": True,
+        "content": json.dumps({"role": "assistant", "content": text}),
+        "metadata": json.dumps({"stream_status": "chunk", "thread_run_id": thread_run_id}),
+        "created_at": now, "updated_at": now,
+    }
+
+
+async def stored_size(transport, agent_run_id: str) -> int:
+    redis_client = await redis.get_client()
+    key = response_list_key(agent_run_id) if transport.name == "list" else response_stream_key(agent_run_id)
+    return await redis_client.memory_usage(key, samples=0) or 0
+
+
+async def simulate_run(transport, compressor, agent_run_id: str, viewers: int, responses: int, latencies, sizes):
+    async def viewer():
+        async for event in transport.listen(agent_run_id):
+            if event.kind == TransportEvent.CONTROL:
+                return
+            latencies.append(time.perf_counter() - json.loads(event.data)["sent_at"])
+
+    viewer_tasks = [asyncio.create_task(viewer()) for _ in range(viewers)]
+    # Let the viewers subscribe before the run starts
+    await asyncio.sleep(0.2)
+
+    writer = ResponseWriter(agent_run_id, transport, compressor)
+    thread_id, thread_run_id = str(uuid.uuid4()), str(uuid.uuid4())
+    for index in range(responses):
+        response = make_response(thread_id, thread_run_id, index)
+        response["sent_at"] = time.perf_counter()
+        await writer.write(json.dumps(response))
+        await asyncio.sleep(RESPONSE_INTERVAL)
+
+    await writer.flush()
+    await transport.signal(agent_run_id, "END_STREAM")
+    await asyncio.gather(*viewer_tasks)
+    sizes.append((writer.raw_bytes, writer.stored_bytes, await stored_size(transport, agent_run_id)))
+    await transport.delete(agent_run_id)
+
+
+async def run_benchmark(runs: int, viewers: int, responses: int):
+    print(f"=== {runs} runs x {viewers} viewers x {responses} responses ===")
+    for transport in (ListResponseTransport(), StreamResponseTransport()):
+        uncompressed_memory = None
+        for compressed in (False, True):
+            latencies, sizes = [], []
+            cpu_before, commands_before = await redis_usage()
+            start = time.perf_counter()
+            await asyncio.gather(*[
+                simulate_run(
+                    transport, ResponseCompressor() if compressed else None,
+                    f"benchmark-{transport.name}-{index}", viewers, responses, latencies, sizes
+                )
+                for index in range(runs)
+            ])
+            elapsed = time.perf_counter() - start
+            cpu_after, commands_after = await redis_usage()
+
+            latencies.sort()
+            p99 = latencies[int(len(latencies) * 0.99) - 1] if latencies else 0
+            raw_bytes = sum(size[0] for size in sizes) / runs
+            stored_bytes = sum(size[1] for size in sizes) / runs
+            memory = sum(size[2] for size in sizes) / runs
+            if uncompressed_memory is None:
+                uncompressed_memory = memory
+            saved = f"saved {(uncompressed_memory - memory) / 1024:8.1f} KB/run" if compressed else ""
+            label = f"{transport.name}{'+zstd' if compressed else ''}"
+            print(
+                f"{label:>11} | latency p50 {statistics.median(latencies) * 1000:7.2f} ms"
+                f" p99 {p99 * 1000:7.2f} ms | redis cpu {(cpu_after - cpu_before) / runs * 1000:8.2f} ms/run"
+                f" | {(commands_after - commands_before) / runs:9.0f} commands/run | {elapsed:6.2f}s"
+                f" | payloads {raw_bytes / 1024:8.1f} KB stored as {stored_bytes / 1024:8.1f} KB"
+                f" | memory {memory / 1024:8.1f} KB/run {saved}"
+            )
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    runs, viewers, responses = (args + [20, 3, 500][len(args):])[:3]
+    asyncio.run(run_benchmark(runs, viewers, responses))
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Simulation of agent run scheduling under mixed load (services/run_dispatcher.py).
+
+Simulated workers with a fixed number of slots run agent runs of random
+duration, submitted by:
+- one account flooding the triggered lane
+- a few accounts submitting batch runs with API keys
+- many interactive users starting runs at random times
+
+The same load goes once through a single FIFO queue, as when every run was
+sent straight to Dramatiq, and once through the dispatcher. The benchmark
+reports the time runs waited for a worker per lane (p50 / p95 / p99 / max).
+
+The dispatcher keeps its state under agent_run_queue:* in Redis and the
+benchmark deletes those keys before and after it runs. Run it with --fake to
+use fakeredis, or with --scratch-db to use an empty database of the Redis
+server in REDIS_HOST / REDIS_PORT / REDIS_PASSWORD (not database 0).
+
+Usage: python benchmark_run_dispatcher.py (--fake | --scratch-db N) [worker_slots] [interactive_runs]
+"""
+
+import sys
+import os
+import time
+import random
+import asyncio
+import statistics
+import uuid
+from collections import defaultdict
+from typing import Optional
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from services import redis, run_dispatcher
+from utils.config import config
+
+MEAN_RUN_SECONDS = 0.2
+FLOOD_RUNS = 400
+BATCH_ACCOUNTS = 4
+BATCH_RUNS = 50
+INTERACTIVE_ACCOUNTS = 40
+# Seconds over which interactive runs are started
+INTERACTIVE_PERIOD = 8.0
+CAPS = {"interactive": 2, "triggered": 10, "batch": 5}
+
+
+def make_load(interactive_runs: int):
+    """(delay, lane, account, run id) of every run, in submission order."""
+    rng = random.Random(7)
+    load = [(0.0, "triggered", "flood", str(uuid.uuid4())) for _ in range(FLOOD_RUNS)]
+    for i in range(BATCH_ACCOUNTS):
+        load += [(rng.uniform(0, 1), "batch", f"batch-{i}", str(uuid.uuid4())) for _ in range(BATCH_RUNS)]
+    load += [
+        (rng.uniform(0, INTERACTIVE_PERIOD), "interactive", f"user-{rng.randrange(INTERACTIVE_ACCOUNTS)}", str(uuid.uuid4()))
+        for _ in range(interactive_runs)
+    ]
+    durations = {run_id: rng.expovariate(1 / MEAN_RUN_SECONDS) for _, _, _, run_id in load}
+    return sorted(load), durations
+
+
+def report(name: str, waits):
+    print(name)
+    for lane in run_dispatcher.LANES:
+        lane_waits = sorted(waits[lane])
+        if not lane_waits:
+            continue
+        pct = lambda p: lane_waits[min(len(lane_waits) - 1, int(len(lane_waits) * p))]
+        print(
+            f"  {lane:>11}: {len(lane_waits):4} runs | wait p50 {statistics.median(lane_waits):6.2f}s"
+            f" p95 {pct(0.95):6.2f}s p99 {pct(0.99):6.2f}s max {lane_waits[-1]:6.2f}s"
+        )
+
+
+async def submit_load(load, submit):
+    started = time.monotonic()
+    submitted = {}
+    for delay, lane, account_id, run_id in load:
+        await asyncio.sleep(max(0.0, started + delay - time.monotonic()))
+        submitted[run_id] = (time.monotonic(), lane)
+        await submit(lane, account_id, run_id)
+    return submitted
+
+
+async def simulate_fifo(load, durations, slots: int):
+    queue = asyncio.Queue()
+    waits = defaultdict(list)
+    submitted = {}
+
+    async def worker():
+        while True:
+            run_id = await queue.get()
+            submitted_at, lane = submitted[run_id]
+            waits[lane].append(time.monotonic() - submitted_at)
+            await asyncio.sleep(durations[run_id])
+            queue.task_done()
+
+    async def submit(lane, account_id, run_id):
+        submitted[run_id] = (time.monotonic(), lane)
+        queue.put_nowait(run_id)
+
+    workers = [asyncio.create_task(worker()) for _ in range(slots)]
+    await submit_load(load, submit)
+    await queue.join()
+    for task in workers:
+        task.cancel()
+    return waits
+
+
+async def simulate_dispatcher(load, durations, slots: int):
+    waits = defaultdict(list)
+    submitted = {}
+    running = set()
+
+    async def run(run_kwargs):
+        run_id = run_kwargs["agent_run_id"]
+        submitted_at, lane = submitted[run_id]
+        waits[lane].append(time.monotonic() - submitted_at)
+        await asyncio.sleep(durations[run_id])
+        await run_dispatcher.release(run_id)
+
+    def send(run_kwargs):
+        task = asyncio.create_task(run(run_kwargs))
+        running.add(task)
+        task.add_done_callback(running.discard)
+
+    async def submit(lane, account_id, run_id):
+        submitted[run_id] = (time.monotonic(), lane)
+        await run_dispatcher.submit(account_id, lane, CAPS[lane], agent_run_id=run_id)
+
+    run_dispatcher._send_run = send
+    config.AGENT_RUN_DISPATCH_CAPACITY = slots
+    await submit_load(load, submit)
+    while running or sum(len(w) for w in waits.values()) < len(load):
+        await asyncio.sleep(0.05)
+    return waits
+
+
+async def use_scratch_db(db: int):
+    """Point the Redis client at a database that holds nothing but dispatcher state."""
+    if db == 0:
+        sys.exit("Database 0 is where the backend keeps its data, pick another one")
+    import redis.asyncio as redis_asyncio
+    redis.client = redis_asyncio.Redis(
+        host=os.getenv("REDIS_HOST", "redis"),
+        port=int(os.getenv("REDIS_PORT", 6379)),
+        password=os.getenv("REDIS_PASSWORD", ""),
+        db=db,
+        decode_responses=True,
+    )
+    redis._initialized = True
+    async for key in redis.client.scan_iter():
+        if not key.startswith(run_dispatcher.QUEUE_PREFIX):
+            sys.exit(f"Redis database {db} is not empty ({key}), pick a scratch database")
+
+
+async def run_benchmark(slots: int, interactive_runs: int, scratch_db: Optional[int]):
+    if scratch_db is not None:
+        await use_scratch_db(scratch_db)
+    redis_client = await redis.get_client()
+    stale = [key async for key in redis_client.scan_iter(match=f"{run_dispatcher.QUEUE_PREFIX}*")]
+    if stale:
+        await redis_client.delete(*stale)
+
+    load, durations = make_load(interactive_runs)
+    total_work = sum(durations.values())
+    print(f"{len(load)} runs, {total_work:.1f}s of work on {slots} worker slots (~{total_work / slots:.1f}s)")
+    report("FIFO queue", await simulate_fifo(load, durations, slots))
+    report("Dispatcher", await simulate_dispatcher(load, durations, slots))
+    print(f"Dispatcher state after the run: {await run_dispatcher.get_stats()}")
+
+    stale = [key async for key in redis_client.scan_iter(match=f"{run_dispatcher.QUEUE_PREFIX}*")]
+    if stale:
+        await redis_client.delete(*stale)
+    await redis.close()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    scratch_db = None
+    if args and args[0] == "--fake":
+        import fakeredis
+        args = args[1:]
+        redis.client = fakeredis.FakeAsyncRedis(decode_responses=True)
+        redis._initialized = True
+    elif len(args) > 1 and args[0] == "--scratch-db":
+        scratch_db = int(args[1])
+        args = args[2:]
+    else:
+        sys.exit(__doc__)
+    slots = int(args[0]) if len(args) > 0 else 16
+    interactive_runs = int(args[1]) if len(args) > 1 else 150
+    asyncio.run(run_benchmark(slots, interactive_runs, scratch_db))
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Load test of the active agent run registry (services/run_registry.py).
+
+Fills the Redis server configured in the environment (REDIS_HOST / REDIS_PORT
+/ REDIS_PASSWORD) with unrelated keys, then stops and cleans up agent runs
+while a probe measures the latency of PING, once by finding runs with KEYS
+as before the registry, and once through the registry. KEYS blocks Redis
+for every client while it walks the keyspace; registry lookups should leave
+the probe latency flat. All keys written are deleted at the end.
+
+Usage: python benchmark_run_registry.py [unrelated_keys] [instances] [runs_per_instance]
+"""
+
+import sys
+import os
+import time
+import asyncio
+import statistics
+import uuid
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from services import redis, run_registry
+
+FILL_BATCH = 10_000
+PROBE_INTERVAL = 0.002
+
+
+async def fill(prefix: str, count: int):
+    redis_client = await redis.get_client()
+    for start in range(0, count, FILL_BATCH):
+        await redis_client.mset({f"{prefix}{i}": "x" for i in range(start, min(start + FILL_BATCH, count))})
+
+
+async def delete_prefix(prefix: str):
+    redis_client = await redis.get_client()
+    batch = []
+    async for key in redis_client.scan_iter(match=f"{prefix}*", count=FILL_BATCH):
+        batch.append(key)
+        if len(batch) >= FILL_BATCH:
+            await redis_client.unlink(*batch)
+            batch = []
+    if batch:
+        await redis_client.unlink(*batch)
+
+
+async def probe(latencies: list, stop: asyncio.Event):
+    redis_client = await redis.get_client()
+    while not stop.is_set():
+        start = time.perf_counter()
+        await redis_client.ping()
+        latencies.append((time.perf_counter() - start) * 1000)
+        await asyncio.sleep(PROBE_INTERVAL)
+
+
+async def with_keys(prefix: str, instances, runs):
+    """Stop each run, then clean up each instance, finding them with KEYS."""
+    redis_client = await redis.get_client()
+    for agent_run_id in runs:
+        await redis_client.keys(f"{prefix}active_run:*:{agent_run_id}")
+    for instance_id in instances:
+        await redis_client.keys(f"{prefix}active_run:{instance_id}:*")
+
+
+async def with_registry(prefix: str, instances, runs):
+    """Stop each run, then clean up each instance, through the registry."""
+    for agent_run_id in runs:
+        await run_registry.get_run_instance(agent_run_id)
+    for instance_id in instances:
+        await run_registry.get_instance_runs(instance_id)
+
+
+async def measure(name: str, lookups, *args):
+    latencies = []
+    stop = asyncio.Event()
+    prober = asyncio.create_task(probe(latencies, stop))
+    await asyncio.sleep(0.5)
+    start = time.perf_counter()
+    await lookups(*args)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await prober
+
+    latencies.sort()
+    print(
+        f"{name:>9}: lookups {elapsed:7.2f}s | PING p50 {statistics.median(latencies):6.2f} ms"
+        f" p99 {latencies[int(len(latencies) * 0.99)]:7.2f} ms max {latencies[-1]:7.2f} ms"
+    )
+
+
+async def run_benchmark(unrelated_keys: int, instance_count: int, runs_per_instance: int):
+    await redis.initialize_async()
+    prefix = f"benchmark:registry:{uuid.uuid4().hex[:8]}:"
+    instances = [f"{prefix}{uuid.uuid4().hex[:8]}" for _ in range(instance_count)]
+    runs = {instance_id: [str(uuid.uuid4()) for _ in range(runs_per_instance)] for instance_id in instances}
+    all_runs = [agent_run_id for instance_runs in runs.values() for agent_run_id in instance_runs]
+
+    print(f"Writing {unrelated_keys} unrelated keys...")
+    await fill(prefix, unrelated_keys)
+    redis_client = await redis.get_client()
+    try:
+        print(f"Registering {len(all_runs)} runs on {instance_count} instances, both ways...")
+        for instance_id, instance_runs in runs.items():
+            await redis_client.mset({f"{prefix}active_run:{instance_id}:{r}": "running" for r in instance_runs})
+            for agent_run_id in instance_runs:
+                await run_registry.register_run(instance_id, agent_run_id, ttl=600)
+        print(f"Keyspace: {await redis_client.dbsize()} keys")
+
+        await measure("KEYS", with_keys, prefix, instances, all_runs)
+        await measure("registry", with_registry, prefix, instances, all_runs)
+    finally:
+        for instance_id, instance_runs in runs.items():
+            for agent_run_id in instance_runs:
+                await run_registry.unregister_run(instance_id, agent_run_id)
+        await redis_client.zrem(run_registry.RUN_REGISTRY_INSTANCES_KEY, *instances)
+        await delete_prefix(prefix)
+        await redis.close()
+
+
+if __name__ == "__main__":
+    unrelated_keys = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    instance_count = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    runs_per_instance = int(sys.argv[3]) if len(sys.argv) > 3 else 25
+    asyncio.run(run_benchmark(unrelated_keys, instance_count, runs_per_instance))
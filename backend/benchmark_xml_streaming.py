@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Benchmark of XML tool call detection on streamed responses.
+
+Compares the previous streaming path (append every delta to a buffer, re-scan
+it with ``ResponseProcessor._extract_xml_chunks`` and cut found blocks out with
+``str.replace``) against the incremental ``XMLToolCallScanner``, on generated
+multi-megabyte responses, and checks that both emit the same blocks.
+
+Usage: python benchmark_xml_streaming.py [size_mb ...]
+"""
+
+import sys
+import os
+import time
+import random
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from agentpress.tool_registry import ToolRegistry
+from agentpress.response_processor import ResponseProcessor
+from agentpress.xml_stream_scanner import XMLToolCallScanner
+
+DELTA_SIZE = 24
+
+
+def generate_response(size_bytes: int, seed: int = 42) -> str:
+    """Generate prose interleaved with tool calls, some with large payloads."""
+    rng = random.Random(seed)
+    words = ["agent", "file", "search", "result", "the", "update", "<b>", "data", "</", "function", "<"]
+    parts = []
+    length = 0
+    index = 0
+    while length < size_bytes:
+        prose = " ".join(rng.choice(words) for _ in range(rng.randint(50, 400)))
+        payload = "x" * rng.choice([10, 1_000, 50_000])
+        block = (
+            "<function_calls>\n"
+            f"<invoke name=\"create_file\">\n"
+            f"<parameter name=\"file_path\">file_{index}.txt</parameter>\n"
+            f"<parameter name=\"file_contents\">{payload}</parameter>\n"
+            "</invoke>\n"
+            "</function_calls>"
+        )
+        parts.extend([prose, block])
+        length += len(prose) + len(block)
+        index += 1
+    return "".join(parts)
+
+
+def split_deltas(content: str, size: int = DELTA_SIZE):
+    return [content[i:i + size] for i in range(0, len(content), size)]
+
+
+def run_previous(processor: ResponseProcessor, deltas):
+    chunks = []
+    current_xml_content = ""
+    for delta in deltas:
+        current_xml_content += delta
+        for xml_chunk in processor._extract_xml_chunks(current_xml_content):
+            current_xml_content = current_xml_content.replace(xml_chunk, "", 1)
+            chunks.append(xml_chunk)
+    return chunks
+
+
+def run_scanner(deltas):
+    chunks = []
+    scanner = XMLToolCallScanner()
+    for delta in deltas:
+        chunks.extend(scanner.feed(delta))
+    return chunks
+
+
+def run_benchmark(sizes_mb):
+    processor = ResponseProcessor(tool_registry=ToolRegistry(), add_message_callback=None)
+
+    print(f"=== XML tool call detection, {DELTA_SIZE}-char deltas ===")
+    for size_mb in sizes_mb:
+        content = generate_response(int(size_mb * 1024 * 1024))
+        deltas = split_deltas(content)
+
+        start = time.perf_counter()
+        previous_chunks = run_previous(processor, deltas)
+        previous_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        scanner_chunks = run_scanner(deltas)
+        scanner_time = time.perf_counter() - start
+
+        status = "OK" if previous_chunks == scanner_chunks else "MISMATCH"
+        print(
+            f"{size_mb:>5} MB | {len(deltas):>7} deltas | {len(scanner_chunks):>4} blocks | "
+            f"previous {previous_time:8.3f}s | scanner {scanner_time:8.3f}s | "
+            f"{previous_time / max(scanner_time, 1e-9):8.1f}x | {status}"
+        )
+
+
+if __name__ == "__main__":
+    sizes = [float(arg) for arg in sys.argv[1:]] or [0.5, 1, 2, 4]
+    run_benchmark(sizes)
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import logging
 import os
@@ -7,15 +8,114 @@ import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from services import redis
+from services.redis_multiplexer import get_pubsub_multiplexer
 
 logger = logging.getLogger(__name__)
 
+# Published with the new version whenever a flag is set or deleted
+FLAG_CHANGES_CHANNEL = "feature_flags:changes"
+# Seconds between reloads of the flags without a change published, in case one
+# was missed or the flags were written without bumping the version
+FLAG_RECONCILE_INTERVAL = 60
+# Seconds before subscribing again to changes after a failure
+FLAG_RETRY_DELAY = 5
+
+
 class FeatureFlagManager:
     def __init__(self):
-        """Initialize with existing Redis service"""
+        """Initialize with existing Redis service
+
+        Flags are read from an in-process snapshot of all of them. The snapshot
+        is reloaded when a change is published on FLAG_CHANGES_CHANNEL, and
+        every FLAG_RECONCILE_INTERVAL seconds without one.
+        """
         self.flag_prefix = "feature_flag:"
         self.flag_list_key = "feature_flags:list"
-    
+        self.flag_version_key = "feature_flags:version"
+        self._snapshot: Optional[Dict[str, Dict[str, str]]] = None
+        self._version = -1
+        self._loading: Optional[asyncio.Future] = None
+        self._sync_task: Optional[asyncio.Task] = None
+        self._sync_loop = None
+
+    async def _load(self, force: bool = False):
+        """Load all flags with two round trips and swap in the snapshot.
+
+        Unless forced, a snapshot older than the one in use is discarded.
+        """
+        redis_client = await redis.get_client()
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.get(self.flag_version_key)
+            pipe.smembers(self.flag_list_key)
+            version, keys = await pipe.execute()
+        keys = sorted(keys)
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.hgetall(f"{self.flag_prefix}{key}")
+            details = await pipe.execute()
+
+        version = int(version or 0)
+        # A concurrent load may have swapped in a newer snapshot
+        if force or version >= self._version:
+            self._snapshot = {key: data for key, data in zip(keys, details) if data}
+            self._version = version
+            logger.debug(f"Loaded {len(self._snapshot)} feature flags, version {version}")
+
+    async def reload(self, force: bool = False):
+        """Reload the snapshot, sharing the load with concurrent callers."""
+        if self._loading is None or self._loading.done():
+            self._loading = asyncio.ensure_future(self._load(force))
+        await asyncio.shield(self._loading)
+
+    async def _get_snapshot(self) -> Dict[str, Dict[str, str]]:
+        loop = asyncio.get_running_loop()
+        if self._sync_task is None or self._sync_task.done() or self._sync_loop is not loop:
+            self._sync_loop = loop
+            self._sync_task = asyncio.create_task(self._sync())
+        if self._snapshot is None:
+            await self.reload()
+        return self._snapshot
+
+    async def _sync(self):
+        while True:
+            subscription = None
+            try:
+                subscription = await get_pubsub_multiplexer().subscribe(FLAG_CHANGES_CHANNEL)
+                # Changes may have been missed while not subscribed
+                await self.reload()
+                while True:
+                    try:
+                        _, version = await asyncio.wait_for(subscription.get(), timeout=FLAG_RECONCILE_INTERVAL)
+                    except asyncio.TimeoutError:
+                        # Flags written directly, e.g. by enable_all_flags.py, do not bump the
+                        # version, and the version starts over if Redis loses its data
+                        await self.reload(force=True)
+                        continue
+                    # No version: changes may have been missed
+                    if version is None or int(version) > self._version:
+                        await self.reload()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Feature flag sync failed, serving the last loaded flags: {e}")
+            finally:
+                if subscription is not None:
+                    try:
+                        await subscription.close()
+                    except Exception:
+                        pass
+            await asyncio.sleep(FLAG_RETRY_DELAY)
+
+    async def _publish_change(self, pipe):
+        """Bump the flags version and notify every process, after the queued changes."""
+        pipe.incr(self.flag_version_key)
+        results = await pipe.execute()
+        redis_client = await redis.get_client()
+        await redis_client.publish(FLAG_CHANGES_CHANNEL, results[-1])
+        # Read your own writes without waiting for the notification
+        await self.reload()
+        return results
+
     async def set_flag(self, key: str, enabled: bool, description: str = "") -> bool:
         """Set a feature flag to enabled or disabled"""
         try:
@@ -28,8 +128,10 @@ class FeatureFlagManager:
             
             # Use the existing Redis service
             redis_client = await redis.get_client()
-            await redis_client.hset(flag_key, mapping=flag_data)
-            await redis_client.sadd(self.flag_list_key, key)
+            async with redis_client.pipeline(transaction=True) as pipe:
+                pipe.hset(flag_key, mapping=flag_data)
+                pipe.sadd(self.flag_list_key, key)
+                await self._publish_change(pipe)
             
             logger.debug(f"Set feature flag {key} to {enabled}")
             return True
@@ -40,10 +142,8 @@ class FeatureFlagManager:
     async def is_enabled(self, key: str) -> bool:
         """Check if a feature flag is enabled"""
         try:
-            flag_key = f"{self.flag_prefix}{key}"
-            redis_client = await redis.get_client()
-            enabled = await redis_client.hget(flag_key, 'enabled')
-            return enabled == 'true' if enabled else False
+            flag = (await self._get_snapshot()).get(key)
+            return flag is not None and flag.get('enabled') == 'true'
         except Exception as e:
             logger.error(f"Failed to check feature flag {key}: {e}")
             # Return False by default if Redis is unavailable
@@ -52,10 +152,8 @@ class FeatureFlagManager:
     async def get_flag(self, key: str) -> Optional[Dict[str, str]]:
         """Get feature flag details"""
         try:
-            flag_key = f"{self.flag_prefix}{key}"
-            redis_client = await redis.get_client()
-            flag_data = await redis_client.hgetall(flag_key)
-            return flag_data if flag_data else None
+            flag_data = (await self._get_snapshot()).get(key)
+            return dict(flag_data) if flag_data else None
         except Exception as e:
             logger.error(f"Failed to get feature flag {key}: {e}")
             return None
@@ -65,9 +163,11 @@ class FeatureFlagManager:
         try:
             flag_key = f"{self.flag_prefix}{key}"
             redis_client = await redis.get_client()
-            deleted = await redis_client.delete(flag_key)
+            async with redis_client.pipeline(transaction=True) as pipe:
+                pipe.delete(flag_key)
+                pipe.srem(self.flag_list_key, key)
+                deleted = (await self._publish_change(pipe))[0]
             if deleted:
-                await redis_client.srem(self.flag_list_key, key)
                 logger.debug(f"Deleted feature flag: {key}")
                 return True
             return False
@@ -78,14 +178,8 @@ class FeatureFlagManager:
     async def list_flags(self) -> Dict[str, bool]:
         """List all feature flags with their status"""
         try:
-            redis_client = await redis.get_client()
-            flag_keys = await redis_client.smembers(self.flag_list_key)
-            flags = {}
-            
-            for key in flag_keys:
-                flags[key] = await self.is_enabled(key)
-            
-            return flags
+            snapshot = await self._get_snapshot()
+            return {key: data.get('enabled') == 'true' for key, data in snapshot.items()}
         except Exception as e:
             logger.error(f"Failed to list feature flags: {e}")
             return {}
@@ -93,16 +187,8 @@ class FeatureFlagManager:
     async def get_all_flags_details(self) -> Dict[str, Dict[str, str]]:
         """Get all feature flags with detailed information"""
         try:
-            redis_client = await redis.get_client()
-            flag_keys = await redis_client.smembers(self.flag_list_key)
-            flags = {}
-            
-            for key in flag_keys:
-                flag_data = await self.get_flag(key)
-                if flag_data:
-                    flags[key] = flag_data
-            
-            return flags
+            snapshot = await self._get_snapshot()
+            return {key: dict(data) for key, data in snapshot.items()}
         except Exception as e:
             logger.error(f"Failed to get all flags details: {e}")
             return {}
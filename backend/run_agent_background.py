@@ -4,6 +4,8 @@ dotenv.load_dotenv(".env")
 import sentry
 import asyncio
 import json
+import time
+import random
 import traceback
 from datetime import datetime, timezone
 from typing import Optional
@@ -14,10 +16,17 @@ import dramatiq
 import uuid
 from agentpress.thread_manager import ThreadManager
 from services.supabase import DBConnection
-from services import redis
+from services import redis, run_registry, run_dispatcher
 from dramatiq.brokers.redis import RedisBroker
 import os
 from services.langfuse import langfuse
+from services.usage_ledger import drain_usage_ledger
+from agentpress.response_coalescer import ResponseCoalescer
+from services.response_transport import get_response_transport
+from services.response_writer import ResponseWriter
+from services.response_compression import get_response_compressor
+from services.run_scheduler import get_run_scheduler, start_metrics_server
+from utils.config import config
 from utils.retry import retry
 
 import sentry_sdk
@@ -34,6 +43,11 @@ _initialized = False
 db = DBConnection()
 instance_id = "single"
 
+# Seconds between refreshes of the registration of a running agent run
+ACTIVE_RUN_REFRESH_INTERVAL = 60
+# Delay before a run this worker had no room for is delivered again, plus up to as much jitter
+ADMISSION_REQUEUE_DELAY_MS = 2000
+
 async def initialize():
     """Initialize the agent API with resources from the main API."""
     global db, instance_id, _initialized
@@ -43,6 +57,8 @@ async def initialize():
     await retry(lambda: redis.initialize_async())
     await db.initialize()
 
+    if not _initialized:
+        start_metrics_server()
     _initialized = True
     logger.debug(f"Initialized agent API with instance ID: {instance_id}")
 
@@ -52,6 +68,13 @@ async def check_health(key: str):
     structlog.contextvars.clear_contextvars()
     await redis.set(key, "healthy", ex=redis.REDIS_KEY_TTL)
 
+@dramatiq.actor
+async def process_usage_ledger():
+    """Bill the usage events queued by agent runs, in micro-batches."""
+    structlog.contextvars.clear_contextvars()
+    await initialize()
+    await drain_usage_ledger()
+
 @dramatiq.actor
 async def run_agent_background(
     agent_run_id: str,
@@ -67,6 +90,7 @@ async def run_agent_background(
     is_agent_builder: Optional[bool] = False,
     target_agent_id: Optional[str] = None,
     request_id: Optional[str] = None,
+    admission_attempts: int = 0,
 ):
     """Run the agent in the background using Redis for state."""
     structlog.contextvars.clear_contextvars()
@@ -82,6 +106,58 @@ async def run_agent_background(
         logger.critical(f"Failed to initialize Redis connection: {e}")
         raise e
 
+    run_kwargs = dict(
+        agent_run_id=agent_run_id, thread_id=thread_id, instance_id=instance_id,
+        project_id=project_id, model_name=model_name,
+        enable_thinking=enable_thinking, reasoning_effort=reasoning_effort,
+        stream=stream, enable_context_manager=enable_context_manager,
+        agent_config=agent_config, is_agent_builder=is_agent_builder,
+        target_agent_id=target_agent_id, request_id=request_id,
+    )
+
+    # Leave the run to a less busy worker if this process has no room for it
+    scheduler = get_run_scheduler()
+    if not await scheduler.admit(agent_run_id):
+        if config.WORKER_MAX_REQUEUES and admission_attempts >= config.WORKER_MAX_REQUEUES:
+            await _reject_agent_run(agent_run_id, instance_id)
+            return
+        # Runs may wait for a while, the user may have stopped it meanwhile
+        if await _agent_run_stopped(agent_run_id):
+            logger.info(f"Agent run {agent_run_id} was stopped while waiting for a worker")
+            await _release_dispatch_slot(agent_run_id)
+            return
+        # Still waiting for a worker, it keeps its dispatcher slot
+        try:
+            await run_dispatcher.keep_alive(agent_run_id)
+        except Exception as e:
+            logger.warning(f"Failed to refresh dispatcher slot of agent run {agent_run_id}: {str(e)}")
+        delay = ADMISSION_REQUEUE_DELAY_MS + random.randint(0, ADMISSION_REQUEUE_DELAY_MS)
+        run_agent_background.send_with_options(
+            kwargs={**run_kwargs, "admission_attempts": admission_attempts + 1}, delay=delay
+        )
+        logger.info(f"Requeued agent run {agent_run_id} in {delay} ms (attempt {admission_attempts + 1})")
+        return
+
+    try:
+        await _run_agent_background(**run_kwargs)
+    finally:
+        await scheduler.release()
+
+async def _run_agent_background(
+    agent_run_id: str,
+    thread_id: str,
+    instance_id: str,
+    project_id: str,
+    model_name: str,
+    enable_thinking: Optional[bool],
+    reasoning_effort: Optional[str],
+    stream: bool,
+    enable_context_manager: bool,
+    agent_config: Optional[dict] = None,
+    is_agent_builder: Optional[bool] = False,
+    target_agent_id: Optional[str] = None,
+    request_id: Optional[str] = None,
+):
     # Idempotency check: prevent duplicate runs
     run_lock_key = f"agent_run_lock:{agent_run_id}"
     
@@ -140,17 +216,19 @@ async def run_agent_background(
     pubsub = None
     stop_checker = None
     stop_signal_received = False
+    response_stream = None
+    coalescer = ResponseCoalescer(config.RESPONSE_COALESCE_WINDOW_MS, config.RESPONSE_COALESCE_MAX_BYTES)
 
     # Define Redis keys and channels
-    response_list_key = f"agent_run:{agent_run_id}:responses"
-    response_channel = f"agent_run:{agent_run_id}:new_response"
+    transport = get_response_transport()
+    writer = ResponseWriter(agent_run_id, transport, get_response_compressor())
     instance_control_channel = f"agent_run:{agent_run_id}:control:{instance_id}"
     global_control_channel = f"agent_run:{agent_run_id}:control"
-    instance_active_key = f"active_run:{instance_id}:{agent_run_id}"
 
     async def check_for_stop_signal():
         nonlocal stop_signal_received
         if not pubsub: return
+        registered_at = time.monotonic()
         try:
             while not stop_signal_received:
                 message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=0.5)
@@ -161,10 +239,13 @@ async def run_agent_background(
                         logger.debug(f"Received STOP signal for agent run {agent_run_id} (Instance: {instance_id})")
                         stop_signal_received = True
                         break
-                # Periodically refresh the active run key TTL
-                if total_responses % 50 == 0: # Refresh every 50 responses or so
-                    try: await redis.expire(instance_active_key, redis.REDIS_KEY_TTL)
-                    except Exception as ttl_err: logger.warning(f"Failed to refresh TTL for {instance_active_key}: {ttl_err}")
+                # Periodically refresh the registration of the run
+                if time.monotonic() - registered_at >= ACTIVE_RUN_REFRESH_INTERVAL:
+                    registered_at = time.monotonic()
+                    try:
+                        await run_registry.register_run(instance_id, agent_run_id)
+                        await run_dispatcher.keep_alive(agent_run_id)
+                    except Exception as ttl_err: logger.warning(f"Failed to refresh registration of agent run {agent_run_id}: {ttl_err}")
                 await asyncio.sleep(0.1) # Short sleep to prevent tight loop
         except asyncio.CancelledError:
             logger.debug(f"Stop signal checker cancelled for {agent_run_id} (Instance: {instance_id})")
@@ -185,9 +266,13 @@ async def run_agent_background(
         logger.debug(f"Subscribed to control channels: {instance_control_channel}, {global_control_channel}")
         stop_checker = asyncio.create_task(check_for_stop_signal())
 
-        # Ensure active run key exists and has TTL
-        await redis.set(instance_active_key, "running", ex=redis.REDIS_KEY_TTL)
-
+        # Ensure the run is registered as active on this instance
+        await run_registry.register_run(instance_id, agent_run_id)
+        # The slot may have waited in the Dramatiq queue for most of its INFLIGHT_TTL
+        try:
+            await run_dispatcher.keep_alive(agent_run_id)
+        except Exception as e:
+            logger.warning(f"Failed to refresh dispatcher slot of agent run {agent_run_id}: {str(e)}")
 
         # Initialize agent generator
         agent_gen = run_agent(
@@ -204,19 +289,18 @@ async def run_agent_background(
         final_status = "running"
         error_message = None
 
-        pending_redis_operations = []
-
-        async for response in agent_gen:
+        # Merge token deltas so each Redis write and notification carries more content
+        response_stream = coalescer.coalesce(agent_gen)
+        async for response in response_stream:
             if stop_signal_received:
                 logger.debug(f"Agent run {agent_run_id} stopped by signal.")
                 final_status = "stopped"
                 trace.span(name="agent_run_stopped").end(status_message="agent_run_stopped", level="WARNING")
                 break
 
-            # Store response in Redis list and publish notification
+            # Store response in Redis and notify viewers
             response_json = json.dumps(response)
-            pending_redis_operations.append(asyncio.create_task(redis.rpush(response_list_key, response_json)))
-            pending_redis_operations.append(asyncio.create_task(redis.publish(response_channel, "new")))
+            await writer.write(response_json)
             total_responses += 1
 
             # Check for agent-signaled completion or error
@@ -236,12 +320,10 @@ async def run_agent_background(
              logger.debug(f"Agent run {agent_run_id} completed normally (duration: {duration:.2f}s, responses: {total_responses})")
              completion_message = {"type": "status", "status": "completed", "message": "Agent run completed successfully"}
              trace.span(name="agent_run_completed").end(status_message="agent_run_completed")
-             await redis.rpush(response_list_key, json.dumps(completion_message))
-             await redis.publish(response_channel, "new") # Notify about the completion message
+             await writer.write(json.dumps(completion_message))
 
-        # Fetch final responses from Redis for DB update
-        all_responses_json = await redis.lrange(response_list_key, 0, -1)
-        all_responses = [json.loads(r) for r in all_responses_json]
+        # Viewers stop reading at the control signal, everything before it must be stored
+        await writer.flush()
 
         # Update DB status
         await update_agent_run_status(client, agent_run_id, final_status, error=error_message)
@@ -249,7 +331,7 @@ async def run_agent_background(
         # Publish final control signal (END_STREAM or ERROR)
         control_signal = "END_STREAM" if final_status == "completed" else "ERROR" if final_status == "failed" else "STOP"
         try:
-            await redis.publish(global_control_channel, control_signal)
+            await transport.signal(agent_run_id, control_signal)
             # No need to publish to instance channel as the run is ending on this instance
             logger.debug(f"Published final control signal '{control_signal}' to {global_control_channel}")
         except Exception as e:
@@ -263,34 +345,30 @@ async def run_agent_background(
         final_status = "failed"
         trace.span(name="agent_run_failed").end(status_message=error_message, level="ERROR")
 
-        # Push error message to Redis list
+        # Push error message to Redis
         error_response = {"type": "status", "status": "error", "message": error_message}
         try:
-            await redis.rpush(response_list_key, json.dumps(error_response))
-            await redis.publish(response_channel, "new")
+            await writer.write(json.dumps(error_response))
+            await writer.flush()
         except Exception as redis_err:
              logger.error(f"Failed to push error response to Redis for {agent_run_id}: {redis_err}")
 
-        # Fetch final responses (including the error)
-        all_responses = []
-        try:
-             all_responses_json = await redis.lrange(response_list_key, 0, -1)
-             all_responses = [json.loads(r) for r in all_responses_json]
-        except Exception as fetch_err:
-             logger.error(f"Failed to fetch responses from Redis after error for {agent_run_id}: {fetch_err}")
-             all_responses = [error_response] # Use the error message we tried to push
-
         # Update DB status
         await update_agent_run_status(client, agent_run_id, "failed", error=f"{error_message}\n{traceback_str}")
 
         # Publish ERROR signal
         try:
-            await redis.publish(global_control_channel, "ERROR")
+            await transport.signal(agent_run_id, "ERROR")
             logger.debug(f"Published ERROR signal to {global_control_channel}")
         except Exception as e:
             logger.warning(f"Failed to publish ERROR signal: {str(e)}")
 
     finally:
+        # Stop reading from the agent if the run ended early
+        if response_stream is not None:
+            await response_stream.aclose()
+            logger.debug(f"Coalesced {coalescer.received} agent responses into {coalescer.emitted} for {agent_run_id}")
+
         # Cleanup stop checker task
         if stop_checker and not stop_checker.done():
             stop_checker.cancel()
@@ -307,35 +385,77 @@ async def run_agent_background(
             except Exception as e:
                 logger.warning(f"Error closing pubsub for {agent_run_id}: {str(e)}")
 
+        # Finish writing responses before the TTL is set on them
+        await writer.close(timeout=30.0)
+        logger.debug(
+            f"Wrote {writer.written} responses of {agent_run_id} in {writer.batches} batches "
+            f"({writer.failed} failed), {writer.raw_bytes} bytes stored as {writer.stored_bytes}"
+        )
+
         # Set TTL on the response list in Redis
         await _cleanup_redis_response_list(agent_run_id)
 
-        # Remove the instance-specific active run key
-        await _cleanup_redis_instance_key(agent_run_id)
+        # Remove the registration of the run on its instance
+        await _cleanup_redis_instance_key(agent_run_id, instance_id)
+
+        # Give its slot to the next run waiting
+        await _release_dispatch_slot(agent_run_id)
 
         # Clean up the run lock
         await _cleanup_redis_run_lock(agent_run_id)
 
-        # Wait for all pending redis operations to complete, with timeout
-        try:
-            await asyncio.wait_for(asyncio.gather(*pending_redis_operations), timeout=30.0)
-        except asyncio.TimeoutError:
-            logger.warning(f"Timeout waiting for pending Redis operations for {agent_run_id}")
-
         logger.debug(f"Agent run background task fully completed for: {agent_run_id} (Instance: {instance_id}) with final status: {final_status}")
 
-async def _cleanup_redis_instance_key(agent_run_id: str):
-    """Clean up the instance-specific Redis key for an agent run."""
+async def _reject_agent_run(agent_run_id: str, instance_id: str):
+    """Fail a run that no worker had room for."""
+    error_message = "Agent workers are too busy to start this run, please try again"
+    logger.warning(f"Rejecting agent run {agent_run_id} after {config.WORKER_MAX_REQUEUES} requeues")
+    transport = get_response_transport()
+    try:
+        await transport.append(agent_run_id, json.dumps({"type": "status", "status": "error", "message": error_message}))
+    except Exception as e:
+        logger.error(f"Failed to push error response to Redis for {agent_run_id}: {e}")
+
+    client = await db.client
+    await update_agent_run_status(client, agent_run_id, "failed", error=error_message)
+
+    try:
+        await transport.signal(agent_run_id, "ERROR")
+    except Exception as e:
+        logger.warning(f"Failed to publish ERROR signal: {str(e)}")
+
+    await _cleanup_redis_response_list(agent_run_id)
+    await _cleanup_redis_instance_key(agent_run_id, instance_id)
+    await _release_dispatch_slot(agent_run_id)
+
+async def _agent_run_stopped(agent_run_id: str) -> bool:
+    """Whether a run that has not started yet is no longer running in the database."""
+    try:
+        client = await db.client
+        result = await client.table('agent_runs').select('status').eq('id', agent_run_id).execute()
+        return bool(result.data) and result.data[0]['status'] != 'running'
+    except Exception as e:
+        logger.warning(f"Failed to check the status of agent run {agent_run_id}: {str(e)}")
+        return False
+
+async def _release_dispatch_slot(agent_run_id: str):
+    """Release the dispatcher slot of an agent run that has ended."""
+    try:
+        await run_dispatcher.release(agent_run_id)
+    except Exception as e:
+        logger.warning(f"Failed to release dispatcher slot of agent run {agent_run_id}: {str(e)}")
+
+async def _cleanup_redis_instance_key(agent_run_id: str, instance_id: Optional[str]):
+    """Remove the registration of an agent run on its instance."""
     if not instance_id:
         logger.warning("Instance ID not set, cannot clean up instance key.")
         return
-    key = f"active_run:{instance_id}:{agent_run_id}"
-    logger.debug(f"Cleaning up Redis instance key: {key}")
+    logger.debug(f"Unregistering agent run {agent_run_id} of instance {instance_id}")
     try:
-        await redis.delete(key)
-        logger.debug(f"Successfully cleaned up Redis key: {key}")
+        await run_registry.unregister_run(instance_id, agent_run_id)
+        logger.debug(f"Successfully unregistered agent run {agent_run_id}")
     except Exception as e:
-        logger.warning(f"Failed to clean up Redis key {key}: {str(e)}")
+        logger.warning(f"Failed to unregister agent run {agent_run_id}: {str(e)}")
 
 async def _cleanup_redis_run_lock(agent_run_id: str):
     """Clean up the run lock Redis key for an agent run."""
@@ -351,13 +471,12 @@ async def _cleanup_redis_run_lock(agent_run_id: str):
 REDIS_RESPONSE_LIST_TTL = 3600 * 24
 
 async def _cleanup_redis_response_list(agent_run_id: str):
-    """Set TTL on the Redis response list."""
-    response_list_key = f"agent_run:{agent_run_id}:responses"
+    """Set TTL on the stored responses of an agent run."""
     try:
-        await redis.expire(response_list_key, REDIS_RESPONSE_LIST_TTL)
-        logger.debug(f"Set TTL ({REDIS_RESPONSE_LIST_TTL}s) on response list: {response_list_key}")
+        await get_response_transport().expire(agent_run_id, REDIS_RESPONSE_LIST_TTL)
+        logger.debug(f"Set TTL ({REDIS_RESPONSE_LIST_TTL}s) on responses of agent run: {agent_run_id}")
     except Exception as e:
-        logger.warning(f"Failed to set TTL on response list {response_list_key}: {str(e)}")
+        logger.warning(f"Failed to set TTL on responses of agent run {agent_run_id}: {str(e)}")
 
 async def update_agent_run_status(
     client,
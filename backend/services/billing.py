@@ -10,7 +10,7 @@ import stripe
 from datetime import datetime, timezone, timedelta
 
 from supabase import Client as SupabaseClient
-from utils.cache import Cache
+from utils.cache import Cache, cached
 from utils.logger import logger
 from utils.config import config, EnvMode
 from services.supabase import DBConnection
@@ -18,14 +18,13 @@ from utils.auth_utils import get_current_user_id_from_jwt
 from pydantic import BaseModel
 from utils.constants import MODEL_ACCESS_TIERS, MODEL_NAME_ALIASES, HARDCODED_MODEL_PRICES
 from litellm.cost_calculator import cost_per_token
+from services.pricing import TOKEN_PRICE_MULTIPLIER, cost_many, token_cost
+from services import usage_counters
 import time
 
 # Initialize Stripe
 stripe.api_key = config.STRIPE_SECRET_KEY
 
-# Token price multiplier
-TOKEN_PRICE_MULTIPLIER = 1.5
-
 # Minimum credits required to allow a new request when over subscription limit
 CREDIT_MIN_START_DOLLARS = 0.20
 
@@ -363,11 +362,23 @@ async def get_user_subscription(user_id: str) -> Optional[Dict]:
         return None
 
 async def calculate_monthly_usage(client, user_id: str) -> float:
-    """Calculate total agent run minutes for the current month for a user."""
-    result = await Cache.get(f"monthly_usage:{user_id}")
-    if result:
-        return result
+    """Cost of the usage of a user this month, read from their usage counter.
 
+    The counter is built from the usage logs on the first read of the month,
+    and computed from the logs directly while Redis is unavailable.
+    """
+    try:
+        usage = await usage_counters.get_monthly_usage(user_id)
+        if usage is not None:
+            return usage
+        return await usage_counters.rebuild(user_id, lambda: calculate_usage_from_logs(client, user_id))
+    except Exception as e:
+        logger.warning(f"Failed to read the usage counter of {user_id}, computing it from the logs: {str(e)}")
+        return await calculate_usage_from_logs(client, user_id)
+
+
+async def calculate_usage_from_logs(client, user_id: str) -> float:
+    """Calculate the cost of the usage of a user this month from their usage logs."""
     start_time = time.time()
     
     # Use get_usage_logs to fetch all usage data (it already handles the date filtering and batching)
@@ -394,9 +405,7 @@ async def calculate_monthly_usage(client, user_id: str) -> float:
     
     end_time = time.time()
     execution_time = end_time - start_time
-    logger.debug(f"Calculate monthly usage took {execution_time:.3f} seconds, total cost: {total_cost}")
-    
-    await Cache.set(f"monthly_usage:{user_id}", total_cost, ttl=5)
+    logger.debug(f"Calculate usage from logs took {execution_time:.3f} seconds, total cost: {total_cost}")
     return total_cost
 
 
@@ -489,9 +498,6 @@ async def get_usage_logs(client, user_id: str, page: int = 0, items_per_page: in
                     'created_at': usage['created_at']
                 }
     
-    # Track cumulative usage to determine when credits started being used
-    cumulative_cost = 0.0
-    
     # Process messages into usage log entries
     processed_logs = []
     
@@ -509,15 +515,6 @@ async def get_usage_logs(client, user_id: str, page: int = 0, items_per_page: in
             # Safely calculate total tokens
             total_tokens = (prompt_tokens or 0) + (completion_tokens or 0)
             
-            # Calculate estimated cost using the same logic as calculate_monthly_usage
-            estimated_cost = calculate_token_cost(
-                prompt_tokens,
-                completion_tokens,
-                model
-            )
-            
-            cumulative_cost += estimated_cost
-            
             # Safely extract project_id from threads relationship
             project_id = 'unknown'
             if message.get('threads') and isinstance(message['threads'], list) and len(message['threads']) > 0:
@@ -539,12 +536,13 @@ async def get_usage_logs(client, user_id: str, page: int = 0, items_per_page: in
                     'model': model
                 },
                 'total_tokens': total_tokens,
-                'estimated_cost': estimated_cost,
+                # Set below, once the whole page is priced
+                'estimated_cost': 0.0,
                 'project_id': project_id,
                 # Add credit usage info
                 'credit_used': credit_used.get('amount', 0) if credit_used else 0,
                 'payment_method': 'credits' if credit_used else 'subscription',
-                'was_over_limit': cumulative_cost > subscription_limit if not credit_used else True
+                'was_over_limit': True
             }
             
             processed_logs.append(log_entry)
@@ -552,6 +550,21 @@ async def get_usage_logs(client, user_id: str, page: int = 0, items_per_page: in
             logger.warning(f"Error processing usage log entry for message {message.get('message_id', 'unknown')}: {str(e)}")
             continue
     
+    # Calculate estimated costs using the same logic as calculate_token_cost,
+    # each model of the page is looked up once
+    estimated_costs = cost_many(
+        (log['content']['usage']['prompt_tokens'], log['content']['usage']['completion_tokens'], log['content']['model'])
+        for log in processed_logs
+    )
+    
+    # Track cumulative usage to determine when credits started being used
+    cumulative_cost = 0.0
+    for log_entry, estimated_cost in zip(processed_logs, estimated_costs):
+        cumulative_cost += estimated_cost
+        log_entry['estimated_cost'] = estimated_cost
+        if log_entry['payment_method'] == 'subscription':
+            log_entry['was_over_limit'] = cumulative_cost > subscription_limit
+    
     # Check if there are more results
     has_more = len(processed_logs) == items_per_page
     
@@ -569,66 +582,13 @@ def calculate_token_cost(prompt_tokens: int, completion_tokens: int, model: str)
         # Ensure tokens are valid integers
         prompt_tokens = int(prompt_tokens) if prompt_tokens is not None else 0
         completion_tokens = int(completion_tokens) if completion_tokens is not None else 0
-        
-        # Try to resolve the model name using MODEL_NAME_ALIASES first
-        resolved_model = MODEL_NAME_ALIASES.get(model, model)
-
-        # Check if we have hardcoded pricing for this model (try both original and resolved)
-        hardcoded_pricing = get_model_pricing(model) or get_model_pricing(resolved_model)
-        if hardcoded_pricing:
-            input_cost_per_million, output_cost_per_million = hardcoded_pricing
-            input_cost = (prompt_tokens / 1_000_000) * input_cost_per_million
-            output_cost = (completion_tokens / 1_000_000) * output_cost_per_million
-            message_cost = input_cost + output_cost
-        else:
-            # Use litellm pricing as fallback - try multiple variations
-            try:
-                models_to_try = [model]
-                
-                # Add resolved model if different
-                if resolved_model != model:
-                    models_to_try.append(resolved_model)
-                
-                # Try without provider prefix if it has one
-                if '/' in model:
-                    models_to_try.append(model.split('/', 1)[1])
-                if '/' in resolved_model and resolved_model != model:
-                    models_to_try.append(resolved_model.split('/', 1)[1])
-                    
-                # Special handling for Google models accessed via OpenRouter
-                if model.startswith('openrouter/google/'):
-                    google_model_name = model.replace('openrouter/', '')
-                    models_to_try.append(google_model_name)
-                if resolved_model.startswith('openrouter/google/'):
-                    google_model_name = resolved_model.replace('openrouter/', '')
-                    models_to_try.append(google_model_name)
-                
-                # Try each model name variation until we find one that works
-                message_cost = None
-                for model_name in models_to_try:
-                    try:
-                        prompt_token_cost, completion_token_cost = cost_per_token(model_name, prompt_tokens, completion_tokens)
-                        if prompt_token_cost is not None and completion_token_cost is not None:
-                            message_cost = prompt_token_cost + completion_token_cost
-                            break
-                    except Exception as e:
-                        logger.debug(f"Failed to get pricing for model variation {model_name}: {str(e)}")
-                        continue
-                
-                if message_cost is None:
-                    logger.warning(f"Could not get pricing for model {model} (resolved: {resolved_model}), returning 0 cost")
-                    return 0.0
-                    
-            except Exception as e:
-                logger.warning(f"Could not get pricing for model {model} (resolved: {resolved_model}): {str(e)}, returning 0 cost")
-                return 0.0
-        
-        # Apply the TOKEN_PRICE_MULTIPLIER
-        return message_cost * TOKEN_PRICE_MULTIPLIER
+        # Hardcoded prices first, then litellm's, resolved once per model (see services/pricing.py)
+        return token_cost(prompt_tokens, completion_tokens, model)
     except Exception as e:
         logger.error(f"Error calculating token cost for model {model}: {str(e)}")
         return 0.0
 
+@cached("allowed_models_for_user:{user_id}", ttl=1 * 60, stale_ttl=1 * 60)
 async def get_allowed_models_for_user(client, user_id: str):
     """
     Get the list of models allowed for a user based on their subscription tier.
@@ -636,11 +596,6 @@ async def get_allowed_models_for_user(client, user_id: str):
     Returns:
         List of model names allowed for the user's subscription tier.
     """
-
-    result = await Cache.get(f"allowed_models_for_user:{user_id}")
-    if result:
-        return result
-
     subscription = await get_user_subscription(user_id)
     tier_name = 'free'
     
@@ -657,9 +612,7 @@ async def get_allowed_models_for_user(client, user_id: str):
             tier_name = tier_info['name']
     
     # Return allowed models for this tier
-    result = MODEL_ACCESS_TIERS.get(tier_name, MODEL_ACCESS_TIERS['free'])  # Default to free tier if unknown
-    await Cache.set(f"allowed_models_for_user:{user_id}", result, ttl=1 * 60)
-    return result
+    return MODEL_ACCESS_TIERS.get(tier_name, MODEL_ACCESS_TIERS['free'])  # Default to free tier if unknown
 
 
 async def can_use_model(client, user_id: str, model_name: str):
@@ -944,7 +897,12 @@ async def use_credits_from_balance(
     thread_id: str = None,
     message_id: str = None
 ) -> bool:
-    """Deduct credits from a user's balance."""
+    """Deduct credits from a user's balance.
+
+    Deductions are recorded under message_id, and the database function charges
+    a message only once, so a call that failed (even after it committed) can be
+    retried with the same message_id.
+    """
     try:
         # Use the database function to use credits
         result = await client.rpc('use_credits', {
@@ -975,7 +933,11 @@ async def handle_usage_with_credits(
     This should be called after each agent response to track and deduct from credits if needed.
     
     Returns:
-        Tuple[bool, str]: (success, message)
+        Tuple[bool, str]: (success, message), success is False if the usage is
+        over the limit and the credits of the account cannot pay for it.
+
+    Raises:
+        Exception: If the usage could not be processed, so that it can be retried.
     """
     try:
         # Get current subscription tier and limits
@@ -1021,7 +983,7 @@ async def handle_usage_with_credits(
                     logger.debug(f"Used ${overage_amount:.4f} credits for user {user_id} overage")
                     return True, f"Used ${overage_amount:.4f} from credits (Balance: ${credit_balance.balance_dollars - overage_amount:.2f})"
                 else:
-                    return False, "Failed to deduct credits"
+                    raise RuntimeError(f"Failed to deduct ${overage_amount:.4f} credits")
             else:
                 # Insufficient credits
                 if credit_balance.can_purchase_credits:
@@ -1034,7 +996,7 @@ async def handle_usage_with_credits(
         
     except Exception as e:
         logger.error(f"Error handling usage with credits: {str(e)}")
-        return False, f"Error processing usage: {str(e)}"
+        raise
 
 # API endpoints
 @router.post("/create-checkout-session")
@@ -1656,7 +1618,6 @@ async def stripe_webhook(request: Request):
                     logger.info(f"Successfully added ${credit_amount} credits to user {user_id}. New balance: ${new_balance}")
                     
                     # Clear cache for this user
-                    await Cache.delete(f"monthly_usage:{user_id}")
                     await Cache.delete(f"user_subscription:{user_id}")
                     
                 except Exception as e:
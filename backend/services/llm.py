@@ -6,16 +6,22 @@ This module provides a unified interface for making API calls to different LLM p
 - Streaming responses
 - Tool calls and function calling
 - Retry logic with exponential backoff
+- Hedging of streamed calls with an OpenRouter fallback when the first token is late
 - Model-specific configurations
 - Comprehensive error handling and logging
 """
 
-from typing import Union, Dict, Any, Optional, AsyncGenerator, List
+from typing import Union, Dict, Any, Optional, AsyncGenerator, List, Tuple
 import os
+import time
+import asyncio
 import litellm
 from litellm.files.main import ModelResponse
+from prometheus_client import Counter, Histogram
 from utils.logger import logger
 from utils.config import config
+from utils.constants import MODELS, MODEL_NAME_ALIASES
+from services import llm_governor
 
 # litellm.set_verbose=True
 # Let LiteLLM auto-adjust params and drop unsupported ones (e.g., GPT-5 temperature!=1)
@@ -24,6 +30,34 @@ litellm.drop_params = True
 
 # Constants
 MAX_RETRIES = 3
+
+LLM_HEDGEABLE_CALLS = Counter(
+    "llm_hedgeable_calls_total",
+    "Streamed LLM calls that have a fallback to hedge with, by model",
+    ["model"],
+)
+LLM_HEDGES = Counter(
+    "llm_hedges_total",
+    "Streamed LLM calls that started their fallback, by model and reason (ttft, error)",
+    ["model", "reason"],
+)
+LLM_HEDGE_WINS = Counter(
+    "llm_hedge_wins_total",
+    "Hedged LLM calls by model and the call that streamed first (primary, fallback)",
+    ["model", "winner"],
+)
+LLM_RATE_LIMIT_REROUTES = Counter(
+    "llm_rate_limit_reroutes_total",
+    "LLM calls moved to their fallback because the rate limits of their provider were saturated, by model",
+    ["model"],
+)
+LLM_TIME_TO_FIRST_TOKEN = Histogram(
+    "llm_time_to_first_token_seconds",
+    "Time to the first chunk of hedged LLM calls, from either model, by requested model",
+    ["model"],
+    buckets=(0.25, 0.5, 1, 2, 3, 5, 8, 12, 20, 30, 60),
+)
+
 class LLMError(Exception):
     """Base exception for LLM-related errors."""
     pass
@@ -123,11 +157,16 @@ def _apply_anthropic_caching(messages: List[Dict[str, Any]]) -> None:
             ]
             cache_control_count += 1
         elif isinstance(content, list):
-            for item in content:
+            # Blocks may be shared with the message cache, marked ones are copied
+            content = message["content"] = list(content)
+            # The system prompt ends with a volatile block (date/time), only its
+            # immutable prefix block is worth a cache breakpoint
+            text_blocks = 1 if message.get("role") == "system" else len(content)
+            for i, item in enumerate(content[:text_blocks]):
                 if cache_control_count >= max_cache_control_blocks:
                     break
                 if isinstance(item, dict) and item.get("type") == "text" and "cache_control" not in item:
-                    item["cache_control"] = {"type": "ephemeral"}
+                    content[i] = {**item, "cache_control": {"type": "ephemeral"}}
                     cache_control_count += 1
 
 def _configure_anthopic(params: Dict[str, Any], model_name: str, messages: List[Dict[str, Any]]) -> None:
@@ -295,6 +334,112 @@ def prepare_params(
 
     return params
 
+def _get_ttft_budget(model_name: str) -> float:
+    """Seconds a streamed call to a model waits for its first token before it is hedged."""
+    model_config = MODELS.get(MODEL_NAME_ALIASES.get(model_name, model_name), {})
+    return model_config.get("ttft_budget_ms", config.LLM_HEDGE_TTFT_MS) / 1000
+
+async def _open_stream(params: Dict[str, Any]) -> Tuple[Any, Optional[Any]]:
+    """Start a streamed call and wait for its first chunk, None if the stream is empty."""
+    response = await litellm.acompletion(**params)
+    try:
+        first_chunk = await response.__anext__()
+    except StopAsyncIteration:
+        first_chunk = None
+    except asyncio.CancelledError:
+        # The hedge cancels the loser while it waits for its first chunk
+        await _close_stream(response)
+        raise
+    return response, first_chunk
+
+async def _close_stream(response: Any) -> None:
+    """Close the connection of a stream that will not be read."""
+    completion_stream = getattr(response, "completion_stream", None)
+    for stream in (response, completion_stream):
+        aclose = getattr(stream, "aclose", None)
+        if aclose is not None:
+            try:
+                await aclose()
+            except Exception as e:
+                logger.debug(f"Failed to close abandoned LLM stream: {str(e)}")
+            return
+
+async def _resume_stream(response: Any, first_chunk: Optional[Any]) -> AsyncGenerator:
+    """Stream a response whose first chunk has already been read."""
+    if first_chunk is None:
+        return
+    yield first_chunk
+    async for chunk in response:
+        yield chunk
+
+async def _make_hedged_stream(
+    params: Dict[str, Any],
+    fallback_params: Dict[str, Any],
+    ttft_budget: float
+) -> AsyncGenerator:
+    """Stream from the primary model, hedged with its fallback if the first token is late.
+
+    The fallback is started once the primary has not streamed its first chunk
+    within ttft_budget seconds, or has failed before it. Whichever streams first
+    is returned and the other is cancelled. Errors after the first chunk are
+    left to the caller, as for unhedged streams.
+    """
+    model_name = params["model"]
+    fallback_model = fallback_params["model"]
+    LLM_HEDGEABLE_CALLS.labels(model=model_name).inc()
+    started = time.monotonic()
+    primary = asyncio.create_task(_open_stream(params))
+    fallback = None
+    winner = None
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=ttft_budget)
+        fallback_acquired = False
+        if not done:
+            fallback_acquired = await llm_governor.acquire(fallback_model, fallback_params["messages"], max_wait=0)
+            if not fallback_acquired:
+                # Hedging would only add to the rate limiting of the fallback's provider
+                logger.info(f"No first token from {model_name} after {ttft_budget:.1f}s, not hedging with saturated {fallback_model}")
+                done, _ = await asyncio.wait({primary})
+        if done and primary.exception() is None:
+            winner = primary
+        else:
+            if not fallback_acquired and not await llm_governor.acquire(fallback_model, fallback_params["messages"]):
+                # As for a late first token, a saturated fallback is not used
+                logger.warning(f"LLM call to {model_name} failed before its first token, not falling back to saturated {fallback_model}")
+                raise primary.exception()
+            reason = "error" if done else "ttft"
+            LLM_HEDGES.labels(model=model_name, reason=reason).inc()
+            if done:
+                logger.warning(f"LLM call to {model_name} failed before its first token, falling back to {fallback_model}: {str(primary.exception())}")
+            else:
+                logger.warning(f"No first token from {model_name} after {ttft_budget:.1f}s, hedging with {fallback_model}")
+            fallback = asyncio.create_task(_open_stream(fallback_params))
+            pending = {fallback} if done else {primary, fallback}
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # On a tie the primary wins, its cost is the one the caller accounts for
+                for task in (primary, fallback):
+                    if task in done and task.exception() is None:
+                        winner = task
+                        break
+            if winner is None:
+                raise primary.exception()
+            winner_name = "primary" if winner is primary else "fallback"
+            LLM_HEDGE_WINS.labels(model=model_name, winner=winner_name).inc()
+            logger.info(f"Hedged LLM call to {model_name}: the {winner_name} streamed first")
+    finally:
+        for task in (primary, fallback):
+            if task is None or task is winner:
+                continue
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled() and task.exception() is None:
+                await _close_stream(task.result()[0])
+
+    LLM_TIME_TO_FIRST_TOKEN.labels(model=model_name).observe(time.monotonic() - started)
+    response, first_chunk = winner.result()
+    return _resume_stream(response, first_chunk)
+
 async def make_llm_api_call(
     messages: List[Dict[str, Any]],
     model_name: str,
@@ -330,6 +475,12 @@ async def make_llm_api_call(
         enable_thinking: Whether to enable thinking
         reasoning_effort: Level of reasoning effort
 
+    Calls wait for capacity in the shared rate limits of their provider (see
+    services/llm_governor.py), and go to the OpenRouter fallback if they stay
+    saturated. Streamed calls to a model with an OpenRouter fallback are
+    hedged: if the first token takes longer than the model's TTFT budget, the
+    fallback is started too and whichever streams first is returned.
+
     Returns:
         Union[Dict[str, Any], AsyncGenerator]: API response or stream
 
@@ -340,6 +491,18 @@ async def make_llm_api_call(
     # debug <timestamp>.json messages
     logger.debug(f"Making LLM API call to model: {model_name} (Thinking: {enable_thinking}, Effort: {reasoning_effort})")
     logger.debug(f"📡 API Call: Using model {model_name}")
+    # Wait for capacity in the shared rate limits of the provider, or move the
+    # call to its fallback if they stay saturated
+    if not await llm_governor.acquire(model_name, messages, api_key=api_key):
+        fallback_model = get_openrouter_fallback(model_name)
+        if fallback_model and not api_key and not api_base and await llm_governor.acquire(fallback_model, messages, max_wait=0):
+            LLM_RATE_LIMIT_REROUTES.labels(model=model_name).inc()
+            logger.warning(f"Routing call to {fallback_model}, the rate limits of {model_name} are saturated")
+            model_name = fallback_model
+            model_id = None
+        else:
+            logger.warning(f"No fallback with capacity for {model_name}, waiting for its turn in its saturated rate limits")
+            await llm_governor.acquire(model_name, messages, api_key=api_key, max_wait=float("inf"))
     params = prepare_params(
         messages=messages,
         model_name=model_name,
@@ -356,13 +519,39 @@ async def make_llm_api_call(
         enable_thinking=enable_thinking,
         reasoning_effort=reasoning_effort
     )
+    fallback_model = get_openrouter_fallback(model_name)
+    ttft_budget = _get_ttft_budget(model_name)
+    # Calls to a custom endpoint have no equivalent to hedge with
+    hedged = stream and fallback_model and ttft_budget > 0 and not api_key and not api_base
     try:
+        if hedged:
+            # The hedge replaces LiteLLM's fallback, which only starts once the primary has failed
+            params.pop("fallbacks", None)
+            fallback_params = prepare_params(
+                messages=messages,
+                model_name=fallback_model,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                response_format=response_format,
+                tools=tools,
+                tool_choice=tool_choice,
+                stream=stream,
+                top_p=top_p,
+                enable_thinking=enable_thinking,
+                reasoning_effort=reasoning_effort
+            )
+            response = await _make_hedged_stream(params, fallback_params, ttft_budget)
+            logger.debug(f"Successfully received first chunk of hedged API stream for {model_name}")
+            return response
+
         response = await litellm.acompletion(**params)
         logger.debug(f"Successfully received API response from {model_name}")
         # logger.debug(f"Response: {response}")
         return response
 
     except Exception as e:
+        if isinstance(e, litellm.exceptions.RateLimitError):
+            await llm_governor.report_rate_limited(model_name, api_key)
         logger.error(f"Unexpected error during API call: {str(e)}", exc_info=True)
         raise LLMError(f"API call failed: {str(e)}")
 
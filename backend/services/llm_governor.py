@@ -0,0 +1,218 @@
+"""
+Shared rate limits of the LLM providers.
+
+Every worker used to call the providers independently, so at busy times they
+all hit the rate limits of the same API keys at once and their retries made
+it worse. ``acquire`` takes a request and the estimated input tokens of a
+call from two token buckets in Redis, shared by all processes, per provider
+and API key:
+
+- ``requests``: ``rpm`` requests per minute
+- ``tokens``: ``tpm`` input tokens per minute, estimated with the cached
+  per-message counts of ``agentpress.token_cache``
+
+Each bucket holds up to a minute of its limit and refills continuously. A call
+without capacity reserves its share anyway, taking the bucket below zero, and
+waits for its turn, so calls are served in the order they asked. If its turn
+is more than ``LLM_RATE_LIMIT_WAIT_SECONDS`` away, ``acquire`` returns False
+at once and the caller may use its fallback instead.
+``report_rate_limited`` empties the buckets of a key the provider answered
+with a 429, so that every process backs off.
+
+Limits are set per provider in ``LLM_RATE_LIMITS``, providers not listed are
+not limited. The governor lets calls through if Redis is unavailable, or if
+other calls keep changing the buckets for ``RESERVE_MAX_ATTEMPTS`` attempts.
+"""
+
+import json
+import time
+import random
+import asyncio
+import hashlib
+from typing import Any, Dict, List, Optional
+
+import litellm
+from prometheus_client import Counter, Gauge, Histogram
+from redis.exceptions import WatchError
+
+from agentpress.token_cache import count_messages_tokens
+from services import redis
+from utils.config import config
+from utils.logger import logger
+
+GOVERNOR_PREFIX = "llm_governor:"
+# Seconds an unused bucket is kept, it is full again after a minute anyway
+BUCKET_TTL = 120
+# Attempts at reserving while other calls change the buckets, and the delay
+# before the first retry, doubled on each one (with jitter)
+RESERVE_MAX_ATTEMPTS = 8
+RESERVE_RETRY_DELAY = 0.005
+
+LLM_CALLS_WAITING = Gauge(
+    "llm_governor_waiting",
+    "LLM calls of this process waiting for the rate limits of their provider",
+    ["provider"],
+)
+LLM_GOVERNED_CALLS = Counter(
+    "llm_governor_calls_total",
+    "LLM calls by provider and result (immediate, waited, saturated, error)",
+    ["provider", "result"],
+)
+LLM_GOVERNOR_WAIT = Histogram(
+    "llm_governor_wait_seconds",
+    "Time LLM calls waited for the rate limits of their provider",
+    ["provider"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30),
+)
+LLM_RATE_LIMITED = Counter(
+    "llm_governor_rate_limited_total",
+    "Rate limit errors returned by the providers despite the governor",
+    ["provider"],
+)
+
+
+def get_provider(model_name: str) -> str:
+    """Provider a model is called through, e.g. anthropic, bedrock or openrouter."""
+    try:
+        return litellm.get_llm_provider(model_name)[1]
+    except Exception:
+        return model_name.split("/", 1)[0] if "/" in model_name else "unknown"
+
+
+def _bucket_key(provider: str, api_key: Optional[str]) -> str:
+    """Key of the buckets of a provider's API key, which only holds a hash of the key."""
+    if not api_key:
+        api_key = config.AWS_ACCESS_KEY_ID if provider == "bedrock" else getattr(config, f"{provider.upper()}_API_KEY", None)
+    key_id = hashlib.blake2b(api_key.encode(), digest_size=8).hexdigest() if api_key else "default"
+    return f"{GOVERNOR_PREFIX}{provider}:{key_id}"
+
+
+def estimate_input_tokens(model_name: str, messages: List[Dict[str, Any]]) -> int:
+    """Estimate the input tokens of a call from the cached token counts of its messages."""
+    try:
+        return count_messages_tokens(model_name, messages)
+    except Exception as e:
+        logger.debug(f"Could not count tokens for {model_name}, estimating from size: {str(e)}")
+        return len(json.dumps(messages, default=str)) // 4
+
+
+async def _reserve(key: str, limits: Dict[str, int], tokens: int, max_wait: float) -> Optional[float]:
+    """Reserve a request and tokens in the buckets of a key.
+
+    The buckets may go below zero, each reservation then waits for its turn.
+    Returns the seconds to wait before the call, or None without reserving
+    anything if that would be longer than max_wait. Raises WatchError if
+    another call changed the buckets meanwhile.
+    """
+    redis_client = await redis.get_client()
+    async with redis_client.pipeline(transaction=True) as pipe:
+        await pipe.watch(key)
+        state = await pipe.hgetall(key)
+        now = time.time()
+        elapsed = max(0.0, now - float(state.get("updated", now)))
+        levels = {}
+        wait = 0.0
+        for field, limit, cost in (("requests", limits.get("rpm"), 1), ("tokens", limits.get("tpm"), tokens)):
+            if not limit:
+                continue
+            rate = limit / 60
+            level = min(limit, float(state.get(field, limit)) + elapsed * rate)
+            # A call larger than a whole bucket goes through once the bucket is full
+            level -= min(cost, limit)
+            wait = max(wait, -level / rate)
+            levels[field] = level
+        if wait > max_wait:
+            return None
+        pipe.multi()
+        pipe.hset(key, mapping={**levels, "updated": now})
+        pipe.expire(key, BUCKET_TTL)
+        await pipe.execute()
+    return wait
+
+
+async def acquire(
+    model_name: str,
+    messages: List[Dict[str, Any]],
+    api_key: Optional[str] = None,
+    max_wait: Optional[float] = None
+) -> bool:
+    """Wait for the turn of a call to a model in the rate limits of its provider and key.
+
+    Args:
+        model_name: Model of the call, selects the provider
+        messages: Messages of the call, to estimate its input tokens
+        api_key: API key of the call if not the configured one
+        max_wait: Longest wait in seconds, LLM_RATE_LIMIT_WAIT_SECONDS by default
+
+    Returns:
+        False, right away, if the call would have waited longer than max_wait.
+    """
+    provider = get_provider(model_name)
+    limits = config.LLM_RATE_LIMITS.get(provider)
+    if not limits:
+        return True
+    if max_wait is None:
+        max_wait = config.LLM_RATE_LIMIT_WAIT_SECONDS
+    tokens = estimate_input_tokens(model_name, messages) if limits.get("tpm") else 0
+    key = _bucket_key(provider, api_key)
+    try:
+        for attempt in range(RESERVE_MAX_ATTEMPTS):
+            try:
+                wait = await _reserve(key, limits, tokens, max_wait)
+                break
+            except WatchError:
+                # Another call reserved meanwhile, look again after a while
+                if attempt == RESERVE_MAX_ATTEMPTS - 1:
+                    raise RuntimeError(f"buckets changed by other calls {RESERVE_MAX_ATTEMPTS} times in a row")
+                await asyncio.sleep(RESERVE_RETRY_DELAY * 2 ** attempt * random.uniform(0.5, 1.5))
+    except Exception as e:
+        LLM_GOVERNED_CALLS.labels(provider=provider, result="error").inc()
+        logger.warning(f"Failed to check the rate limits of {provider}, letting the call through: {str(e)}")
+        return True
+
+    if wait is None:
+        LLM_GOVERNED_CALLS.labels(provider=provider, result="saturated").inc()
+        logger.warning(f"Rate limits of {provider} saturated for over {max_wait:.0f}s, not calling {model_name} with ~{tokens} tokens")
+        return False
+    if wait == 0:
+        LLM_GOVERNED_CALLS.labels(provider=provider, result="immediate").inc()
+        return True
+    LLM_GOVERNED_CALLS.labels(provider=provider, result="waited").inc()
+    LLM_GOVERNOR_WAIT.labels(provider=provider).observe(wait)
+    LLM_CALLS_WAITING.labels(provider=provider).inc()
+    try:
+        await asyncio.sleep(wait)
+    finally:
+        LLM_CALLS_WAITING.labels(provider=provider).dec()
+    return True
+
+
+async def report_rate_limited(model_name: str, api_key: Optional[str] = None):
+    """Empty the buckets of a key its provider rate limited, so every process backs off."""
+    provider = get_provider(model_name)
+    LLM_RATE_LIMITED.labels(provider=provider).inc()
+    limits = config.LLM_RATE_LIMITS.get(provider)
+    if not limits:
+        return
+    key = _bucket_key(provider, api_key)
+    try:
+        redis_client = await redis.get_client()
+        async with redis_client.pipeline(transaction=True) as pipe:
+            await pipe.watch(key)
+            state = await pipe.hgetall(key)
+            now = time.time()
+            elapsed = max(0.0, now - float(state.get("updated", now)))
+            levels = {}
+            for field, limit in (("requests", limits.get("rpm")), ("tokens", limits.get("tpm"))):
+                if limit:
+                    # Keep the turns already reserved below zero
+                    levels[field] = min(0.0, float(state.get(field, limit)) + elapsed * limit / 60)
+            pipe.multi()
+            pipe.hset(key, mapping={**levels, "updated": now})
+            pipe.expire(key, BUCKET_TTL)
+            await pipe.execute()
+        logger.info(f"{provider} rate limited a {model_name} call, emptied its buckets")
+    except WatchError:
+        logger.debug(f"Buckets of {provider} changed while being emptied")
+    except Exception as e:
+        logger.warning(f"Failed to report the rate limiting of {provider}: {str(e)}")
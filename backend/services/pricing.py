@@ -0,0 +1,138 @@
+"""
+Prices of the models, resolved once per model name.
+
+Pricing a message used to try up to six variations of its model name against
+litellm on every call, logging each miss. The registry starts with the
+hardcoded prices of ``MODELS`` and their aliases, and resolves any other
+model name against litellm's cost map the first time it is priced, with the
+same name variations. The result is memoized either way, names without a
+price included, so later lookups are a dict access.
+
+Prices from litellm that depend on the size of the prompt (e.g. above 200k
+tokens) are still computed by litellm, under the name that resolved.
+"""
+
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import litellm
+from litellm.cost_calculator import cost_per_token
+
+from utils.constants import HARDCODED_MODEL_PRICES, MODEL_NAME_ALIASES
+from utils.logger import logger
+
+# Multiplier applied to the provider price of tokens
+TOKEN_PRICE_MULTIPLIER = 1.5
+
+# Most model names memoized, bounds the memory used by arbitrary names
+PRICE_CACHE_MAX_ENTRIES = 10_000
+
+# Price per token (input, output), or the litellm model name to price with
+# when its prices depend on the number of tokens
+Price = Union[Tuple[float, float], str]
+
+_prices: Dict[str, Optional[Price]] = {}
+
+
+def _build():
+    """Hardcoded prices per token, under the model names and their aliases."""
+    for model, pricing in HARDCODED_MODEL_PRICES.items():
+        _prices[model] = (
+            pricing["input_cost_per_million_tokens"] / 1_000_000,
+            pricing["output_cost_per_million_tokens"] / 1_000_000,
+        )
+    for alias, model in MODEL_NAME_ALIASES.items():
+        if model in _prices and alias not in _prices:
+            _prices[alias] = _prices[model]
+
+
+def _name_variations(model: str) -> List[str]:
+    """Names a model is looked up under in litellm, in order."""
+    resolved_model = MODEL_NAME_ALIASES.get(model, model)
+    names = [model]
+    if resolved_model != model:
+        names.append(resolved_model)
+    # Without the provider prefix
+    if '/' in model:
+        names.append(model.split('/', 1)[1])
+    if '/' in resolved_model and resolved_model != model:
+        names.append(resolved_model.split('/', 1)[1])
+    # Google models accessed through OpenRouter
+    if model.startswith('openrouter/google/'):
+        names.append(model.replace('openrouter/', ''))
+    if resolved_model.startswith('openrouter/google/'):
+        names.append(resolved_model.replace('openrouter/', ''))
+    return names
+
+
+def _is_tiered(model: str) -> bool:
+    try:
+        model_info = litellm.get_model_info(model)
+    except Exception:
+        return False
+    return any(value for key, value in model_info.items() if "_above_" in key)
+
+
+def _resolve(model: str) -> Optional[Price]:
+    """Find the price of a model in litellm's cost map, None if it has none."""
+    for name in _name_variations(model):
+        try:
+            input_cost, output_cost = cost_per_token(name, 1, 1)
+        except Exception:
+            continue
+        if input_cost is not None and output_cost is not None:
+            return name if _is_tiered(name) else (input_cost, output_cost)
+    logger.warning(f"Could not get pricing for model {model}, its tokens cost 0")
+    return None
+
+
+def get_price(model: Optional[str]) -> Optional[Price]:
+    """Price of a model: per token (input, output), a litellm model name, or None.
+
+    Model names that are not strings, e.g. None for rows without a model, have no price.
+    """
+    if not isinstance(model, str):
+        return None
+    try:
+        return _prices[model]
+    except KeyError:
+        pass
+    price = _resolve(model)
+    if len(_prices) < PRICE_CACHE_MAX_ENTRIES:
+        _prices[model] = price
+    return price
+
+
+def _cost(price: Optional[Price], prompt_tokens: int, completion_tokens: int) -> float:
+    if price is None:
+        return 0.0
+    if isinstance(price, str):
+        input_cost, output_cost = cost_per_token(price, prompt_tokens, completion_tokens)
+        return (input_cost + output_cost) * TOKEN_PRICE_MULTIPLIER
+    return (prompt_tokens * price[0] + completion_tokens * price[1]) * TOKEN_PRICE_MULTIPLIER
+
+
+def token_cost(prompt_tokens: int, completion_tokens: int, model: str) -> float:
+    """Cost of tokens of a model, TOKEN_PRICE_MULTIPLIER included."""
+    return _cost(get_price(model), prompt_tokens, completion_tokens)
+
+
+def cost_many(rows: Iterable[Tuple[Optional[int], Optional[int], Optional[str]]]) -> List[float]:
+    """Costs of (prompt_tokens, completion_tokens, model) rows, as token_cost.
+
+    Each model is looked up once. A row that cannot be priced, e.g. with token
+    counts that are not numbers or an unhashable model, costs 0.
+    """
+    prices: Dict[Optional[str], Optional[Price]] = {}
+    costs = []
+    for prompt_tokens, completion_tokens, model in rows:
+        try:
+            if model not in prices:
+                prices[model] = get_price(model)
+            costs.append(_cost(prices[model], int(prompt_tokens or 0), int(completion_tokens or 0)))
+        except Exception as e:
+            logger.warning(f"Could not price {prompt_tokens} / {completion_tokens} tokens of {model}: {str(e)}")
+            costs.append(0.0)
+    return costs
+
+
+_build()
@@ -0,0 +1,349 @@
+"""
+Process-wide multiplexing of Redis reads for agent run streams.
+
+Following an agent run used to take dedicated Redis connections for every
+viewer (two pub/sub connections, or a blocking XREAD), so a few dozen viewers
+could exhaust the connection pool of an API process.
+
+``PubSubMultiplexer`` holds a single pub/sub connection per process. A channel
+is subscribed while at least one local subscription needs it and its messages
+are fanned out to the buffers of those subscriptions. ``StreamMultiplexer``
+follows any number of Redis streams with a single blocking XREAD loop in the
+same way.
+
+A slow consumer never blocks the shared reader. Pub/sub subscriptions collapse
+identical pending messages, which are notifications. A stream subscription
+whose buffer is full stops receiving and catches up with XRANGE on its own
+before it rejoins the shared reader.
+"""
+
+import asyncio
+from collections import OrderedDict, deque
+from typing import Dict, Set, Tuple, Optional, List, Any
+
+from services import redis
+from utils.logger import logger
+
+# Time the shared pub/sub reader waits for a message before checking its state
+PUBSUB_READ_TIMEOUT = 1.0
+# Distinct messages kept for a subscription that is not reading them
+PUBSUB_MAX_PENDING = 64
+# Delay before reading again after a failed read
+READ_RETRY_DELAY = 1.0
+
+# Longest time the shared XREAD blocks, also bounds how long a newly joined
+# stream waits to be included in the read
+STREAM_READ_BLOCK_MS = 250
+# Entries read per stream and call
+STREAM_READ_COUNT = 500
+# Entries buffered for a subscription before it has to catch up on its own
+STREAM_MAX_BUFFERED = 2000
+
+
+class PubSubSubscription:
+    """Messages of a set of channels, received through the shared connection.
+
+    Yields (channel, data) tuples. ``data`` is None after the shared connection
+    had to be re-established, as messages may have been missed.
+    """
+
+    def __init__(self, multiplexer: "PubSubMultiplexer", channels: Tuple[str, ...]):
+        self.channels = channels
+        self.closed = False
+        self._multiplexer = multiplexer
+        self._pending: "OrderedDict[Tuple[str, Optional[str]], None]" = OrderedDict()
+        self._event = asyncio.Event()
+
+    def _deliver(self, channel: str, data: Optional[str]):
+        message = (channel, data)
+        if message in self._pending:
+            return
+        if len(self._pending) >= PUBSUB_MAX_PENDING:
+            dropped = self._pending.popitem(last=False)[0]
+            logger.warning(f"Pub/sub subscription to {self.channels} is not reading, dropped message {dropped}")
+        self._pending[message] = None
+        self._event.set()
+
+    async def get(self) -> Tuple[str, Optional[str]]:
+        """Wait for the next message."""
+        while not self._pending:
+            self._event.clear()
+            await self._event.wait()
+        return self._pending.popitem(last=False)[0]
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Tuple[str, Optional[str]]:
+        return await self.get()
+
+    async def close(self):
+        """Release the subscription, unsubscribing channels no longer needed."""
+        await self._multiplexer.unsubscribe(self)
+
+
+class PubSubMultiplexer:
+    """Shares one pub/sub connection between all subscriptions of the process."""
+
+    def __init__(self):
+        self._pubsub = None
+        self._reader: Optional[asyncio.Task] = None
+        self._subscriptions: Dict[str, Set[PubSubSubscription]] = {}
+        self._lock = asyncio.Lock()
+
+    @property
+    def channel_count(self) -> int:
+        return len(self._subscriptions)
+
+    async def subscribe(self, *channels: str) -> PubSubSubscription:
+        """Subscribe to channels, sharing the process-wide connection."""
+        subscription = PubSubSubscription(self, channels)
+        async with self._lock:
+            new_channels = [channel for channel in channels if channel not in self._subscriptions]
+            for channel in channels:
+                self._subscriptions.setdefault(channel, set()).add(subscription)
+            if new_channels:
+                try:
+                    if self._pubsub is None:
+                        self._pubsub = await redis.create_pubsub()
+                    await self._pubsub.subscribe(*new_channels)
+                except Exception:
+                    self._remove(subscription)
+                    raise
+            if self._reader is None or self._reader.done():
+                self._reader = asyncio.create_task(self._read_loop())
+        return subscription
+
+    async def unsubscribe(self, subscription: PubSubSubscription):
+        async with self._lock:
+            if subscription.closed:
+                return
+            unused = self._remove(subscription)
+            if unused and self._pubsub is not None:
+                try:
+                    await self._pubsub.unsubscribe(*unused)
+                except Exception as e:
+                    logger.warning(f"Failed to unsubscribe from {unused}: {str(e)}")
+
+    def _remove(self, subscription: PubSubSubscription) -> List[str]:
+        subscription.closed = True
+        unused = []
+        for channel in subscription.channels:
+            subscribers = self._subscriptions.get(channel)
+            if subscribers is None:
+                continue
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscriptions[channel]
+                unused.append(channel)
+        return unused
+
+    async def _read_loop(self):
+        # Stops when nothing is subscribed, subscribe() starts a new reader
+        while self._subscriptions:
+            try:
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=PUBSUB_READ_TIMEOUT)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # The connection re-subscribes when it reconnects, but messages may have been lost
+                logger.warning(f"Shared pub/sub reader failed, resynchronizing subscribers: {str(e)}")
+                await asyncio.sleep(READ_RETRY_DELAY)
+                for channel, subscribers in list(self._subscriptions.items()):
+                    for subscription in list(subscribers):
+                        subscription._deliver(channel, None)
+                continue
+
+            if not message or message.get("type") != "message":
+                continue
+            channel = message.get("channel")
+            data = message.get("data")
+            if isinstance(channel, bytes):
+                channel = channel.decode('utf-8')
+            if isinstance(data, bytes):
+                data = data.decode('utf-8')
+            for subscription in list(self._subscriptions.get(channel, ())):
+                subscription._deliver(channel, data)
+
+
+def _stream_id(entry_id: Optional[str]) -> Tuple[int, int]:
+    if not entry_id:
+        return (0, 0)
+    milliseconds, _, sequence = entry_id.partition('-')
+    return int(milliseconds), int(sequence or 0)
+
+
+class StreamSubscription:
+    """Entries of a Redis stream after a given id, received through the shared reader.
+
+    Yields (entry_id, fields) tuples in stream order, without gaps or duplicates.
+    """
+
+    def __init__(self, multiplexer: "StreamMultiplexer", key: str, after: Optional[str]):
+        self.key = key
+        self.closed = False
+        self._multiplexer = multiplexer
+        self._buffer: deque = deque()
+        # Id of the last entry received, delivery resumes after it
+        self._last_id = after
+        self._last = _stream_id(after)
+        # Detached from the shared reader, starts by catching up on its own
+        self._lagging = True
+        self._event = asyncio.Event()
+
+    def _accept(self, entries: List[Tuple[str, Dict[str, Any]]]):
+        for entry_id, fields in entries:
+            position = _stream_id(entry_id)
+            if position <= self._last:
+                continue
+            self._buffer.append((entry_id, fields))
+            self._last_id = entry_id
+            self._last = position
+
+    def _deliver(self, read_from: str, entries: List[Tuple[str, Dict[str, Any]]]):
+        # Only a read that started at or before our position is free of gaps, any
+        # other read is repeated from our position after a rewind
+        if self._lagging or _stream_id(read_from) > self._last:
+            return
+        self._accept(entries)
+        if len(self._buffer) >= STREAM_MAX_BUFFERED:
+            self._lagging = True
+            self._multiplexer._detach(self)
+        self._event.set()
+
+    async def _catch_up(self):
+        redis_client = await redis.get_client()
+        start = f"({self._last_id}" if self._last_id else "-"
+        entries = await redis_client.xrange(self.key, min=start, count=STREAM_READ_COUNT)
+        self._accept(entries)
+        if len(entries) < STREAM_READ_COUNT and not self.closed:
+            self._lagging = False
+            self._multiplexer._attach(self)
+
+    async def get(self) -> Tuple[str, Dict[str, Any]]:
+        """Wait for the next entry."""
+        while True:
+            if self._buffer:
+                return self._buffer.popleft()
+            if self._lagging:
+                await self._catch_up()
+                continue
+            self._event.clear()
+            await self._event.wait()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Tuple[str, Dict[str, Any]]:
+        return await self.get()
+
+    def close(self):
+        """Release the subscription."""
+        self._multiplexer.unsubscribe(self)
+
+
+class StreamMultiplexer:
+    """Follows every subscribed stream of the process with one blocking XREAD loop."""
+
+    def __init__(self):
+        self._reader: Optional[asyncio.Task] = None
+        self._subscriptions: Dict[str, Set[StreamSubscription]] = {}
+        # Stream key -> id the next read starts after, for streams with attached subscriptions
+        self._positions: Dict[str, str] = {}
+        self._attached: Dict[str, int] = {}
+        self._wakeup = asyncio.Event()
+
+    @property
+    def stream_count(self) -> int:
+        return len(self._subscriptions)
+
+    def subscribe(self, key: str, after: Optional[str] = None) -> StreamSubscription:
+        """Follow a stream from after the given id (from the start if None)."""
+        subscription = StreamSubscription(self, key, after)
+        self._subscriptions.setdefault(key, set()).add(subscription)
+        if self._reader is None or self._reader.done():
+            self._reader = asyncio.create_task(self._read_loop())
+        return subscription
+
+    def unsubscribe(self, subscription: StreamSubscription):
+        if subscription.closed:
+            return
+        subscription.closed = True
+        if not subscription._lagging:
+            self._detach(subscription)
+        subscribers = self._subscriptions.get(subscription.key)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscriptions[subscription.key]
+
+    def _attach(self, subscription: StreamSubscription):
+        key = subscription.key
+        position = subscription._last_id or "0-0"
+        current = self._positions.get(key)
+        # Rewinding makes the next read cover everything after the subscription's position
+        if current is None or _stream_id(position) < _stream_id(current):
+            self._positions[key] = position
+        self._attached[key] = self._attached.get(key, 0) + 1
+        self._wakeup.set()
+
+    def _detach(self, subscription: StreamSubscription):
+        key = subscription.key
+        remaining = self._attached.get(key, 0) - 1
+        if remaining > 0:
+            self._attached[key] = remaining
+        else:
+            self._attached.pop(key, None)
+            self._positions.pop(key, None)
+
+    async def _read_loop(self):
+        while self._subscriptions:
+            streams = dict(self._positions)
+            if not streams:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=PUBSUB_READ_TIMEOUT)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            try:
+                redis_client = await redis.get_client()
+                response = await redis_client.xread(streams, count=STREAM_READ_COUNT, block=STREAM_READ_BLOCK_MS)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Shared stream reader failed: {str(e)}")
+                await asyncio.sleep(READ_RETRY_DELAY)
+                continue
+
+            for key, entries in response or []:
+                if isinstance(key, bytes):
+                    key = key.decode('utf-8')
+                if not entries:
+                    continue
+                # Keep a rewind that happened during the read
+                if self._positions.get(key) == streams[key]:
+                    self._positions[key] = entries[-1][0]
+                for subscription in list(self._subscriptions.get(key, ())):
+                    subscription._deliver(streams[key], entries)
+
+
+_pubsub_multiplexer: Optional[PubSubMultiplexer] = None
+_stream_multiplexer: Optional[StreamMultiplexer] = None
+
+
+def get_pubsub_multiplexer() -> PubSubMultiplexer:
+    """Get the pub/sub multiplexer of this process."""
+    global _pubsub_multiplexer
+    if _pubsub_multiplexer is None:
+        _pubsub_multiplexer = PubSubMultiplexer()
+    return _pubsub_multiplexer
+
+
+def get_stream_multiplexer() -> StreamMultiplexer:
+    """Get the stream multiplexer of this process."""
+    global _stream_multiplexer
+    if _stream_multiplexer is None:
+        _stream_multiplexer = StreamMultiplexer()
+    return _stream_multiplexer
@@ -0,0 +1,121 @@
+"""
+Compression of stored agent run responses.
+
+Responses stay in Redis for ``REDIS_RESPONSE_LIST_TTL`` after their run has
+ended. Most of them are small JSON documents with the same structure, which
+zstd compresses well when given a dictionary of that structure.
+
+Compressed responses are stored as text (the Redis client decodes replies) in
+the form ``z<dictionary version>:<base64>``. A JSON document never starts with
+``z``, so readers handle both forms and responses stored before compression
+was enabled, or by writers that have it disabled, stay readable.
+
+"""
+
+import json
+import base64
+from functools import lru_cache
+from typing import Optional
+
+import zstandard
+
+from utils.config import config
+
+
+COMPRESSED_PREFIX = "z"
+COMPRESSION_LEVEL = 3
+# Responses shorter than this (UTF-8) are stored as is
+MIN_COMPRESSED_SIZE = 96
+DICTIONARY_VERSION = 1
+
+
+def _dictionary_v1() -> bytes:
+    """Raw content dictionary made of the JSON skeletons of streamed responses.
+
+    Stored responses are decompressed with the dictionary they were compressed
+    with until they expire: never change it, add a new version instead.
+    """
+    timestamp = "2025-01-01T00:00:00.000000+00:00"
+    run_id = "00000000-0000-0000-0000-000000000000"
+    samples = [
+        {"type": "status", "status": "completed", "message": "Agent run completed successfully"},
+        {"type": "status", "status": "error", "message": ""},
+        {
+            "message_id": run_id, "thread_id": run_id, "type": "tool", "is_llm_message": True,
+            "content": json.dumps({"role": "user", "content": "<tool_result> </tool_result>"}),
+            "metadata": json.dumps({"parsing_details": {}, "frontend_content": {}}),
+            "created_at": timestamp, "updated_at": timestamp,
+        },
+        {
+            "message_id": run_id, "thread_id": run_id, "type": "status", "is_llm_message": False,
+            "content": json.dumps({
+                "role": "assistant", "status_type": "tool_started", "function_name": "", "xml_tag_name": "",
+                "message": "Starting execution of ", "tool_index": 0,
+            }),
+            "metadata": json.dumps({"thread_run_id": run_id}),
+            "created_at": timestamp, "updated_at": timestamp,
+        },
+        {
+            "message_id": run_id, "thread_id": run_id, "type": "assistant", "is_llm_message": True,
+            "content": json.dumps({
+                "role": "assistant",
+                "content": '<function_calls>\n<invoke name="">\n<parameter name=""></parameter>\n</invoke>\n</function_calls>',
+            }),
+            "metadata": json.dumps({"stream_status": "complete", "thread_run_id": run_id}),
+            "created_at": timestamp, "updated_at": timestamp,
+        },
+        # The most frequent response comes last, zstd finds matches at the end sooner
+        {
+            "sequence": 0, "message_id": None, "thread_id": run_id, "type": "assistant", "is_llm_message": True,
+            "content": json.dumps({"role": "assistant", "content": ""}),
+            "metadata": json.dumps({"stream_status": "chunk", "thread_run_id": run_id}),
+            "created_at": timestamp, "updated_at": timestamp,
+        },
+    ]
+    return "".join(json.dumps(sample) for sample in samples).encode('utf-8')
+
+
+_DICTIONARIES = {
+    1: _dictionary_v1,
+}
+
+
+@lru_cache(maxsize=None)
+def _dictionary(version: int):
+    return zstandard.ZstdCompressionDict(_DICTIONARIES[version](), dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+
+
+@lru_cache(maxsize=None)
+def _decompressor(version: int):
+    return zstandard.ZstdDecompressor(dict_data=_dictionary(version))
+
+
+class ResponseCompressor:
+    """Compresses the responses of a run, counting the bytes before and after."""
+
+    def __init__(self):
+        self._compressor = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL, dict_data=_dictionary(DICTIONARY_VERSION))
+        self._prefix = f"{COMPRESSED_PREFIX}{DICTIONARY_VERSION}:"
+
+    def compress(self, payload: str) -> str:
+        """Get the form of a serialized response to store, compressed if that makes it smaller."""
+        raw = payload.encode('utf-8')
+        if len(raw) < MIN_COMPRESSED_SIZE:
+            return payload
+        compressed = self._prefix + base64.b64encode(self._compressor.compress(raw)).decode('ascii')
+        return compressed if len(compressed) < len(raw) else payload
+
+
+def decompress_response(stored: str) -> str:
+    """Get the serialized response from its stored form."""
+    if not stored.startswith(COMPRESSED_PREFIX):
+        return stored
+    version, _, data = stored[len(COMPRESSED_PREFIX):].partition(':')
+    return _decompressor(int(version)).decompress(base64.b64decode(data)).decode('utf-8')
+
+
+def get_response_compressor() -> Optional[ResponseCompressor]:
+    """Get a compressor for the responses of a run, None if compression is disabled."""
+    if not config.AGENT_RESPONSE_COMPRESSION:
+        return None
+    return ResponseCompressor()
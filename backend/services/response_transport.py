@@ -0,0 +1,306 @@
+"""
+Transport of agent run responses from the worker to stream viewers.
+
+``run_agent_background`` appends the serialized responses of a run and
+``stream_agent_run`` replays and follows them. Both go through a
+``ResponseTransport``, selected by ``config.AGENT_RESPONSE_TRANSPORT``:
+
+- ``list``: a Redis list per run plus a ``new`` notification on a pub/sub
+  channel. Viewers re-read the list from their last index on every
+  notification.
+- ``stream``: a Redis stream per run. Viewers follow it with a blocking
+  ``XREAD`` from the last id they have seen, so there is no notification
+  round trip. Control signals are appended to the stream as well.
+- ``dual``: writes both and reads the list. Used to migrate from ``list`` to
+  ``stream`` without breaking viewers of runs started before the switch:
+  deploy ``dual`` everywhere, wait for ``REDIS_RESPONSE_LIST_TTL``, then
+  switch to ``stream``.
+
+Viewers in an API process share its pub/sub connection and its blocking
+``XREAD`` (services/redis_multiplexer.py) instead of holding connections of
+their own.
+
+Positions in a run are opaque string cursors: the list index, or the stream
+entry id. They are sent to browsers as SSE event ids, which come back as
+``Last-Event-ID`` when a stream is resumed.
+"""
+
+import re
+import asyncio
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, List, Optional, Tuple
+
+from services import redis
+from services.redis_multiplexer import get_pubsub_multiplexer, get_stream_multiplexer
+from services.response_compression import decompress_response
+from utils.config import config
+from utils.logger import logger
+
+# Approximate cap of the number of entries kept in a response stream
+RESPONSE_STREAM_MAXLEN = 100_000
+
+CONTROL_SIGNALS = ("STOP", "END_STREAM", "ERROR")
+
+_STREAM_ID_PATTERN = re.compile(r"[0-9]+-[0-9]+")
+
+
+def response_list_key(agent_run_id: str) -> str:
+    return f"agent_run:{agent_run_id}:responses"
+
+
+def response_stream_key(agent_run_id: str) -> str:
+    return f"agent_run:{agent_run_id}:response_stream"
+
+
+def response_channel(agent_run_id: str) -> str:
+    return f"agent_run:{agent_run_id}:new_response"
+
+
+def control_channel(agent_run_id: str) -> str:
+    return f"agent_run:{agent_run_id}:control"
+
+
+class TransportEvent:
+    """A response (with its cursor) or a control signal received while following a run."""
+
+    __slots__ = ("kind", "cursor", "data")
+
+    RESPONSE = "response"
+    CONTROL = "control"
+
+    def __init__(self, kind: str, data: str, cursor: Optional[str] = None):
+        self.kind = kind
+        self.data = data
+        self.cursor = cursor
+
+    def __repr__(self):
+        return f"TransportEvent({self.kind!r}, {self.data[:40]!r}, cursor={self.cursor!r})"
+
+
+class ResponseTransport(ABC):
+    """Stores the responses of agent runs and delivers them to viewers."""
+
+    name: str = ""
+
+    @abstractmethod
+    async def append(self, agent_run_id: str, *payloads: str) -> None:
+        """Store serialized responses of a run, in order, and notify its viewers.
+
+        Payloads may be compressed by a ``ResponseCompressor``, they are
+        decompressed when read.
+        """
+
+    @abstractmethod
+    async def signal(self, agent_run_id: str, signal: str) -> None:
+        """Publish a control signal (STOP, END_STREAM, ERROR) for a run."""
+
+    @abstractmethod
+    async def read(self, agent_run_id: str, after: Optional[str] = None) -> List[Tuple[str, str]]:
+        """Get the stored responses after a cursor (all if None) as (cursor, payload) pairs."""
+
+    @abstractmethod
+    def listen(self, agent_run_id: str, after: Optional[str] = None) -> AsyncIterator[TransportEvent]:
+        """Follow a run: yield its responses after the cursor, then new ones as they arrive.
+
+        Ends after yielding a control event.
+        """
+
+    @abstractmethod
+    def is_valid_cursor(self, cursor: str) -> bool:
+        """Check a cursor received from a client, such as an SSE Last-Event-ID."""
+
+    @abstractmethod
+    async def expire(self, agent_run_id: str, seconds: int) -> None:
+        """Set the TTL of the stored responses of a run."""
+
+    @abstractmethod
+    async def delete(self, agent_run_id: str) -> None:
+        """Delete the stored responses of a run."""
+
+
+class ListResponseTransport(ResponseTransport):
+    """Redis list per run, with pub/sub notifications."""
+
+    name = "list"
+
+    async def append(self, agent_run_id: str, *payloads: str) -> None:
+        if not payloads:
+            return
+        redis_client = await redis.get_client()
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.rpush(response_list_key(agent_run_id), *payloads)
+            pipe.publish(response_channel(agent_run_id), "new")
+            await pipe.execute()
+
+    async def signal(self, agent_run_id: str, signal: str) -> None:
+        await redis.publish(control_channel(agent_run_id), signal)
+
+    async def read(self, agent_run_id: str, after: Optional[str] = None) -> List[Tuple[str, str]]:
+        start = int(after) + 1 if after is not None else 0
+        payloads = await redis.lrange(response_list_key(agent_run_id), start, -1)
+        return [(str(start + offset), decompress_response(payload)) for offset, payload in enumerate(payloads)]
+
+    async def listen(self, agent_run_id: str, after: Optional[str] = None) -> AsyncIterator[TransportEvent]:
+        channel = response_channel(agent_run_id)
+        subscription = await get_pubsub_multiplexer().subscribe(channel, control_channel(agent_run_id))
+        try:
+            # Catch up on anything appended before the subscription was active
+            for cursor, payload in await self.read(agent_run_id, after):
+                after = cursor
+                yield TransportEvent(TransportEvent.RESPONSE, payload, cursor)
+
+            async for message_channel, data in subscription:
+                # No data: the shared connection was re-established, re-read the list
+                if data is not None:
+                    if message_channel == channel:
+                        if data != "new":
+                            continue
+                    elif data not in CONTROL_SIGNALS:
+                        continue
+
+                # Read on control signals too, notifications may arrive after them
+                for cursor, payload in await self.read(agent_run_id, after):
+                    after = cursor
+                    yield TransportEvent(TransportEvent.RESPONSE, payload, cursor)
+                if data in CONTROL_SIGNALS:
+                    yield TransportEvent(TransportEvent.CONTROL, data)
+                    return
+        finally:
+            try:
+                await subscription.close()
+            except Exception as e:
+                logger.warning(f"Error closing subscription for agent run {agent_run_id}: {str(e)}")
+
+    def is_valid_cursor(self, cursor: str) -> bool:
+        return cursor.isascii() and cursor.isdigit()
+
+    async def expire(self, agent_run_id: str, seconds: int) -> None:
+        await redis.expire(response_list_key(agent_run_id), seconds)
+
+    async def delete(self, agent_run_id: str) -> None:
+        await redis.delete(response_list_key(agent_run_id))
+
+
+class StreamResponseTransport(ResponseTransport):
+    """Redis stream per run, followed with blocking reads.
+
+    Entries hold either a ``data`` field (a response) or a ``control`` field.
+    Control signals are also published on the control channel, which the
+    worker itself listens to for STOP.
+    """
+
+    name = "stream"
+
+    async def append(self, agent_run_id: str, *payloads: str) -> None:
+        if not payloads:
+            return
+        redis_client = await redis.get_client()
+        key = response_stream_key(agent_run_id)
+        if len(payloads) == 1:
+            await redis_client.xadd(key, {"data": payloads[0]}, maxlen=RESPONSE_STREAM_MAXLEN, approximate=True)
+            return
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for payload in payloads:
+                pipe.xadd(key, {"data": payload}, maxlen=RESPONSE_STREAM_MAXLEN, approximate=True)
+            await pipe.execute()
+
+    async def signal(self, agent_run_id: str, signal: str) -> None:
+        await self._append_control(agent_run_id, signal)
+        await redis.publish(control_channel(agent_run_id), signal)
+
+    async def _append_control(self, agent_run_id: str, signal: str) -> None:
+        redis_client = await redis.get_client()
+        await redis_client.xadd(response_stream_key(agent_run_id), {"control": signal}, maxlen=RESPONSE_STREAM_MAXLEN, approximate=True)
+
+    async def read(self, agent_run_id: str, after: Optional[str] = None) -> List[Tuple[str, str]]:
+        redis_client = await redis.get_client()
+        # Exclusive range start, supported since Redis 6.2
+        start = f"({after}" if after is not None else "-"
+        entries = await redis_client.xrange(response_stream_key(agent_run_id), min=start)
+        return [(entry_id, decompress_response(fields["data"])) for entry_id, fields in entries if "data" in fields]
+
+    async def listen(self, agent_run_id: str, after: Optional[str] = None) -> AsyncIterator[TransportEvent]:
+        subscription = get_stream_multiplexer().subscribe(response_stream_key(agent_run_id), after)
+        try:
+            async for entry_id, fields in subscription:
+                if "data" in fields:
+                    yield TransportEvent(TransportEvent.RESPONSE, decompress_response(fields["data"]), entry_id)
+                elif fields.get("control") in CONTROL_SIGNALS:
+                    yield TransportEvent(TransportEvent.CONTROL, fields["control"])
+                    return
+        finally:
+            subscription.close()
+
+    def is_valid_cursor(self, cursor: str) -> bool:
+        return _STREAM_ID_PATTERN.fullmatch(cursor) is not None
+
+    async def expire(self, agent_run_id: str, seconds: int) -> None:
+        await redis.expire(response_stream_key(agent_run_id), seconds)
+
+    async def delete(self, agent_run_id: str) -> None:
+        await redis.delete(response_stream_key(agent_run_id))
+
+
+class DualResponseTransport(ResponseTransport):
+    """Writes to both the list and the stream transport, reads from the list."""
+
+    name = "dual"
+
+    def __init__(self):
+        self.primary = ListResponseTransport()
+        self.secondary = StreamResponseTransport()
+
+    async def append(self, agent_run_id: str, *payloads: str) -> None:
+        await asyncio.gather(
+            self.primary.append(agent_run_id, *payloads),
+            self._secondary_write(self.secondary.append(agent_run_id, *payloads))
+        )
+
+    async def signal(self, agent_run_id: str, signal: str) -> None:
+        await self.primary.signal(agent_run_id, signal)
+        await self._secondary_write(self.secondary._append_control(agent_run_id, signal))
+
+    async def read(self, agent_run_id: str, after: Optional[str] = None) -> List[Tuple[str, str]]:
+        return await self.primary.read(agent_run_id, after)
+
+    def listen(self, agent_run_id: str, after: Optional[str] = None) -> AsyncIterator[TransportEvent]:
+        return self.primary.listen(agent_run_id, after)
+
+    def is_valid_cursor(self, cursor: str) -> bool:
+        return self.primary.is_valid_cursor(cursor)
+
+    async def expire(self, agent_run_id: str, seconds: int) -> None:
+        await asyncio.gather(self.primary.expire(agent_run_id, seconds), self.secondary.expire(agent_run_id, seconds))
+
+    async def delete(self, agent_run_id: str) -> None:
+        await asyncio.gather(self.primary.delete(agent_run_id), self.secondary.delete(agent_run_id))
+
+    @staticmethod
+    async def _secondary_write(operation):
+        # The stream is not read yet during the migration, it must not fail runs
+        try:
+            await operation
+        except Exception as e:
+            logger.warning(f"Failed to write agent run responses to Redis stream: {str(e)}")
+
+
+_TRANSPORTS = {
+    ListResponseTransport.name: ListResponseTransport,
+    StreamResponseTransport.name: StreamResponseTransport,
+    DualResponseTransport.name: DualResponseTransport,
+}
+
+_transport: Optional[ResponseTransport] = None
+
+
+def get_response_transport() -> ResponseTransport:
+    """Get the response transport selected by AGENT_RESPONSE_TRANSPORT."""
+    global _transport
+    if _transport is None:
+        name = (config.AGENT_RESPONSE_TRANSPORT or ListResponseTransport.name).lower()
+        if name not in _TRANSPORTS:
+            logger.warning(f"Unknown AGENT_RESPONSE_TRANSPORT '{name}', using '{ListResponseTransport.name}'")
+            name = ListResponseTransport.name
+        _transport = _TRANSPORTS[name]()
+        logger.debug(f"Using '{name}' agent response transport")
+    return _transport
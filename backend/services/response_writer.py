@@ -0,0 +1,126 @@
+"""
+Ordered, batched writes of the responses of an agent run.
+
+``ResponseWriter`` queues the serialized responses of a run and appends them
+through its response transport from a single task, one batch per round trip:
+everything queued while a batch is being written goes into the next one. A
+single writer keeps responses in order, and the queue is bounded, so a slow
+Redis slows the agent down instead of piling up write tasks. A batch that
+fails is retried before the next one is written; the responses of a batch
+that fails every attempt are logged one by one as lost.
+"""
+
+import asyncio
+from collections import deque
+from typing import Optional
+
+from services.response_compression import ResponseCompressor, decompress_response
+from services.response_transport import ResponseTransport
+from utils.logger import logger
+
+# Responses appended per round trip
+RESPONSE_WRITER_MAX_BATCH = 100
+# Responses queued before write() waits for the queue to drain
+RESPONSE_WRITER_MAX_PENDING = 1000
+# Attempts at writing a batch, and the delay before the first retry, doubled on each one
+RESPONSE_WRITER_MAX_ATTEMPTS = 3
+RESPONSE_WRITER_RETRY_DELAY = 0.2
+# Characters of each lost response that are logged
+LOST_RESPONSE_LOG_CHARS = 500
+
+
+class ResponseWriter:
+    """Writes the responses of one agent run, in order, in batches."""
+
+    def __init__(
+        self,
+        agent_run_id: str,
+        transport: ResponseTransport,
+        compressor: Optional[ResponseCompressor] = None,
+        max_batch: int = RESPONSE_WRITER_MAX_BATCH,
+        max_pending: int = RESPONSE_WRITER_MAX_PENDING
+    ):
+        self.agent_run_id = agent_run_id
+        self.transport = transport
+        self.compressor = compressor
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        # Responses written or lost, round trips, and UTF-8 sizes before and after compression
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+
+        self._pending: deque = deque()
+        self._in_flight = 0
+        self._not_full = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def write(self, payload: str):
+        """Queue a serialized response, waiting while the queue is full."""
+        while len(self._pending) >= self.max_pending:
+            self._not_full.clear()
+            await self._not_full.wait()
+
+        raw_size = len(payload.encode('utf-8'))
+        stored = self.compressor.compress(payload) if self.compressor else payload
+        self.raw_bytes += raw_size
+        # Compressed responses are ASCII
+        self.stored_bytes += raw_size if stored is payload else len(stored)
+        self._pending.append(stored)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._write_pending())
+
+    async def _write_pending(self):
+        while self._pending:
+            batch = [self._pending.popleft() for _ in range(min(len(self._pending), self.max_batch))]
+            self._not_full.set()
+            self._in_flight = len(batch)
+            try:
+                await self._append(batch)
+            finally:
+                self._in_flight = 0
+
+    async def _append(self, batch):
+        for attempt in range(RESPONSE_WRITER_MAX_ATTEMPTS):
+            if attempt:
+                await asyncio.sleep(RESPONSE_WRITER_RETRY_DELAY * 2 ** (attempt - 1))
+            try:
+                await self.transport.append(self.agent_run_id, *batch)
+                self.written += len(batch)
+                self.batches += 1
+                return
+            except Exception as e:
+                logger.warning(f"Failed to write {len(batch)} responses of agent run {self.agent_run_id} (attempt {attempt + 1}): {str(e)}")
+        self.failed += len(batch)
+        logger.error(f"Lost {len(batch)} responses of agent run {self.agent_run_id} after {RESPONSE_WRITER_MAX_ATTEMPTS} attempts")
+        for stored in batch:
+            self._log_lost(stored)
+
+    def _log_lost(self, stored: str):
+        try:
+            response = decompress_response(stored)
+        except Exception:
+            response = stored
+        logger.error(f"Lost response of agent run {self.agent_run_id}: {response[:LOST_RESPONSE_LOG_CHARS]}")
+
+    async def flush(self):
+        """Wait until every queued response has been written."""
+        while self._task is not None and not self._task.done():
+            # A cancelled caller must not cancel the writes of the run
+            await asyncio.shield(self._task)
+
+    async def close(self, timeout: float):
+        """Flush, giving up on the remaining responses after the timeout."""
+        try:
+            await asyncio.wait_for(self.flush(), timeout=timeout)
+        except asyncio.TimeoutError:
+            unwritten = len(self._pending) + self._in_flight
+            self.failed += unwritten
+            logger.warning(f"Timeout writing {unwritten} pending responses of agent run {self.agent_run_id}")
+            for stored in self._pending:
+                self._log_lost(stored)
+            self._pending.clear()
+            if self._task is not None:
+                self._task.cancel()
@@ -0,0 +1,295 @@
+"""
+Fair dispatch of agent runs to the workers.
+
+Every agent run used to be sent straight to the Dramatiq queue, so an account
+starting hundreds of runs from triggers or the API delayed every run queued
+after them. ``submit`` now holds runs in Redis and sends them to the workers
+in this order:
+
+- Priority lanes (``LANES``): interactive runs, runs started by triggers and
+  workflows, and batch runs started with an API key. Lanes share the workers
+  in proportion to ``LANE_WEIGHTS``, so no lane is starved.
+- Weighted fair queuing between the accounts with runs waiting in a lane,
+  each account weighted by its concurrency cap.
+- Concurrency caps: an account has at most ``MAX_PARALLEL_AGENT_RUNS`` runs
+  sent to the workers at once (see ``check_agent_run_limit``, unlimited in
+  local and staging mode), and all accounts together at most
+  ``AGENT_RUN_DISPATCH_CAPACITY`` (0 for no limit).
+
+A run takes a slot from the time it is sent until ``release`` is called when
+it ends, or until the worker has not called ``keep_alive`` for
+``INFLIGHT_TTL`` seconds. Runs are sent by whichever process holds the
+dispatch lock, when a run is submitted or released, and periodically by
+``dispatch_loop``.
+"""
+
+import json
+import time
+import uuid
+import asyncio
+from typing import Any, Dict, List, Optional, Tuple
+
+from services import redis
+from utils.config import config
+from utils.logger import logger
+
+LANES = ("interactive", "triggered", "batch")
+LANE_WEIGHTS = {"interactive": 16, "triggered": 4, "batch": 1}
+
+QUEUE_PREFIX = "agent_run_queue:"
+# Runs waiting or running: run -> {"account": ..., "lane": ...}
+RUNS_KEY = QUEUE_PREFIX + "runs"
+# Runs sent to the workers, scored by the time their slot expires
+INFLIGHT_KEY = QUEUE_PREFIX + "inflight"
+# Runs sent to the workers per account
+ACCOUNT_INFLIGHT_KEY = QUEUE_PREFIX + "account_inflight"
+# Concurrency cap per account, from its last submitted run
+CAPS_KEY = QUEUE_PREFIX + "caps"
+# Virtual times and start tags of the fair queuing, between lanes and per lane
+VTIME_KEY = QUEUE_PREFIX + "vtime"
+LOCK_KEY = QUEUE_PREFIX + "lock"
+# Set when a dispatch was requested while another process held the lock
+DIRTY_KEY = QUEUE_PREFIX + "dirty"
+
+# Seconds a run keeps its slot without keep_alive, frees the slots of crashed
+# workers. Three times the worker's ACTIVE_RUN_REFRESH_INTERVAL (60s).
+INFLIGHT_TTL = 180
+DISPATCH_LOCK_TTL_MS = 10_000
+DISPATCH_INTERVAL = 15
+# Accounts read per round trip when looking for one under its cap
+ACCOUNT_PAGE_SIZE = 50
+
+
+def _pending_key(lane: str, account_id: str) -> str:
+    return f"{QUEUE_PREFIX}pending:{lane}:{account_id}"
+
+
+def _accounts_key(lane: str) -> str:
+    """Accounts with runs waiting in a lane, scored by the virtual time of their next run."""
+    return f"{QUEUE_PREFIX}accounts:{lane}"
+
+
+def _send_run(run_kwargs: Dict[str, Any]):
+    # Imported here, the worker module imports this one
+    from run_agent_background import run_agent_background
+    run_agent_background.send(**run_kwargs)
+
+
+async def submit(account_id: str, lane: str, max_concurrent: int, **run_kwargs):
+    """Queue an agent run, sent to the workers once its lane and account get their turn.
+
+    Args:
+        account_id: Account the run is counted against
+        lane: One of LANES
+        max_concurrent: Runs of the account the workers may run at once
+        **run_kwargs: Arguments of run_agent_background, including agent_run_id
+    """
+    if lane not in LANE_WEIGHTS:
+        raise ValueError(f"Unknown agent run lane: {lane}")
+    agent_run_id = run_kwargs["agent_run_id"]
+    try:
+        redis_client = await redis.get_client()
+        lane_vtime = float(await redis_client.hget(VTIME_KEY, f"accounts:{lane}") or 0)
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.hset(RUNS_KEY, agent_run_id, json.dumps({"account": account_id, "lane": lane}))
+            pipe.hset(CAPS_KEY, account_id, max(1, max_concurrent))
+            pipe.rpush(_pending_key(lane, account_id), json.dumps(run_kwargs))
+            pipe.zadd(_accounts_key(lane), {account_id: lane_vtime}, nx=True)
+            await pipe.execute()
+    except Exception as e:
+        # Better unfair than lost
+        logger.warning(f"Failed to queue agent run {agent_run_id}, sending it directly: {str(e)}")
+        _send_run(run_kwargs)
+        return
+
+    logger.debug(f"Queued agent run {agent_run_id} of account {account_id} in lane {lane}")
+    await dispatch()
+
+
+async def keep_alive(agent_run_id: str):
+    """Extend the slot of a run that is still running."""
+    redis_client = await redis.get_client()
+    await redis_client.zadd(INFLIGHT_KEY, {agent_run_id: time.time() + INFLIGHT_TTL}, xx=True)
+
+
+async def release(agent_run_id: str):
+    """Remove a run from the dispatcher when it ends or is stopped, waiting or not."""
+    redis_client = await redis.get_client()
+    info = await redis_client.hget(RUNS_KEY, agent_run_id)
+    if info is None:
+        return
+    info = json.loads(info)
+    if not await _release_slot(redis_client, agent_run_id, info["account"]):
+        if not await _remove_pending(redis_client, agent_run_id, info["lane"], info["account"]):
+            # Being dispatched right now: it is released again when it ends
+            return
+    await redis_client.hdel(RUNS_KEY, agent_run_id)
+    await dispatch()
+
+
+async def _remove_pending(redis_client, agent_run_id: str, lane: str, account_id: str) -> bool:
+    """Drop a run that is still waiting from its queue, False if it was not there."""
+    pending_key = _pending_key(lane, account_id)
+    for message in await redis_client.lrange(pending_key, 0, -1):
+        if json.loads(message)["agent_run_id"] == agent_run_id:
+            return bool(await redis_client.lrem(pending_key, 1, message))
+    return False
+
+
+async def _release_slot(redis_client, agent_run_id: str, account_id: str) -> bool:
+    """Free the slot of a run sent to the workers, False if it had none."""
+    # Only the caller that removes the run frees its slot
+    if not await redis_client.zrem(INFLIGHT_KEY, agent_run_id):
+        return False
+    await redis_client.hincrby(ACCOUNT_INFLIGHT_KEY, account_id, -1)
+    return True
+
+
+async def dispatch() -> int:
+    """Send the runs that can run now to the workers. Returns the number of runs sent."""
+    redis_client = await redis.get_client()
+    sent = 0
+    while True:
+        token = uuid.uuid4().hex
+        if not await redis_client.set(LOCK_KEY, token, nx=True, px=DISPATCH_LOCK_TTL_MS):
+            # Ask the holder of the lock to dispatch again once it is done, in
+            # case it read the queues before our change. It may have released
+            # the lock before seeing the flag, so try once more.
+            await redis_client.set(DIRTY_KEY, 1)
+            if not await redis_client.set(LOCK_KEY, token, nx=True, px=DISPATCH_LOCK_TTL_MS):
+                return sent
+        try:
+            await redis_client.delete(DIRTY_KEY)
+            sent += await _dispatch_locked(redis_client)
+        finally:
+            if await redis_client.get(LOCK_KEY) == token:
+                await redis_client.delete(LOCK_KEY)
+        if not await redis_client.exists(DIRTY_KEY):
+            return sent
+
+
+async def _next_account(redis_client, lane: str) -> Optional[Tuple[str, float, int]]:
+    """The account with the lowest virtual time in a lane that is under its cap."""
+    accounts_key = _accounts_key(lane)
+    start = 0
+    while True:
+        page: List[Tuple[str, float]] = await redis_client.zrange(
+            accounts_key, start, start + ACCOUNT_PAGE_SIZE - 1, withscores=True
+        )
+        if not page:
+            return None
+        account_ids = [account_id for account_id, _ in page]
+        caps = await redis_client.hmget(CAPS_KEY, account_ids)
+        inflight = await redis_client.hmget(ACCOUNT_INFLIGHT_KEY, account_ids)
+        for (account_id, vtime), cap, running in zip(page, caps, inflight):
+            cap = int(cap or 1)
+            if int(running or 0) < cap:
+                return account_id, vtime, cap
+        start += ACCOUNT_PAGE_SIZE
+
+
+async def _drop_account_if_idle(redis_client, lane: str, account_id: str, vtime: float):
+    """Remove an account without runs waiting from a lane."""
+    await redis_client.zrem(_accounts_key(lane), account_id)
+    # A run submitted before the removal would not have added the account back
+    if await redis_client.llen(_pending_key(lane, account_id)):
+        await redis_client.zadd(_accounts_key(lane), {account_id: vtime}, nx=True)
+
+
+async def _dispatch_locked(redis_client) -> int:
+    now = time.time()
+    # Free the slots of runs whose worker stopped keeping them alive
+    for agent_run_id in await redis_client.zrangebyscore(INFLIGHT_KEY, "-inf", now):
+        info = await redis_client.hget(RUNS_KEY, agent_run_id)
+        if info is not None:
+            logger.warning(f"Agent run {agent_run_id} was not kept alive, freeing its slot")
+            await _release_slot(redis_client, agent_run_id, json.loads(info)["account"])
+            await redis_client.hdel(RUNS_KEY, agent_run_id)
+        else:
+            await redis_client.zrem(INFLIGHT_KEY, agent_run_id)
+
+    capacity = config.AGENT_RUN_DISPATCH_CAPACITY
+    inflight = await redis_client.zcard(INFLIGHT_KEY)
+    # Start-time fair queuing, between lanes and between the accounts of a
+    # lane: the lane or account with the lowest start tag is served next, and
+    # its next start tag is 1 / weight later. Tags are raised to the virtual
+    # time (the tag last served) when served, so a lane or account that was
+    # idle or at its cap gets no credit for that time.
+    vtimes = await redis_client.hgetall(VTIME_KEY)
+    lanes_vtime = float(vtimes.get("lanes", 0))
+    lane_tags = {lane: float(vtimes.get(f"lane:{lane}", 0)) for lane in LANES}
+    account_vtimes = {lane: float(vtimes.get(f"accounts:{lane}", 0)) for lane in LANES}
+    blocked = set()
+    sent = 0
+
+    while not capacity or inflight < capacity:
+        lanes = [lane for lane in LANES if lane not in blocked]
+        if not lanes:
+            break
+        lane = min(lanes, key=lambda lane: (max(lane_tags[lane], lanes_vtime), LANES.index(lane)))
+        candidate = await _next_account(redis_client, lane)
+        if candidate is None:
+            # Empty, or every account in it is at its cap
+            blocked.add(lane)
+            continue
+        account_id, account_tag, cap = candidate
+
+        pending_key = _pending_key(lane, account_id)
+        message = await redis_client.lpop(pending_key)
+        if message is None:
+            await _drop_account_if_idle(redis_client, lane, account_id, account_tag)
+            continue
+        run_kwargs = json.loads(message)
+        agent_run_id = run_kwargs["agent_run_id"]
+
+        lanes_vtime = max(lane_tags[lane], lanes_vtime)
+        lane_tags[lane] = lanes_vtime + 1 / LANE_WEIGHTS[lane]
+        account_vtimes[lane] = max(account_tag, account_vtimes[lane])
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.zadd(INFLIGHT_KEY, {agent_run_id: now + INFLIGHT_TTL})
+            pipe.hincrby(ACCOUNT_INFLIGHT_KEY, account_id, 1)
+            # An account is weighted by its cap
+            pipe.zadd(_accounts_key(lane), {account_id: account_vtimes[lane] + 1 / cap}, xx=True)
+            pipe.hset(VTIME_KEY, mapping={
+                "lanes": lanes_vtime, f"lane:{lane}": lane_tags[lane], f"accounts:{lane}": account_vtimes[lane]
+            })
+            await pipe.execute()
+        if not await redis_client.llen(pending_key):
+            await _drop_account_if_idle(redis_client, lane, account_id, account_vtimes[lane])
+
+        try:
+            _send_run(run_kwargs)
+        except Exception as e:
+            # Put it back first in line and retry on the next dispatch
+            logger.error(f"Failed to send agent run {agent_run_id} to the workers: {str(e)}")
+            await _release_slot(redis_client, agent_run_id, account_id)
+            await redis_client.lpush(pending_key, message)
+            await redis_client.zadd(_accounts_key(lane), {account_id: account_vtimes[lane]})
+            break
+        logger.debug(f"Dispatched agent run {agent_run_id} of account {account_id} from lane {lane}")
+        inflight += 1
+        sent += 1
+    return sent
+
+
+async def get_stats() -> Dict[str, Any]:
+    """Runs sent to the workers, and accounts with runs waiting per lane."""
+    redis_client = await redis.get_client()
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.zcard(INFLIGHT_KEY)
+        for lane in LANES:
+            pipe.zcard(_accounts_key(lane))
+        inflight, *accounts = await pipe.execute()
+    return {"inflight": inflight, "waiting_accounts": dict(zip(LANES, accounts))}
+
+
+async def dispatch_loop():
+    """Dispatch every DISPATCH_INTERVAL seconds, for slots freed by expiry."""
+    while True:
+        try:
+            await dispatch()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Failed to dispatch agent runs: {str(e)}")
+        await asyncio.sleep(DISPATCH_INTERVAL)
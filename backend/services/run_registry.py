@@ -0,0 +1,121 @@
+"""
+Registry of the agent runs that are running, and of the instance running them.
+
+Replaces the ``active_run:{instance_id}:{agent_run_id}`` keys, which could
+only be found with KEYS, a command that blocks Redis for the whole keyspace.
+
+- ``active_runs:instance:{instance_id}``: sorted set of the runs of an
+  instance, scored by the time their registration expires
+- ``active_runs:owners``: hash of each run to its instance
+- ``active_runs:instances``: sorted set of the instances, scored by the time
+  the registration of their last run expires
+
+Registrations expire unless refreshed, like the keys they replace, and
+lookups ignore expired runs. ``reap_loop`` periodically removes them, and
+the instances left without any run, such as instances that died.
+"""
+
+import time
+import asyncio
+from typing import List, Optional
+
+from redis.exceptions import WatchError
+
+from services import redis
+from utils.logger import logger
+
+RUN_REGISTRY_OWNERS_KEY = "active_runs:owners"
+RUN_REGISTRY_INSTANCES_KEY = "active_runs:instances"
+# Seconds between two reaps of expired registrations
+RUN_REGISTRY_REAP_INTERVAL = 60
+# Instances listed per round trip while reaping
+RUN_REGISTRY_REAP_BATCH = 100
+
+
+def instance_runs_key(instance_id: str) -> str:
+    return f"active_runs:instance:{instance_id}"
+
+
+async def register_run(instance_id: str, agent_run_id: str, ttl: int = redis.REDIS_KEY_TTL):
+    """Register a run as running on an instance for ttl seconds, or refresh its registration."""
+    expires_at = time.time() + ttl
+    redis_client = await redis.get_client()
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.zadd(instance_runs_key(instance_id), {agent_run_id: expires_at})
+        pipe.hset(RUN_REGISTRY_OWNERS_KEY, agent_run_id, instance_id)
+        pipe.zadd(RUN_REGISTRY_INSTANCES_KEY, {instance_id: expires_at}, gt=True)
+        await pipe.execute()
+
+
+async def unregister_run(instance_id: str, agent_run_id: str):
+    """Remove the registration of a run that has ended."""
+    redis_client = await redis.get_client()
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.zrem(instance_runs_key(instance_id), agent_run_id)
+        pipe.hdel(RUN_REGISTRY_OWNERS_KEY, agent_run_id)
+        await pipe.execute()
+
+
+async def get_run_instance(agent_run_id: str) -> Optional[str]:
+    """Get the instance a run is registered on, None if it is not registered."""
+    redis_client = await redis.get_client()
+    instance_id = await redis_client.hget(RUN_REGISTRY_OWNERS_KEY, agent_run_id)
+    if instance_id is None:
+        return None
+    expires_at = await redis_client.zscore(instance_runs_key(instance_id), agent_run_id)
+    return instance_id if expires_at is not None and expires_at > time.time() else None
+
+
+async def get_instance_runs(instance_id: str) -> List[str]:
+    """Get the runs registered on an instance whose registration has not expired."""
+    redis_client = await redis.get_client()
+    return await redis_client.zrangebyscore(instance_runs_key(instance_id), time.time(), "+inf")
+
+
+async def _reap_instance(instance_id: str, now: float) -> int:
+    """Remove the expired runs of an instance, and the instance if it has none left."""
+    key = instance_runs_key(instance_id)
+    redis_client = await redis.get_client()
+    async with redis_client.pipeline(transaction=True) as pipe:
+        # Registered again while being reaped: leave it to the next reap
+        await pipe.watch(key)
+        expired = await pipe.zrangebyscore(key, "-inf", now)
+        remaining = await pipe.zcard(key) - len(expired)
+        pipe.multi()
+        if expired:
+            pipe.zrem(key, *expired)
+            pipe.hdel(RUN_REGISTRY_OWNERS_KEY, *expired)
+        if remaining == 0:
+            pipe.zrem(RUN_REGISTRY_INSTANCES_KEY, instance_id)
+        await pipe.execute()
+    return len(expired)
+
+
+async def reap_expired() -> int:
+    """Remove the expired registrations of every instance, and the instances left without any.
+
+    Returns the number of runs removed.
+    """
+    now = time.time()
+    redis_client = await redis.get_client()
+    reaped = 0
+    async for instance_id, _ in redis_client.zscan_iter(RUN_REGISTRY_INSTANCES_KEY, count=RUN_REGISTRY_REAP_BATCH):
+        try:
+            reaped += await _reap_instance(instance_id, now)
+        except WatchError:
+            logger.debug(f"Instance {instance_id} registered a run while being reaped")
+    return reaped
+
+
+async def reap_loop():
+    """Reap expired registrations every RUN_REGISTRY_REAP_INTERVAL seconds."""
+    while True:
+        try:
+            reaped = await reap_expired()
+            if reaped:
+                logger.info(f"Reaped {reaped} expired agent run registrations")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Failed to reap expired agent run registrations: {str(e)}")
+        await asyncio.sleep(RUN_REGISTRY_REAP_INTERVAL)
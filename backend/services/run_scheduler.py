@@ -0,0 +1,186 @@
+"""
+Admission control of the agent runs of a worker process.
+
+Dramatiq runs the coroutines of every worker thread of a process on a single
+event loop, so the runs of a process share its CPU time and memory. The
+``RunScheduler`` admits a run only while the process has fewer than
+``WORKER_MAX_CONCURRENT_RUNS`` active, the event loop is not lagging behind
+by more than ``WORKER_MAX_LOOP_LAG_MS`` and its memory is under
+``WORKER_MAX_MEMORY_MB``. A run that cannot be admitted waits for up to
+``WORKER_ADMISSION_WAIT_SECONDS``, after which the actor requeues it so that
+a less busy process can pick it up. A run holds a Dramatiq thread while it
+waits, so ``WORKER_MAX_CONCURRENT_RUNS`` must be below the threads of the
+process for the limit to take effect.
+
+The state of the scheduler is exported as Prometheus metrics, served by each
+worker process when ``WORKER_METRICS_PORT`` is set.
+"""
+
+import os
+import time
+import asyncio
+from typing import Optional
+
+from prometheus_client import Counter, Gauge, start_http_server
+
+from utils.config import config
+from utils.logger import logger
+
+# Seconds between two measurements of the event loop lag
+LOOP_LAG_INTERVAL = 0.25
+# Weight of past measurements in the reported loop lag, a spike decays over a few seconds
+LOOP_LAG_DECAY = 0.8
+# Ports tried after WORKER_METRICS_PORT, one per worker process
+METRICS_PORT_ATTEMPTS = 64
+
+RUNS_QUEUED = Gauge("agent_worker_runs_queued", "Agent runs waiting to be admitted by this worker process")
+RUNS_ACTIVE = Gauge("agent_worker_runs_active", "Agent runs running in this worker process")
+RUNS_COMPLETED = Counter("agent_worker_runs_completed_total", "Agent runs that ended in this worker process")
+RUNS_NOT_ADMITTED = Counter(
+    "agent_worker_runs_not_admitted_total",
+    "Agent runs this worker process was too busy to admit, by reason (runs, loop_lag, memory)",
+    ["reason"],
+)
+LOOP_LAG = Gauge("agent_worker_loop_lag_seconds", "Event loop lag of this worker process")
+MEMORY = Gauge("agent_worker_memory_bytes", "Resident memory of this worker process")
+
+
+def _memory_usage() -> Optional[int]:
+    """Resident memory of this process in bytes, None where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class RunScheduler:
+    """Admits the agent runs of a worker process, within its concurrency limit and resources."""
+
+    def __init__(
+        self,
+        max_runs: int,
+        max_loop_lag_ms: int,
+        max_memory_mb: int,
+        admission_wait: float
+    ):
+        self.max_runs = max_runs
+        self.max_loop_lag = max_loop_lag_ms / 1000
+        self.max_memory = max_memory_mb * 1024 * 1024 if max_memory_mb else None
+        self.admission_wait = admission_wait
+        self.active = 0
+        self.queued = 0
+        self.loop_lag = 0.0
+
+        self._changed: Optional[asyncio.Condition] = None
+        self._monitor: Optional[asyncio.Task] = None
+
+    def _ensure_started(self):
+        if self._monitor is None or self._monitor.done():
+            self._changed = asyncio.Condition()
+            self._monitor = asyncio.create_task(self._monitor_loop())
+
+    async def _monitor_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            lag = max(0.0, loop.time() - started - LOOP_LAG_INTERVAL)
+            self.loop_lag = max(lag, self.loop_lag * LOOP_LAG_DECAY)
+            LOOP_LAG.set(self.loop_lag)
+            memory = _memory_usage()
+            if memory is not None:
+                MEMORY.set(memory)
+            # Waiting runs may be admitted now that the lag or memory went down
+            if self.queued:
+                async with self._changed:
+                    self._changed.notify_all()
+
+    def _refusal(self) -> Optional[str]:
+        """Why a run cannot be admitted right now, None if it can."""
+        if self.active >= self.max_runs:
+            return "runs"
+        # An idle process admits a run whatever its resources, or nothing would run
+        if self.active == 0:
+            return None
+        if self.loop_lag > self.max_loop_lag:
+            return "loop_lag"
+        if self.max_memory is not None:
+            memory = _memory_usage()
+            if memory is not None and memory > self.max_memory:
+                return "memory"
+        return None
+
+    async def admit(self, agent_run_id: str) -> bool:
+        """Admit a run, waiting up to admission_wait seconds for the process to have room.
+
+        Returns False if the run was not admitted. An admitted run must be
+        released once it has ended.
+        """
+        self._ensure_started()
+        deadline = time.monotonic() + self.admission_wait
+        self.queued += 1
+        RUNS_QUEUED.inc()
+        try:
+            async with self._changed:
+                while (reason := self._refusal()) is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        RUNS_NOT_ADMITTED.labels(reason=reason).inc()
+                        logger.info(
+                            f"Worker too busy to admit agent run {agent_run_id} ({reason}): "
+                            f"{self.active} active runs, loop lag {self.loop_lag * 1000:.0f} ms"
+                        )
+                        return False
+                    try:
+                        await asyncio.wait_for(self._changed.wait(), timeout=remaining)
+                    except asyncio.TimeoutError:
+                        pass
+                self.active += 1
+                RUNS_ACTIVE.inc()
+                return True
+        finally:
+            self.queued -= 1
+            RUNS_QUEUED.dec()
+
+    async def release(self):
+        """Release the slot of a run that has ended."""
+        self.active -= 1
+        RUNS_ACTIVE.dec()
+        RUNS_COMPLETED.inc()
+        async with self._changed:
+            self._changed.notify(1)
+
+
+_run_scheduler: Optional[RunScheduler] = None
+
+
+def get_run_scheduler() -> RunScheduler:
+    """Get the run scheduler of this worker process."""
+    global _run_scheduler
+    if _run_scheduler is None:
+        _run_scheduler = RunScheduler(
+            max_runs=config.WORKER_MAX_CONCURRENT_RUNS,
+            max_loop_lag_ms=config.WORKER_MAX_LOOP_LAG_MS,
+            max_memory_mb=config.WORKER_MAX_MEMORY_MB,
+            admission_wait=config.WORKER_ADMISSION_WAIT_SECONDS,
+        )
+    return _run_scheduler
+
+
+def start_metrics_server() -> Optional[int]:
+    """Serve the metrics of this process on the first free port from WORKER_METRICS_PORT.
+
+    Returns the port, None if metrics are disabled or no port was free.
+    """
+    if not config.WORKER_METRICS_PORT:
+        return None
+    for port in range(config.WORKER_METRICS_PORT, config.WORKER_METRICS_PORT + METRICS_PORT_ATTEMPTS):
+        try:
+            start_http_server(port)
+        except OSError:
+            continue
+        logger.info(f"Serving worker metrics on port {port}")
+        return port
+    logger.warning(f"No free port to serve worker metrics from {config.WORKER_METRICS_PORT}")
+    return None
@@ -0,0 +1,192 @@
+"""
+Monthly usage counters of the accounts.
+
+The usage of an account for the current month used to be computed on every
+billing check by paging through its messages and pricing each of them again.
+The usage ledger now adds the cost of the usage it bills to a counter per
+account and month, in Redis, and billing checks read the counter:
+
+- ``usage_counters:{month}``: hash of each account to its cost this month
+- ``usage_counters:{month}:built``: set of the accounts whose counter was
+  built from their history this month
+
+A counter is only read once it was built: the first read of an account in a
+month computes its usage from its messages with ``compute`` and adds the
+difference to the counter, which keeps the usage added meanwhile. Messages
+whose usage event is still in the ledger stream are counted when the event
+is billed, so the cost of those events is left out of the computed usage.
+``reconcile_loop`` periodically rebuilds the counters of the month the same
+way, which corrects the usage counted twice or missed by the ledger. A
+reconciliation stops after ``USAGE_RECONCILE_MAX_SECONDS`` and the next one
+resumes where it stopped.
+"""
+
+import time
+import asyncio
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from services import redis
+from services.supabase import DBConnection
+from utils.logger import logger
+
+USAGE_COUNTERS_PREFIX = "usage_counters:"
+# Counters are kept for a while after their month, for reference
+USAGE_COUNTERS_TTL = 62 * 24 * 60 * 60
+# Seconds between two reconciliations of the counters of the month, run by one process
+USAGE_RECONCILE_INTERVAL = 6 * 60 * 60
+USAGE_RECONCILE_LOCK_KEY = USAGE_COUNTERS_PREFIX + "reconcile_lock"
+# Pause between the accounts of a reconciliation, spreads its database load
+USAGE_RECONCILE_ACCOUNT_DELAY = 0.2
+# Longest run of a reconciliation, well within the lock so that runs never overlap
+USAGE_RECONCILE_MAX_SECONDS = USAGE_RECONCILE_INTERVAL // 2
+
+# Rebuilds in progress in this process per account, concurrent reads share one
+_rebuilds: Dict[str, asyncio.Future] = {}
+
+
+def current_month() -> str:
+    """Month usage is counted in, in UTC, e.g. 2025-08."""
+    return datetime.now(timezone.utc).strftime("%Y-%m")
+
+
+def month_of(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m")
+
+
+def _counters_key(month: str) -> str:
+    return f"{USAGE_COUNTERS_PREFIX}{month}"
+
+
+def _built_key(month: str) -> str:
+    return f"{USAGE_COUNTERS_PREFIX}{month}:built"
+
+
+def _reconcile_progress_key(month: str) -> str:
+    return f"{USAGE_COUNTERS_PREFIX}{month}:reconciled_until"
+
+
+def queue_usage(pipe, costs: Dict[Tuple[str, str], float]):
+    """Queue the commands adding costs to the counters, keyed by (account_id, month), on a pipeline."""
+    for (account_id, month), cost in costs.items():
+        pipe.hincrbyfloat(_counters_key(month), account_id, cost)
+    for month in {month for _, month in costs}:
+        pipe.expire(_counters_key(month), USAGE_COUNTERS_TTL)
+
+
+async def add_usage(costs: Dict[Tuple[str, str], float]):
+    """Add costs to the counters, keyed by (account_id, month)."""
+    if not costs:
+        return
+    redis_client = await redis.get_client()
+    async with redis_client.pipeline(transaction=False) as pipe:
+        queue_usage(pipe, costs)
+        await pipe.execute()
+
+
+async def get_monthly_usage(account_id: str) -> Optional[float]:
+    """Usage of an account this month from its counter, None if the counter was not built."""
+    month = current_month()
+    redis_client = await redis.get_client()
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.sismember(_built_key(month), account_id)
+        pipe.hget(_counters_key(month), account_id)
+        built, usage = await pipe.execute()
+    if not built:
+        return None
+    return float(usage or 0)
+
+
+async def _rebuild(account_id: str, compute: Callable[[], Awaitable[float]]) -> float:
+    # Imported here, the usage ledger adds to the counters of this module
+    from services import usage_ledger
+    month = current_month()
+    redis_client = await redis.get_client()
+    usage = await compute()
+    # The ledger counts an event and removes it from the stream atomically, so this
+    # snapshot holds each billed message either in the counter or in the stream
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hget(_counters_key(month), account_id)
+        pipe.xrange(usage_ledger.USAGE_STREAM_KEY)
+        counted, pending_entries = await pipe.execute()
+    usage -= await usage_ledger.pending_cost(pending_entries, account_id, month)
+    counted = float(counted or 0)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        # Usage the ledger adds after the snapshot is added on top
+        pipe.hincrbyfloat(_counters_key(month), account_id, usage - counted)
+        pipe.sadd(_built_key(month), account_id)
+        pipe.expire(_counters_key(month), USAGE_COUNTERS_TTL)
+        pipe.expire(_built_key(month), USAGE_COUNTERS_TTL)
+        rebuilt, *_ = await pipe.execute()
+    if abs(usage - counted) > 0.01:
+        logger.debug(f"Usage counter of {account_id} for {month} corrected by {usage - counted:+.4f}")
+    return float(rebuilt)
+
+
+async def rebuild(account_id: str, compute: Callable[[], Awaitable[float]]) -> float:
+    """Build the counter of an account for this month from its usage computed by compute.
+
+    Returns the usage of the account this month.
+    """
+    future = _rebuilds.get(account_id)
+    if future is None:
+        future = asyncio.ensure_future(_rebuild(account_id, compute))
+        _rebuilds[account_id] = future
+        future.add_done_callback(lambda _: _rebuilds.pop(account_id, None))
+    # Callers that give up must not cancel the rebuild for the others
+    return await asyncio.shield(future)
+
+
+async def reconcile(max_seconds: float = USAGE_RECONCILE_MAX_SECONDS) -> int:
+    """Rebuild the counters of the accounts built this month, for up to max_seconds.
+
+    Resumes from where the previous reconciliation stopped. Returns the number rebuilt.
+    """
+    # Imported here, billing reads the counters of this module
+    from services.billing import calculate_usage_from_logs
+    client = await DBConnection().client
+    redis_client = await redis.get_client()
+    month = current_month()
+    deadline = time.monotonic() + max_seconds
+    # Accounts are reconciled in order, after the last one of an interrupted run
+    reconciled_until = await redis_client.get(_reconcile_progress_key(month)) or ""
+    account_ids = sorted([account_id async for account_id in redis_client.sscan_iter(_built_key(month))])
+    account_ids = [account_id for account_id in account_ids if account_id > reconciled_until]
+    reconciled = 0
+    for account_id in account_ids:
+        if time.monotonic() >= deadline:
+            await redis_client.set(_reconcile_progress_key(month), reconciled_until, ex=USAGE_COUNTERS_TTL)
+            logger.warning(f"Reconciliation of the usage counters stopped after {max_seconds:.0f}s, the next one resumes it")
+            break
+        try:
+            # Rebuilds are shared, a timeout leaves this one running for its other readers
+            await asyncio.wait_for(
+                rebuild(account_id, lambda: calculate_usage_from_logs(client, account_id)),
+                timeout=deadline - time.monotonic()
+            )
+            reconciled += 1
+        except asyncio.TimeoutError:
+            logger.warning(f"Reconciliation timed out on the usage counter of {account_id}")
+        except Exception as e:
+            logger.warning(f"Failed to reconcile the usage counter of {account_id}: {str(e)}")
+        reconciled_until = account_id
+        await asyncio.sleep(USAGE_RECONCILE_ACCOUNT_DELAY)
+    else:
+        await redis_client.delete(_reconcile_progress_key(month))
+    return reconciled
+
+
+async def reconcile_loop():
+    """Reconcile the counters every USAGE_RECONCILE_INTERVAL seconds, in one process at a time."""
+    while True:
+        try:
+            # The lock expires with the interval, whichever process takes it next runs the next one.
+            # Runs stop within USAGE_RECONCILE_MAX_SECONDS, so two never overlap
+            if await redis.set(USAGE_RECONCILE_LOCK_KEY, "1", ex=USAGE_RECONCILE_INTERVAL, nx=True):
+                reconciled = await reconcile()
+                logger.info(f"Reconciled {reconciled} monthly usage counters")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Failed to reconcile monthly usage counters: {str(e)}")
+        await asyncio.sleep(USAGE_RECONCILE_INTERVAL / 6)
@@ -0,0 +1,276 @@
+"""
+Asynchronous usage ledger.
+
+Billing an ``assistant_response_end`` used to happen inline in
+``ThreadManager.add_message``: cost calculation, an account lookup and
+``handle_usage_with_credits`` on every turn. Instead, usage events are appended
+to a Redis stream and billed by the ``process_usage_ledger`` worker actor,
+which reads them in micro-batches and resolves accounts through the cache.
+Each event is billed with ``handle_usage_with_credits`` under its own message,
+and its cost is then added to the monthly usage counters of
+``services.usage_counters`` in the same transaction that acknowledges it, so
+the events still in the stream are exactly those not counted yet.
+
+Delivery is at-least-once: an event is acknowledged only once it was billed.
+Credit deductions are idempotent per message (see ``use_credits``), so an
+event billed again after a failure is not charged twice.
+Events that failed to bill, or left pending by a crashed consumer, are
+reclaimed by the next drain; ``reclaim_loop`` schedules one while any are
+pending.
+"""
+
+import os
+import json
+import time
+import socket
+import asyncio
+from typing import List, Dict, Any, Optional, Tuple
+
+from services import redis, usage_counters
+from services.supabase import DBConnection
+from services.billing import calculate_token_cost, handle_usage_with_credits
+from utils.cache import cached
+from utils.logger import logger
+
+USAGE_STREAM_KEY = "usage_ledger:events"
+USAGE_CONSUMER_GROUP = "usage_ledger"
+# Approximate cap of the stream length; acknowledged events are trimmed away
+USAGE_STREAM_MAXLEN = 100_000
+# Number of events billed together
+USAGE_BATCH_SIZE = 200
+# Delay before a scheduled drain runs, lets events of concurrent runs pile up
+USAGE_DRAIN_DELAY_MS = 1000
+# Guards against scheduling more than one pending drain
+USAGE_DRAIN_SCHEDULED_KEY = "usage_ledger:drain_scheduled"
+USAGE_DRAIN_SCHEDULED_TTL = 60
+# Pending events idle for longer than this are reclaimed from dead consumers
+# and retried when they failed to bill
+USAGE_CLAIM_IDLE_MS = 60_000
+# Seconds between two checks for pending events, which schedule a drain
+USAGE_RECLAIM_INTERVAL = 60
+# TTL of the cached thread -> account mapping, threads never change account
+THREAD_ACCOUNT_CACHE_TTL = 24 * 60 * 60
+
+_consumer_name = f"{socket.gethostname()}-{os.getpid()}"
+
+
+async def record_usage(
+    thread_id: str,
+    message_id: str,
+    model: Optional[str],
+    prompt_tokens: int,
+    completion_tokens: int
+):
+    """Queue a usage event for billing and make sure a drain is scheduled.
+
+    Falls back to billing inline if the event cannot be queued.
+    """
+    event = {
+        "thread_id": thread_id,
+        "message_id": message_id,
+        "model": model or "unknown",
+        "prompt_tokens": int(prompt_tokens or 0),
+        "completion_tokens": int(completion_tokens or 0),
+        "recorded_at": time.time(),
+    }
+    try:
+        redis_client = await redis.get_client()
+        await redis_client.xadd(USAGE_STREAM_KEY, {"event": json.dumps(event)}, maxlen=USAGE_STREAM_MAXLEN, approximate=True)
+    except Exception as e:
+        logger.warning(f"Failed to queue usage event for message {message_id}, billing inline: {str(e)}")
+        client = await DBConnection().client
+        costs = await _bill_event(client, event)
+        try:
+            await usage_counters.add_usage(costs)
+        except Exception as e:
+            logger.error(f"Failed to add usage to the monthly counters, left to reconciliation: {str(e)}")
+        return
+
+    # The flag is set after XADD and cleared by the drain before its final read,
+    # so an event is either seen by the running drain or schedules a new one
+    try:
+        await _schedule_drain()
+    except Exception as e:
+        logger.error(f"Failed to schedule usage ledger drain: {str(e)}", exc_info=True)
+
+
+async def _schedule_drain():
+    """Schedule a drain unless one is already scheduled."""
+    if await redis.set(USAGE_DRAIN_SCHEDULED_KEY, "1", ex=USAGE_DRAIN_SCHEDULED_TTL, nx=True):
+        # Imported here, the actor lives with the other worker actors
+        from run_agent_background import process_usage_ledger
+        process_usage_ledger.send_with_options(delay=USAGE_DRAIN_DELAY_MS)
+
+
+async def _ensure_consumer_group(redis_client):
+    try:
+        await redis_client.xgroup_create(USAGE_STREAM_KEY, USAGE_CONSUMER_GROUP, id="0", mkstream=True)
+    except Exception as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+@cached("thread_account:{thread_id}", ttl=THREAD_ACCOUNT_CACHE_TTL, cache_none=False)
+async def _get_thread_account(client, thread_id: str) -> Optional[str]:
+    """Resolve the account of a thread, cached since it never changes."""
+    thread_row = await client.table('threads').select('account_id').eq('thread_id', thread_id).limit(1).execute()
+    return thread_row.data[0]['account_id'] if thread_row.data and len(thread_row.data) > 0 else None
+
+
+def _event_month(event: Dict[str, Any]) -> str:
+    # Events queued before they carried their time are counted in the current month
+    return usage_counters.month_of(event.get("recorded_at") or time.time())
+
+
+async def _bill_event(client, event: Dict[str, Any]) -> Dict[Tuple[str, str], float]:
+    """Bill the usage of an event to its account.
+
+    Returns the cost to add to the monthly usage counters, keyed by (account_id, month).
+    Raises if the usage could not be billed, the event must then be retried.
+    """
+    token_cost = calculate_token_cost(event["prompt_tokens"], event["completion_tokens"], event["model"])
+    if token_cost <= 0:
+        return {}
+    account_id = await _get_thread_account(client, event["thread_id"])
+    if not account_id:
+        logger.warning(f"No account found for thread {event['thread_id']}, skipping usage of message {event['message_id']}")
+        return {}
+
+    success, message = await handle_usage_with_credits(
+        client,
+        account_id,
+        token_cost,
+        thread_id=event["thread_id"],
+        message_id=event["message_id"],
+        model=event["model"]
+    )
+    if not success:
+        logger.warning(f"Usage of message {event['message_id']} not covered for account {account_id}: {message}")
+
+    # Counted after billing, which compares the usage before the event to the subscription limit
+    return {(account_id, _event_month(event)): token_cost}
+
+
+async def _count_and_ack(redis_client, entry_id, costs: Dict[Tuple[str, str], float]):
+    """Add the cost of a billed entry to the monthly usage counters and acknowledge it, atomically."""
+    try:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            usage_counters.queue_usage(pipe, costs)
+            pipe.xack(USAGE_STREAM_KEY, USAGE_CONSUMER_GROUP, entry_id)
+            pipe.xdel(USAGE_STREAM_KEY, entry_id)
+            await pipe.execute()
+        return
+    except Exception as e:
+        logger.error(f"Failed to add usage to the monthly counters, left to reconciliation: {str(e)}")
+    # The entry was billed, it must not be billed again
+    await redis_client.xack(USAGE_STREAM_KEY, USAGE_CONSUMER_GROUP, entry_id)
+    await redis_client.xdel(USAGE_STREAM_KEY, entry_id)
+
+
+async def pending_cost(entries, account_id: str, month: str) -> float:
+    """Cost of the usage of an account in a month among stream entries, i.e. not counted yet."""
+    client = await DBConnection().client
+    cost = 0.0
+    for _, fields in entries:
+        try:
+            event = json.loads(fields["event"])
+            if _event_month(event) != month:
+                continue
+            event_cost = calculate_token_cost(event["prompt_tokens"], event["completion_tokens"], event["model"])
+        except (KeyError, TypeError, json.JSONDecodeError):
+            continue
+        if event_cost > 0 and await _get_thread_account(client, event["thread_id"]) == account_id:
+            cost += event_cost
+    return cost
+
+
+async def _process_entries(client, redis_client, entries) -> int:
+    """Bill stream entries one by one and acknowledge those billed or malformed.
+
+    Entries that failed to bill stay pending and are reclaimed by a later drain.
+    Returns the number acknowledged.
+    """
+    if not entries:
+        return 0
+    processed = 0
+    done = []
+    for entry_id, fields in entries:
+        try:
+            event = json.loads(fields["event"])
+        except (KeyError, TypeError, json.JSONDecodeError):
+            logger.error(f"Dropping malformed usage event {entry_id}: {fields}")
+            done.append(entry_id)
+            continue
+        try:
+            costs = await _bill_event(client, event)
+        except Exception as e:
+            logger.error(f"Failed to bill usage of message {event.get('message_id')}, left pending for a retry: {str(e)}")
+            continue
+        if costs:
+            await _count_and_ack(redis_client, entry_id, costs)
+            processed += 1
+        else:
+            done.append(entry_id)
+    if done:
+        await redis_client.xack(USAGE_STREAM_KEY, USAGE_CONSUMER_GROUP, *done)
+        await redis_client.xdel(USAGE_STREAM_KEY, *done)
+    return processed + len(done)
+
+
+async def drain_usage_ledger() -> int:
+    """Bill every queued usage event in micro-batches. Returns the number processed."""
+    redis_client = await redis.get_client()
+    client = await DBConnection().client
+    await _ensure_consumer_group(redis_client)
+
+    processed = 0
+
+    # Events that failed to bill, or were delivered to a consumer that died
+    # before acknowledging them
+    cursor = "0-0"
+    while True:
+        cursor, claimed, *_ = await redis_client.xautoclaim(
+            USAGE_STREAM_KEY, USAGE_CONSUMER_GROUP, _consumer_name,
+            min_idle_time=USAGE_CLAIM_IDLE_MS, start_id=cursor, count=USAGE_BATCH_SIZE
+        )
+        processed += await _process_entries(client, redis_client, claimed)
+        if cursor in ("0-0", b"0-0"):
+            break
+
+    async def _read_batches() -> int:
+        count = 0
+        while True:
+            response = await redis_client.xreadgroup(
+                USAGE_CONSUMER_GROUP, _consumer_name, {USAGE_STREAM_KEY: ">"}, count=USAGE_BATCH_SIZE
+            )
+            entries = response[0][1] if response else []
+            if not entries:
+                return count
+            count += await _process_entries(client, redis_client, entries)
+
+    processed += await _read_batches()
+    await redis.delete(USAGE_DRAIN_SCHEDULED_KEY)
+    processed += await _read_batches()
+
+    if processed:
+        logger.debug(f"Usage ledger billed {processed} events")
+    return processed
+
+
+async def reclaim_loop():
+    """Schedule a drain every USAGE_RECLAIM_INTERVAL seconds while events are pending.
+
+    Without it, events that failed to bill would wait for the next usage event.
+    """
+    while True:
+        try:
+            redis_client = await redis.get_client()
+            await _ensure_consumer_group(redis_client)
+            pending = await redis_client.xpending(USAGE_STREAM_KEY, USAGE_CONSUMER_GROUP)
+            if pending and pending.get("pending"):
+                await _schedule_drain()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Failed to check pending usage events: {str(e)}")
+        await asyncio.sleep(USAGE_RECLAIM_INTERVAL)
@@ -0,0 +1,39 @@
+-- Bulk insert of the message rows buffered by the backend's MessageWriter.
+-- Rows are stamped with the database clock, like single inserts, instead of
+-- the clock of the worker that buffered them. clock_timestamp() advances from
+-- one row to the next, so the created_at order of a batch is the order of its
+-- rows. Rows whose message_id already exists are skipped, so a retried batch
+-- is not written twice.
+CREATE OR REPLACE FUNCTION public.insert_messages_batch(p_rows JSONB)
+RETURNS SETOF public.messages
+LANGUAGE plpgsql
+SECURITY INVOKER
+AS $$
+BEGIN
+    RETURN QUERY
+    INSERT INTO public.messages (
+        message_id, thread_id, type, is_llm_message, content, metadata,
+        agent_id, agent_version_id, created_at, updated_at
+    )
+    SELECT
+        (r.value->>'message_id')::UUID,
+        (r.value->>'thread_id')::UUID,
+        r.value->>'type',
+        COALESCE((r.value->>'is_llm_message')::BOOLEAN, FALSE),
+        r.value->'content',
+        COALESCE(r.value->'metadata', '{}'::jsonb),
+        (r.value->>'agent_id')::UUID,
+        (r.value->>'agent_version_id')::UUID,
+        TIMEZONE('utc'::text, clock_timestamp()),
+        TIMEZONE('utc'::text, clock_timestamp())
+    FROM (
+        SELECT value, position
+        FROM jsonb_array_elements(p_rows) WITH ORDINALITY AS rows(value, position)
+        ORDER BY position
+    ) r
+    ON CONFLICT (message_id) DO NOTHING
+    RETURNING *;
+END;
+$$;
+
+GRANT EXECUTE ON FUNCTION public.insert_messages_batch(JSONB) TO authenticated, service_role;
@@ -0,0 +1,69 @@
+-- Credit deductions for token overage are retried by the backend's usage
+-- ledger until they are acknowledged, including after a timeout of a call
+-- that did commit. use_credits now charges a message at most once: the balance
+-- row is locked first, so a deduction already recorded for p_message_id is
+-- seen by any retry, which succeeds without charging again.
+CREATE INDEX IF NOT EXISTS idx_credit_usage_message_id ON public.credit_usage(message_id);
+
+CREATE OR REPLACE FUNCTION public.use_credits(
+    p_user_id UUID,
+    p_amount DECIMAL,
+    p_description TEXT DEFAULT NULL,
+    p_thread_id UUID DEFAULT NULL,
+    p_message_id UUID DEFAULT NULL
+)
+RETURNS BOOLEAN
+LANGUAGE plpgsql
+SECURITY DEFINER
+AS $$
+DECLARE
+    current_balance DECIMAL;
+    success BOOLEAN := FALSE;
+BEGIN
+    SELECT balance_dollars INTO current_balance
+    FROM public.credit_balance
+    WHERE user_id = p_user_id
+    FOR UPDATE;
+
+    IF p_message_id IS NOT NULL AND EXISTS (
+        SELECT 1 FROM public.credit_usage
+        WHERE message_id = p_message_id
+          AND user_id = p_user_id
+          AND usage_type = 'token_overage'
+    ) THEN
+        RETURN TRUE;
+    END IF;
+
+    IF current_balance IS NOT NULL AND current_balance >= p_amount THEN
+        UPDATE public.credit_balance
+        SET 
+            balance_dollars = balance_dollars - p_amount,
+            total_used = total_used + p_amount,
+            last_updated = NOW()
+        WHERE user_id = p_user_id;
+        
+        INSERT INTO public.credit_usage (
+            user_id, 
+            amount_dollars, 
+            description, 
+            thread_id, 
+            message_id,
+            usage_type
+        )
+        VALUES (
+            p_user_id, 
+            p_amount, 
+            p_description, 
+            p_thread_id, 
+            p_message_id,
+            'token_overage'
+        );
+        
+        success := TRUE;
+    END IF;
+    
+    RETURN success;
+END;
+$$;
+
+GRANT EXECUTE ON FUNCTION public.use_credits TO service_role;
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Tests of the two-tier cache (utils/cache.py) against fakeredis: single-flight
+computation of missing values, background refresh of stale values, results
+computed across an invalidation not being stored, and invalidation of the
+local tier of every process. Each test uses its own cache instances, two of
+them standing in for two processes.
+
+Usage: python test_cache.py
+"""
+
+import sys
+import os
+import time
+import asyncio
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import fakeredis
+
+from services import redis, redis_multiplexer
+from utils import cache
+from utils.cache import cached
+
+
+def _setup():
+    redis.client = fakeredis.FakeAsyncRedis(decode_responses=True)
+    redis._initialized = True
+    # The shared pub/sub connection belongs to the event loop of one test
+    redis_multiplexer._pubsub_multiplexer = None
+
+
+async def _subscribed(*caches):
+    """Wait until the caches receive invalidations, so their local tier is used."""
+    for c in caches:
+        c._local_enabled()
+    for _ in range(100):
+        if all(c._subscribed for c in caches):
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("cache did not subscribe to invalidations")
+
+
+async def _close(*caches):
+    for c in caches:
+        c._listener.cancel()
+    await asyncio.gather(*(c._listener for c in caches), return_exceptions=True)
+
+
+class Computation:
+    """A compute function that counts its calls and waits for release() if asked to."""
+
+    def __init__(self, value="value", block=False, error=None):
+        self.value = value
+        self.error = error
+        self.calls = 0
+        self.released = asyncio.Event()
+        if not block:
+            self.released.set()
+
+    async def __call__(self):
+        self.calls += 1
+        await self.released.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def release(self):
+        self.released.set()
+
+
+async def _stored(key: str):
+    redis_client = await redis.get_client()
+    return cache._cache._decode(await redis_client.get(cache.CACHE_PREFIX + key))
+
+
+def test_single_flight():
+    async def run():
+        _setup()
+        c = cache._cache()
+        compute = Computation(block=True)
+        callers = [asyncio.create_task(c.get_or_compute("ns:key", compute)) for _ in range(10)]
+        await asyncio.sleep(0.01)
+        compute.release()
+        assert await asyncio.gather(*callers) == ["value"] * 10
+        assert compute.calls == 1
+        assert (await _stored("ns:key")).value == "value"
+        # Cached now
+        assert await c.get_or_compute("ns:key", compute) == "value"
+        assert compute.calls == 1
+    asyncio.run(run())
+
+
+def test_cancelled_caller_does_not_cancel_computation():
+    async def run():
+        _setup()
+        c = cache._cache()
+        compute = Computation(block=True)
+        first = asyncio.create_task(c.get_or_compute("ns:key", compute))
+        second = asyncio.create_task(c.get_or_compute("ns:key", compute))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        compute.release()
+        assert await second == "value"
+        assert compute.calls == 1
+    asyncio.run(run())
+
+
+def test_errors_not_cached():
+    async def run():
+        _setup()
+        c = cache._cache()
+        failing = Computation(error=ValueError("database unavailable"))
+        for _ in range(2):
+            try:
+                await c.get_or_compute("ns:key", failing)
+                raise AssertionError("error was not raised")
+            except ValueError:
+                pass
+        assert failing.calls == 2
+        assert await _stored("ns:key") is None
+        assert await c.get_or_compute("ns:key", Computation()) == "value"
+    asyncio.run(run())
+
+
+def test_none_cached_unless_disabled():
+    async def run():
+        _setup()
+        c = cache._cache()
+        compute = Computation(value=None)
+        await c.get_or_compute("ns:none", compute, cache_none=False)
+        await c.get_or_compute("ns:none", compute, cache_none=False)
+        assert compute.calls == 2
+        await c.get_or_compute("ns:none", compute)
+        await c.get_or_compute("ns:none", compute)
+        assert compute.calls == 3
+    asyncio.run(run())
+
+
+def test_stale_value_refreshed_in_background():
+    async def run():
+        _setup()
+        c = cache._cache()
+        now = time.time()
+        redis_client = await redis.get_client()
+        await redis_client.set(cache.CACHE_PREFIX + "ns:key", c._encode(cache._Entry("old", now - 1, now + 60)))
+
+        compute = Computation(value="new", block=True)
+        # Stale callers get the old value right away and share one refresh
+        assert await c.get_or_compute("ns:key", compute, stale_ttl=60) == "old"
+        assert await c.get_or_compute("ns:key", compute, stale_ttl=60) == "old"
+        await asyncio.sleep(0.01)
+        assert compute.calls == 1
+        compute.release()
+        await asyncio.sleep(0.01)
+        entry = await _stored("ns:key")
+        assert entry.value == "new" and entry.fresh_until > time.time()
+        assert await c.get_or_compute("ns:key", compute, stale_ttl=60) == "new"
+        assert compute.calls == 1
+    asyncio.run(run())
+
+
+def test_result_computed_across_invalidation_not_stored():
+    async def run():
+        _setup()
+        c = cache._cache()
+        compute = Computation(value="before", block=True)
+        caller = asyncio.create_task(c.get_or_compute("ns:key", compute))
+        await asyncio.sleep(0.01)
+        # The data changed while it was being read
+        await c.invalidate("ns:key")
+        compute.release()
+        assert await caller == "before"
+        assert await _stored("ns:key") is None
+        assert await c.get_or_compute("ns:key", Computation(value="after")) == "after"
+        assert (await _stored("ns:key")).value == "after"
+    asyncio.run(run())
+
+
+def test_invalidation_reaches_every_process():
+    async def run():
+        _setup()
+        first, second = cache._cache(), cache._cache()
+        await _subscribed(first, second)
+        try:
+            await first.set("ns:key", "old")
+            assert await second.get("ns:key") == "old"
+            assert "ns:key" in first._local and "ns:key" in second._local
+
+            # Changed in Redis behind the back of the local tiers
+            redis_client = await redis.get_client()
+            await redis_client.set(cache.CACHE_PREFIX + "ns:key", first._encode(cache._Entry("new", time.time() + 60, time.time() + 60)))
+            assert await second.get("ns:key") == "old"
+
+            await first.invalidate("ns:key")
+            await asyncio.sleep(0.05)
+            assert "ns:key" not in second._local
+            assert await second.get("ns:key") is None
+            assert second.stats()["lookups"] == {"redis": 1, "local": 1, "miss": 1}
+        finally:
+            await _close(first, second)
+    asyncio.run(run())
+
+
+def test_cached_decorator():
+    async def run():
+        _setup()
+        calls = []
+
+        @cached("ns:{account_id}:{month}", ttl=60)
+        async def usage(account_id: str, month: str = "2026-10"):
+            calls.append(account_id)
+            return {"account": account_id}
+
+        assert await usage("a") == {"account": "a"}
+        assert await usage("a", month="2026-10") == {"account": "a"}
+        assert await usage("b") == {"account": "b"}
+        assert calls == ["a", "b"]
+        assert (await _stored("ns:a:2026-10")).value == {"account": "a"}
+        await usage.invalidate("a")
+        assert await _stored("ns:a:2026-10") is None
+        await usage("a")
+        assert calls == ["a", "b", "a"]
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    for test in (
+        test_single_flight,
+        test_cancelled_caller_does_not_cancel_computation,
+        test_errors_not_cached,
+        test_none_cached_unless_disabled,
+        test_stale_value_refreshed_in_background,
+        test_result_computed_across_invalidation_not_stored,
+        test_invalidation_reaches_every_process,
+        test_cached_decorator,
+    ):
+        test()
+        print(f"{test.__name__}: ok")
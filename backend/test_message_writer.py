@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Tests of the write-behind MessageWriter (agentpress/message_writer.py): the
+order rows are written in, retries of failed flushes, and close() when the
+agent run is cancelled. A fake database stands in for ThreadManager.
+
+Usage: python test_message_writer.py
+"""
+
+import sys
+import os
+import asyncio
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from agentpress import message_writer
+from agentpress.message_writer import MessageWriter
+
+# Retries are not what is slow to test
+message_writer.MESSAGE_WRITE_RETRY_BACKOFF = 0.01
+
+
+class FakeDatabase:
+    """Records the messages written through both callbacks, in order."""
+
+    def __init__(self, failures: int = 0, insert_delay: float = 0, bad_types=()):
+        self.messages = []
+        self.batches = []
+        self.failures = failures
+        self.insert_delay = insert_delay
+        self.bad_types = set(bad_types)
+
+    async def add_message(self, thread_id, type, content, **kwargs):
+        message = {'message_id': f"direct-{len(self.messages)}", 'thread_id': thread_id, 'type': type, 'content': content}
+        self.messages.append(message)
+        return message
+
+    async def insert_messages(self, rows):
+        if self.insert_delay:
+            await asyncio.sleep(self.insert_delay)
+        if self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError("database unavailable")
+        if any(row['type'] in self.bad_types for row in rows):
+            raise ValueError("invalid row")
+        self.batches.append(len(rows))
+        self.messages.extend(rows)
+        return rows
+
+    def contents(self):
+        return [message['content']['n'] for message in self.messages]
+
+
+def _writer(database: FakeDatabase, **kwargs) -> MessageWriter:
+    return MessageWriter(database.add_message, database.insert_messages, **kwargs)
+
+
+def test_order():
+    """Buffered rows are written before the direct write that follows them."""
+    async def run():
+        database = FakeDatabase()
+        writer = _writer(database, flush_interval=10)
+        for n in range(3):
+            saved = await writer.add_message("thread", "status", {'n': n})
+            assert saved['message_id'] and saved['created_at']
+        assert database.messages == []
+        await writer.add_message("thread", "assistant", {'n': 3}, is_llm_message=True)
+        await writer.add_message("thread", "status", {'n': 4})
+        await writer.close()
+        assert database.contents() == [0, 1, 2, 3, 4], database.contents()
+        assert database.batches == [3, 1], database.batches
+    asyncio.run(run())
+
+
+def test_assistant_response_end_written_directly():
+    """Saving assistant_response_end bills the turn, it is never buffered."""
+    async def run():
+        database = FakeDatabase()
+        writer = _writer(database, flush_interval=10)
+        await writer.add_message("thread", "status", {'n': 0})
+        saved = await writer.add_message("thread", "assistant_response_end", {'n': 1})
+        assert saved['message_id'] == "direct-1", saved
+        assert database.contents() == [0, 1]
+        await writer.close()
+    asyncio.run(run())
+
+
+def test_timer_and_batch_size():
+    """The timer flushes a few rows, a full batch is flushed right away."""
+    async def run():
+        database = FakeDatabase()
+        writer = _writer(database, flush_interval=0.05, max_batch=4)
+        await writer.add_message("thread", "status", {'n': 0})
+        await asyncio.sleep(0.1)
+        assert database.contents() == [0]
+        for n in range(1, 5):
+            await writer.add_message("thread", "status", {'n': n})
+        # Well before the timer of row 1
+        await asyncio.sleep(0.01)
+        assert database.contents() == [0, 1, 2, 3, 4], database.contents()
+        await writer.close()
+    asyncio.run(run())
+
+
+def test_retries():
+    """Failed flushes are retried, rows added meanwhile are written after them."""
+    async def run():
+        database = FakeDatabase(failures=2)
+        writer = _writer(database, flush_interval=0.01)
+        await writer.add_message("thread", "status", {'n': 0})
+        await asyncio.sleep(0.02)
+        await writer.add_message("thread", "status", {'n': 1})
+        await asyncio.sleep(0.1)
+        assert database.contents() == [0, 1], database.contents()
+        await writer.close()
+        assert database.contents() == [0, 1]
+    asyncio.run(run())
+
+
+def test_one_by_one_after_failed_flushes():
+    """After MESSAGE_WRITE_MAX_ATTEMPTS failures, only the rows that fail alone are dropped."""
+    async def run():
+        database = FakeDatabase(bad_types={"bad"})
+        writer = _writer(database, flush_interval=10)
+        original_types = message_writer.BUFFERED_MESSAGE_TYPES
+        message_writer.BUFFERED_MESSAGE_TYPES = frozenset({"status", "bad"})
+        try:
+            await writer.add_message("thread", "status", {'n': 0})
+            await writer.add_message("thread", "bad", {'n': 1})
+            await writer.add_message("thread", "status", {'n': 2})
+            await writer.close()
+        finally:
+            message_writer.BUFFERED_MESSAGE_TYPES = original_types
+        assert database.contents() == [0, 2], database.contents()
+    asyncio.run(run())
+
+
+def test_close_cancelled():
+    """A cancelled close still writes the buffered rows, and the cancellation propagates."""
+    async def run():
+        database = FakeDatabase(failures=1, insert_delay=0.05)
+        writer = _writer(database, flush_interval=10)
+        await writer.add_message("thread", "status", {'n': 0})
+        await writer.add_message("thread", "status", {'n': 1})
+        closing = asyncio.create_task(writer.close())
+        await asyncio.sleep(0.02)
+        closing.cancel()
+        try:
+            await closing
+            raise AssertionError("close was not cancelled")
+        except asyncio.CancelledError:
+            pass
+        await asyncio.sleep(0.2)
+        assert database.contents() == [0, 1], database.contents()
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    for test in (
+        test_order,
+        test_assistant_response_end_written_directly,
+        test_timer_and_batch_size,
+        test_retries,
+        test_one_by_one_after_failed_flushes,
+        test_close_cancelled,
+    ):
+        test()
+        print(f"{test.__name__}: ok")
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Tests of the fair dispatch of agent runs (services/run_dispatcher.py) against
+fakeredis: concurrency caps per account and overall, the order runs of the
+lanes and of the accounts in a lane are sent in, and the release and expiry
+of slots. Runs are recorded instead of being sent to Dramatiq.
+
+Usage: python test_run_dispatcher.py
+"""
+
+import sys
+import os
+import asyncio
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import fakeredis
+
+from services import redis, run_dispatcher
+from utils.config import config
+
+
+def _setup(capacity: int = 0) -> list:
+    """Fresh fakeredis, returns the list of run ids sent to the workers."""
+    redis.client = fakeredis.FakeAsyncRedis(decode_responses=True)
+    redis._initialized = True
+    config.AGENT_RUN_DISPATCH_CAPACITY = capacity
+    sent = []
+    run_dispatcher._send_run = lambda run_kwargs: sent.append(run_kwargs["agent_run_id"])
+    return sent
+
+
+async def _submit(account_id: str, lane: str, runs: int, cap: int = 10, prefix: str = None):
+    for n in range(runs):
+        await run_dispatcher.submit(account_id, lane, cap, agent_run_id=f"{prefix or account_id}-{n}", thread_id="thread")
+
+
+def test_account_cap():
+    async def run():
+        sent = _setup()
+        await _submit("a", "interactive", 5, cap=2)
+        assert sent == ["a-0", "a-1"], sent
+        await run_dispatcher.release("a-0")
+        assert sent == ["a-0", "a-1", "a-2"], sent
+        # Releasing a run twice frees one slot
+        await run_dispatcher.release("a-0")
+        assert len(sent) == 3
+        await _submit("b", "interactive", 1, cap=2)
+        assert sent[-1] == "b-0"
+    asyncio.run(run())
+
+
+def test_dispatch_capacity():
+    async def run():
+        sent = _setup(capacity=3)
+        await _submit("a", "batch", 4)
+        await _submit("b", "batch", 4)
+        assert len(sent) == 3
+        assert (await run_dispatcher.get_stats())["inflight"] == 3
+        await run_dispatcher.release(sent[0])
+        assert len(sent) == 4
+    asyncio.run(run())
+
+
+def test_interactive_runs_overtake_flood():
+    async def run():
+        sent = _setup(capacity=2)
+        await _submit("flood", "triggered", 20)
+        await _submit("user", "interactive", 2)
+        assert sent == ["flood-0", "flood-1"], sent
+        await run_dispatcher.release("flood-0")
+        await run_dispatcher.release("flood-1")
+        assert sent[2:] == ["user-0", "user-1"], sent
+        # The flood is not starved either
+        for agent_run_id in ("user-0", "user-1"):
+            await run_dispatcher.release(agent_run_id)
+        assert sent[4:] == ["flood-2", "flood-3"], sent
+    asyncio.run(run())
+
+
+def test_accounts_of_a_lane_take_turns():
+    async def run():
+        sent = _setup(capacity=1)
+        # Queued while the workers are busy
+        await _submit("x", "batch", 1)
+        await _submit("a", "batch", 4)
+        await _submit("b", "batch", 2)
+        while True:
+            count = len(sent)
+            await run_dispatcher.release(sent[-1])
+            if len(sent) == count:
+                break
+        assert sent == ["x-0", "a-0", "b-0", "a-1", "b-1", "a-2", "a-3"], sent
+    asyncio.run(run())
+
+
+def test_release_waiting_run():
+    async def run():
+        sent = _setup()
+        await _submit("a", "interactive", 3, cap=1)
+        # Stopped before it was sent
+        await run_dispatcher.release("a-1")
+        await run_dispatcher.release("a-0")
+        assert sent == ["a-0", "a-2"], sent
+        redis_client = await redis.get_client()
+        assert await redis_client.hkeys(run_dispatcher.RUNS_KEY) == ["a-2"]
+    asyncio.run(run())
+
+
+def test_slot_expires_without_keep_alive():
+    async def run():
+        sent = _setup()
+        original_ttl = run_dispatcher.INFLIGHT_TTL
+        run_dispatcher.INFLIGHT_TTL = 0.2
+        try:
+            await _submit("a", "triggered", 2, cap=1, prefix="dead")
+            await _submit("b", "triggered", 2, cap=1, prefix="alive")
+            assert sent == ["dead-0", "alive-0"], sent
+            await asyncio.sleep(0.1)
+            await run_dispatcher.keep_alive("alive-0")
+            await asyncio.sleep(0.15)
+            await run_dispatcher.dispatch()
+            # The worker of dead-0 stopped keeping its slot, alive-0 still runs
+            assert sent == ["dead-0", "alive-0", "dead-1"], sent
+            # Its worker ending it later frees nothing more
+            await run_dispatcher.release("dead-0")
+            assert len(sent) == 3
+        finally:
+            run_dispatcher.INFLIGHT_TTL = original_ttl
+    asyncio.run(run())
+
+
+def test_sent_directly_without_redis():
+    async def run():
+        sent = _setup()
+
+        async def unavailable():
+            raise ConnectionError("redis unavailable")
+
+        original = redis.get_client
+        redis.get_client = unavailable
+        try:
+            await _submit("a", "interactive", 2, cap=1)
+        finally:
+            redis.get_client = original
+        assert sent == ["a-0", "a-1"], sent
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    for test in (
+        test_account_cap,
+        test_dispatch_capacity,
+        test_interactive_runs_overtake_flood,
+        test_accounts_of_a_lane_take_turns,
+        test_release_waiting_run,
+        test_slot_expires_without_keep_alive,
+        test_sent_directly_without_redis,
+    ):
+        test()
+        print(f"{test.__name__}: ok")
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Tests of the admission control of agent runs in worker processes
+(services/run_scheduler.py): the run limit, waiting for a run to be released,
+and refusals for event loop lag and memory, which never apply to an idle
+process.
+
+Usage: python test_run_scheduler.py
+"""
+
+import sys
+import os
+import asyncio
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from services import run_scheduler
+from services.run_scheduler import RunScheduler
+
+
+def _scheduler(max_runs: int = 2, max_memory_mb: int = 0, admission_wait: float = 0.05) -> RunScheduler:
+    return RunScheduler(max_runs=max_runs, max_loop_lag_ms=500, max_memory_mb=max_memory_mb, admission_wait=admission_wait)
+
+
+def _not_admitted(reason: str) -> float:
+    return run_scheduler.RUNS_NOT_ADMITTED.labels(reason=reason)._value.get()
+
+
+def test_run_limit():
+    async def run():
+        scheduler = _scheduler()
+        refused = _not_admitted("runs")
+        assert await scheduler.admit("run-1")
+        assert await scheduler.admit("run-2")
+        assert not await scheduler.admit("run-3")
+        assert scheduler.active == 2 and scheduler.queued == 0
+        assert _not_admitted("runs") == refused + 1
+        await scheduler.release()
+        assert await scheduler.admit("run-3")
+        assert scheduler.active == 2
+    asyncio.run(run())
+
+
+def test_waiting_run_admitted_on_release():
+    async def run():
+        scheduler = _scheduler(max_runs=1, admission_wait=5)
+        assert await scheduler.admit("run-1")
+        waiting = asyncio.create_task(scheduler.admit("run-2"))
+        await asyncio.sleep(0.01)
+        assert scheduler.queued == 1 and not waiting.done()
+        await scheduler.release()
+        assert await asyncio.wait_for(waiting, timeout=1)
+        assert scheduler.active == 1 and scheduler.queued == 0
+    asyncio.run(run())
+
+
+def test_release_admits_one_waiting_run():
+    async def run():
+        scheduler = _scheduler(max_runs=1, admission_wait=0.3)
+        assert await scheduler.admit("run-1")
+        waiting = [asyncio.create_task(scheduler.admit(f"run-{n}")) for n in range(2, 5)]
+        await asyncio.sleep(0.01)
+        await scheduler.release()
+        results = await asyncio.gather(*waiting)
+        assert sorted(results) == [False, False, True], results
+        assert scheduler.active == 1 and scheduler.queued == 0
+    asyncio.run(run())
+
+
+def test_loop_lag():
+    async def run():
+        scheduler = _scheduler(max_runs=10)
+        # An idle process admits a run however late its loop is
+        scheduler._ensure_started()
+        scheduler.loop_lag = 10.0
+        assert await scheduler.admit("run-1")
+        refused = _not_admitted("loop_lag")
+        assert not await scheduler.admit("run-2")
+        assert _not_admitted("loop_lag") == refused + 1
+        scheduler.loop_lag = 0.0
+        assert await scheduler.admit("run-2")
+    asyncio.run(run())
+
+
+def test_memory():
+    async def run():
+        original = run_scheduler._memory_usage
+        run_scheduler._memory_usage = lambda: 300 * 1024 * 1024
+        try:
+            scheduler = _scheduler(max_runs=10, max_memory_mb=200)
+            assert await scheduler.admit("run-1")
+            assert not await scheduler.admit("run-2")
+            run_scheduler._memory_usage = lambda: 100 * 1024 * 1024
+            assert await scheduler.admit("run-2")
+            # Unknown memory usage does not block runs
+            run_scheduler._memory_usage = lambda: None
+            assert await scheduler.admit("run-3")
+        finally:
+            run_scheduler._memory_usage = original
+    asyncio.run(run())
+
+
+def test_cancelled_admission():
+    async def run():
+        scheduler = _scheduler(max_runs=1, admission_wait=5)
+        assert await scheduler.admit("run-1")
+        waiting = asyncio.create_task(scheduler.admit("run-2"))
+        await asyncio.sleep(0.01)
+        waiting.cancel()
+        try:
+            await waiting
+            raise AssertionError("admission was not cancelled")
+        except asyncio.CancelledError:
+            pass
+        assert scheduler.active == 1 and scheduler.queued == 0
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    for test in (
+        test_run_limit,
+        test_waiting_run_admitted_on_release,
+        test_release_admits_one_waiting_run,
+        test_loop_lag,
+        test_memory,
+        test_cancelled_admission,
+    ):
+        test()
+        print(f"{test.__name__}: ok")
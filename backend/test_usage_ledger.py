@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Tests of the usage ledger (services/usage_ledger.py) against fakeredis: usage
+events are billed, counted in the monthly usage counters and acknowledged
+once, and events that failed to bill are retried without charging credits
+twice. Billing and the database are stand-ins; the credit store charges a
+message once, like the use_credits database function.
+
+Usage: python test_usage_ledger.py
+"""
+
+import sys
+import os
+import time
+import json
+import asyncio
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import fakeredis
+
+from services import redis, usage_counters
+from services import usage_ledger
+from services.billing import calculate_token_cost
+
+MODEL = "gpt-4o-mini"
+THREAD_ACCOUNTS = {"thread-a": "account-a", "thread-b": "account-b"}
+
+
+class FakeCredits:
+    """Stand-in for handle_usage_with_credits, charging each message once."""
+
+    def __init__(self):
+        self.charges = {}
+        self.calls = []
+        # Messages whose next call fails after charging, like a timeout of a committed call
+        self.fail_after_charge = set()
+
+    async def handle_usage_with_credits(self, client, account_id, token_cost, thread_id=None, message_id=None, model=None):
+        self.calls.append(message_id)
+        self.charges.setdefault(message_id, (account_id, token_cost))
+        if message_id in self.fail_after_charge:
+            self.fail_after_charge.discard(message_id)
+            raise TimeoutError("read timeout")
+        return True, "charged"
+
+
+class FakeDBConnection:
+    @property
+    async def client(self):
+        return None
+
+
+def _setup() -> FakeCredits:
+    redis.client = fakeredis.FakeAsyncRedis(decode_responses=True)
+    redis._initialized = True
+    credits = FakeCredits()
+    usage_ledger.handle_usage_with_credits = credits.handle_usage_with_credits
+    usage_ledger.DBConnection = FakeDBConnection
+
+    async def get_thread_account(client, thread_id):
+        return THREAD_ACCOUNTS.get(thread_id)
+
+    async def schedule_drain():
+        pass
+
+    usage_ledger._get_thread_account = get_thread_account
+    usage_ledger._schedule_drain = schedule_drain
+    usage_ledger.USAGE_CLAIM_IDLE_MS = 0
+    return credits
+
+
+async def _record(message_id: str, thread_id: str = "thread-a", prompt_tokens: int = 1_000_000):
+    await usage_ledger.record_usage(thread_id, message_id, MODEL, prompt_tokens, 0)
+
+
+async def _counter(account_id: str) -> float:
+    redis_client = await redis.get_client()
+    return float(await redis_client.hget(usage_counters._counters_key(usage_counters.current_month()), account_id) or 0)
+
+
+async def _pending() -> int:
+    redis_client = await redis.get_client()
+    return (await redis_client.xpending(usage_ledger.USAGE_STREAM_KEY, usage_ledger.USAGE_CONSUMER_GROUP))["pending"]
+
+
+COST = calculate_token_cost(1_000_000, 0, MODEL)
+
+
+def test_events_billed_counted_and_acknowledged():
+    async def run():
+        credits = _setup()
+        await _record("m1")
+        await _record("m2", "thread-b")
+        await _record("m3")
+        assert await usage_ledger.drain_usage_ledger() == 3
+        assert sorted(credits.charges) == ["m1", "m2", "m3"]
+        assert abs(await _counter("account-a") - 2 * COST) < 1e-9
+        assert abs(await _counter("account-b") - COST) < 1e-9
+        redis_client = await redis.get_client()
+        assert await redis_client.xlen(usage_ledger.USAGE_STREAM_KEY) == 0
+        assert await _pending() == 0
+    asyncio.run(run())
+
+
+def test_failed_event_retried_without_charging_twice():
+    async def run():
+        credits = _setup()
+        credits.fail_after_charge.add("m1")
+        await _record("m1")
+        await _record("m2")
+        assert await usage_ledger.drain_usage_ledger() == 1
+        assert await _pending() == 1
+        assert abs(await _counter("account-a") - COST) < 1e-9
+
+        # The next drain reclaims the event and bills it again
+        assert await usage_ledger.drain_usage_ledger() == 1
+        assert credits.calls.count("m1") == 2
+        assert len(credits.charges) == 2
+        assert abs(await _counter("account-a") - 2 * COST) < 1e-9
+        assert await _pending() == 0
+    asyncio.run(run())
+
+
+def test_failed_count_acknowledges_billed_event():
+    async def run():
+        credits = _setup()
+        original = usage_counters.queue_usage
+
+        def failing_queue_usage(pipe, costs):
+            raise ConnectionError("redis unavailable")
+
+        usage_counters.queue_usage = failing_queue_usage
+        try:
+            await _record("m1")
+            assert await usage_ledger.drain_usage_ledger() == 1
+        finally:
+            usage_counters.queue_usage = original
+        # Billed once and acknowledged, the counter is left to reconciliation
+        assert credits.calls == ["m1"]
+        assert await _pending() == 0
+        assert await _counter("account-a") == 0
+    asyncio.run(run())
+
+
+def test_malformed_and_unbillable_events_dropped():
+    async def run():
+        credits = _setup()
+        redis_client = await redis.get_client()
+        await redis_client.xadd(usage_ledger.USAGE_STREAM_KEY, {"event": "{not json"})
+        await _record("m1", "thread-unknown")
+        await _record("m2", prompt_tokens=0)
+        assert await usage_ledger.drain_usage_ledger() == 3
+        assert credits.calls == []
+        assert await redis_client.xlen(usage_ledger.USAGE_STREAM_KEY) == 0
+    asyncio.run(run())
+
+
+def test_pending_cost():
+    async def run():
+        _setup()
+        await _record("m1")
+        await _record("m2", "thread-b")
+        redis_client = await redis.get_client()
+        last_month = {
+            "thread_id": "thread-a", "message_id": "m3", "model": MODEL,
+            "prompt_tokens": 1_000_000, "completion_tokens": 0, "recorded_at": time.time() - 40 * 24 * 60 * 60,
+        }
+        await redis_client.xadd(usage_ledger.USAGE_STREAM_KEY, {"event": json.dumps(last_month)})
+        entries = await redis_client.xrange(usage_ledger.USAGE_STREAM_KEY)
+        cost = await usage_ledger.pending_cost(entries, "account-a", usage_counters.current_month())
+        assert abs(cost - COST) < 1e-9, cost
+    asyncio.run(run())
+
+
+def test_inline_billing_without_redis():
+    async def run():
+        credits = _setup()
+
+        async def unavailable():
+            raise ConnectionError("redis unavailable")
+
+        original = redis.get_client
+        redis.get_client = unavailable
+        try:
+            await _record("m1")
+        finally:
+            redis.get_client = original
+        assert credits.calls == ["m1"]
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    for test in (
+        test_events_billed_counted_and_acknowledged,
+        test_failed_event_retried_without_charging_twice,
+        test_failed_count_acknowledges_billed_event,
+        test_malformed_and_unbillable_events_dropped,
+        test_pending_cost,
+        test_inline_billing_without_redis,
+    ):
+        test()
+        print(f"{test.__name__}: ok")
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+Differential test of the XML tool call lexer against the regex based parser it
+replaced: both must return the same function names, parameters, raw XML and
+parsing details, on hand-written edge cases and on randomized inputs.
+
+Usage: python test_xml_tool_parser.py [iterations]
+"""
+
+import sys
+import os
+import re
+import json
+import random
+import time
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from agentpress.xml_tool_parser import XMLToolParser
+
+
+class RegexXMLToolParser:
+    """Reference: the regex based XMLToolParser.parse_content, returning plain dicts."""
+
+    FUNCTION_CALLS_PATTERN = re.compile(r'<function_calls>(.*?)</function_calls>', re.DOTALL | re.IGNORECASE)
+    INVOKE_PATTERN = re.compile(r'<invoke\s+name=["\']([^"\']+)["\']>(.*?)</invoke>', re.DOTALL | re.IGNORECASE)
+    PARAMETER_PATTERN = re.compile(r'<parameter\s+name=["\']([^"\']+)["\']>(.*?)</parameter>', re.DOTALL | re.IGNORECASE)
+
+    def parse_content(self, content):
+        tool_calls = []
+        for fc_content in self.FUNCTION_CALLS_PATTERN.findall(content):
+            for function_name, invoke_content in self.INVOKE_PATTERN.findall(fc_content):
+                try:
+                    tool_calls.append(self._parse_invoke_block(function_name, invoke_content, fc_content))
+                except Exception:
+                    pass
+        return tool_calls
+
+    def _parse_invoke_block(self, function_name, invoke_content, full_block):
+        parameters = {}
+        parsing_details = {"function_name": function_name, "raw_parameters": {}}
+        for param_name, param_value in self.PARAMETER_PATTERN.findall(invoke_content):
+            param_value = param_value.strip()
+            parameters[param_name] = self._parse_parameter_value(param_value)
+            parsing_details["raw_parameters"][param_name] = param_value
+        invoke_pattern = re.compile(
+            rf'<invoke\s+name=["\']{re.escape(function_name)}["\']>.*?</invoke>',
+            re.DOTALL | re.IGNORECASE
+        )
+        raw_xml_match = invoke_pattern.search(full_block)
+        raw_xml = raw_xml_match.group(0) if raw_xml_match else f"<invoke name=\"{function_name}\">...</invoke>"
+        return {
+            "function_name": function_name,
+            "parameters": parameters,
+            "raw_xml": raw_xml,
+            "parsing_details": parsing_details,
+        }
+
+    def _parse_parameter_value(self, value):
+        value = value.strip()
+        if value.startswith(('{', '[')):
+            try:
+                return json.loads(value)
+            except json.JSONDecodeError:
+                pass
+        if value.lower() in ('true', 'false'):
+            return value.lower() == 'true'
+        try:
+            if '.' in value:
+                return float(value)
+            else:
+                return int(value)
+        except ValueError:
+            pass
+        return value
+
+
+def as_dicts(tool_calls):
+    return [
+        {
+            "function_name": call.function_name,
+            "parameters": call.parameters,
+            "raw_xml": call.raw_xml,
+            "parsing_details": call.parsing_details,
+        }
+        for call in tool_calls
+    ]
+
+
+def normalize(value):
+    """Make NaN comparable, json.loads accepts it inside parameter values."""
+    return json.dumps(value, sort_keys=True, default=repr)
+
+
+def check(content):
+    expected = RegexXMLToolParser().parse_content(content)
+    actual = as_dicts(XMLToolParser().parse_content(content))
+    assert normalize(actual) == normalize(expected), (
+        f"Mismatch for {content[:500]!r}:\n  lexer: {actual!r:.500}\n  regex: {expected!r:.500}"
+    )
+    return len(actual)
+
+
+EDGE_CASES = [
+    "",
+    "no tool calls here",
+    '<function_calls>\n<invoke name="create_file">\n<parameter name="file_path">a.txt</parameter>\n'
+    '<parameter name="file_contents">hello</parameter>\n</invoke>\n</function_calls>',
+    # Values of every type
+    '<function_calls><invoke name="t"><parameter name="a">{"x": [1, 2]}</parameter>'
+    '<parameter name="b">[1, 2</parameter><parameter name="c"> TRUE </parameter>'
+    '<parameter name="d">1.5</parameter><parameter name="e">-3</parameter>'
+    '<parameter name="f">1.2.3</parameter><parameter name="g">{"a": NaN}</parameter>'
+    '<parameter name="h">{} trailing</parameter><parameter name="i">1_000</parameter></invoke></function_calls>',
+    # Case-insensitive keywords, including non-ASCII case equivalents
+    '<FUNCTION_CALLS><Invoke NAME="a"><PARAMETER Name=\'p\'>1</Parameter></INVOKE></Function_Calls>',
+    '<function_calls><İnvoke name="a"></ınvoke><invoKe name="b"></invoke></function_calls>',
+    '<function_callſ><invoke name="a"></invoke></function_calls>',
+    # Mixed quotes, whitespace, and names running to the first quote
+    '<function_calls><invoke\n\tname="a\'>x</invoke><invoke name=\'b">y</invoke></function_calls>',
+    '<function_calls><invoke name=""></invoke><invoke  name="a>b">c</invoke><invokename="d"></invoke></function_calls>',
+    '<function_calls><invoke name="a" ></invoke><invoke name= "b"></invoke></function_calls>',
+    # Repeated names: raw XML is that of the first invoke with the name
+    '<function_calls><invoke name="a">1</invoke><invoke name="A">2</invoke><invoke name="a">3</invoke></function_calls>',
+    '<function_calls><invoke name="Σ">1</invoke><invoke name="σ">2</invoke><invoke name="ς">3</invoke></function_calls>',
+    # Nested invokes
+    '<function_calls><invoke name="a"><invoke name="b">x</invoke><invoke name="b">y</invoke></function_calls>',
+    '<function_calls><invoke name="a<invoke name=">">z</invoke><invoke name=">">w</invoke></function_calls>',
+    # Unclosed blocks and elements
+    '<function_calls><invoke name="a"><parameter name="p">1</invoke></function_calls>',
+    '<function_calls><invoke name="a">',
+    '<function_calls><invoke name="a"></invoke></function_calls><function_calls><invoke name="b">',
+    '<function_calls></function_calls></function_calls><function_calls><invoke name="a"></invoke></function_calls>',
+    # Duplicate parameters, the last one wins
+    '<function_calls><invoke name="a"><parameter name="p">1</parameter><parameter name="p">2</parameter></invoke></function_calls>',
+    # Nesting too deep for json.loads
+    '<function_calls><invoke name="a"><parameter name="p">' + '[' * 5000 + ']' * 5000 + '</parameter></invoke></function_calls>',
+]
+
+
+def test_edge_cases():
+    for content in EDGE_CASES:
+        check(content)
+
+
+def test_unclosed_json_is_kept_as_string():
+    # The regex parser passed this to json.loads, which hit the recursion limit
+    # and dropped the whole invoke; it is not bracketed on both ends, so it is
+    # now kept as a string
+    value = '[' * 5000
+    content = f'<function_calls><invoke name="a"><parameter name="p">{value}</parameter></invoke></function_calls>'
+    tool_calls = XMLToolParser().parse_content(content)
+    assert len(tool_calls) == 1 and tool_calls[0].parameters == {"p": value}
+
+
+FRAGMENTS = [
+    "<function_calls>", "</function_calls>", "<FUNCTION_calls>", "</Function_Calls>",
+    "<invoke", "</invoke>", "<INVOKE", "</Invoke>", "<İnvoke", "<ınvoke",
+    "<parameter", "</parameter>", "<Parameter", "</PARAMETER>",
+    " ", "\n", "\t", " name=", "name=", "NAME=", '"', "'", ">", "<", "/",
+    "a", "A", "b", "x y", "σ", "Σ", "\u212a",
+    "1", "2.5", "true", "False", "{", "}", "[", "]", '{"k": 1}', "[1, 2]", "null",
+]
+
+
+def random_content(rng):
+    parts = []
+    for _ in range(rng.randint(0, 60)):
+        if rng.random() < 0.3:
+            name = rng.choice(["a", "A", "b", "create_file", "σ", "a>b"])
+            quote = rng.choice(['"', "'"])
+            # Mostly matching quotes, sometimes mismatched ones
+            closing_quote = rng.choice([quote, quote, '"', "'"])
+            separator = rng.choice([" ", "  ", "\n"])
+            tag = rng.choice(["invoke", "parameter", "Invoke"])
+            parts.append(f"<{tag}{separator}name={quote}{name}{closing_quote}>")
+        else:
+            parts.append(rng.choice(FRAGMENTS))
+    return "".join(parts)
+
+
+def run_randomized(iterations: int = 20000, seed: int = 1234) -> int:
+    """Check randomized inputs, returns the number of tool calls they contained."""
+    rng = random.Random(seed)
+    calls = 0
+    for _ in range(iterations):
+        calls += check(random_content(rng))
+    return calls
+
+
+def test_randomized():
+    # The inputs must contain tool calls for the comparison to mean anything
+    assert run_randomized() > 0
+
+
+def benchmark():
+    content = "".join(
+        f"Some prose before call {i}.\n<function_calls>\n<invoke name=\"create_file\">\n"
+        f"<parameter name=\"file_path\">src/file_{i}.py</parameter>\n"
+        f"<parameter name=\"file_contents\">{'print(1)' * 5000}</parameter>\n"
+        f"</invoke>\n<invoke name=\"str_replace\">\n<parameter name=\"old_str\">a</parameter>\n"
+        f"<parameter name=\"new_str\">b</parameter>\n</invoke>\n</function_calls>\n"
+        for i in range(50)
+    )
+    for label, parser in [("regex", RegexXMLToolParser()), ("lexer", XMLToolParser())]:
+        start = time.perf_counter()
+        for _ in range(10):
+            parser.parse_content(content)
+        print(f"{label}: {(time.perf_counter() - start) / 10 * 1000:.2f} ms per parse of {len(content):,} chars")
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    print("=== Edge cases ===")
+    test_edge_cases()
+    test_unclosed_json_is_kept_as_string()
+    print(f"{len(EDGE_CASES) + 1} cases OK")
+
+    print(f"\n=== Randomized, {iterations} inputs ===")
+    print(f"{run_randomized(iterations)} tool calls OK")
+
+    print("\n=== Parse time ===")
+    benchmark()
@@ -4,10 +4,10 @@ from datetime import datetime, timezone
 from typing import Dict, Any, Tuple, Optional
 
 from services.supabase import DBConnection
-from services import redis
+from services import run_registry, run_dispatcher
 from utils.logger import logger, structlog
 from utils.config import config
-from run_agent_background import run_agent_background
+from agent.utils import check_agent_run_limit
 from .trigger_service import TriggerEvent, TriggerResult
 from .utils import format_workflow_for_llm
 
@@ -396,7 +396,9 @@ class AgentExecutor:
         
         await self._register_agent_run(agent_run_id)
         
-        run_agent_background.send(
+        limit_check = await check_agent_run_limit(client, account_id)
+        await run_dispatcher.submit(
+            account_id, "triggered", limit_check['max_concurrent_runs'],
             agent_run_id=agent_run_id,
             thread_id=thread_id,
             instance_id="trigger_executor",
@@ -417,8 +419,7 @@ class AgentExecutor:
     
     async def _register_agent_run(self, agent_run_id: str) -> None:
         try:
-            instance_key = f"active_run:trigger_executor:{agent_run_id}"
-            await redis.set(instance_key, "running", ex=redis.REDIS_KEY_TTL)
+            await run_registry.register_run("trigger_executor", agent_run_id)
         except Exception as e:
             logger.warning(f"Failed to register agent run in Redis: {e}")
 
@@ -677,7 +678,9 @@ class WorkflowExecutor:
         
         await self._register_workflow_run(agent_run_id)
         
-        run_agent_background.send(
+        limit_check = await check_agent_run_limit(client, account_id)
+        await run_dispatcher.submit(
+            account_id, "triggered", limit_check['max_concurrent_runs'],
             agent_run_id=agent_run_id,
             thread_id=thread_id,
             instance_id=getattr(config, 'INSTANCE_ID', 'default'),
@@ -699,8 +702,7 @@ class WorkflowExecutor:
     async def _register_workflow_run(self, agent_run_id: str) -> None:
         try:
             instance_id = getattr(config, 'INSTANCE_ID', 'default')
-            instance_key = f"active_run:{instance_id}:{agent_run_id}"
-            await redis.set(instance_key, "running", ex=redis.REDIS_KEY_TTL)
+            await run_registry.register_run(instance_id, agent_run_id)
         except Exception as e:
             logger.warning(f"Failed to register workflow run in Redis: {e}")
 
@@ -1,26 +1,334 @@
+"""
+Two-tier cache: a bounded in-process LRU in front of Redis.
+
+Values are JSON. Each process keeps the entries it reads or writes in memory
+for at most ``LOCAL_MAX_TTL`` seconds. ``invalidate`` deletes the Redis entry
+and publishes the key on ``CACHE_INVALIDATION_CHANNEL`` so every process
+drops its copy; the local tier is only used while this process is subscribed.
+
+``get_or_compute`` (and the ``cached`` decorator built on it) computes a
+missing value once per process, however many coroutines ask for it at the
+same time. Entries written with a ``stale_ttl`` are still served for that
+long after they expire, while a single background refresh recomputes them.
+"""
+
 import json
-from typing import Any
-from services.redis import get_client
+import time
+import asyncio
+import inspect
+import functools
+from collections import OrderedDict, defaultdict
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional
+
+from prometheus_client import Counter
+
+from services import redis
+from services.redis_multiplexer import get_pubsub_multiplexer
+from utils.logger import logger
+
+CACHE_PREFIX = "cache:v2:"
+CACHE_INVALIDATION_CHANNEL = "cache:invalidate"
+DEFAULT_TTL = 15 * 60
+# Longest time an entry is served from process memory, bounds how stale it can
+# be if an invalidation is missed
+LOCAL_MAX_TTL = 30
+LOCAL_MAX_ENTRIES = 10_000
+# Delay before subscribing again to invalidations after a failure
+INVALIDATION_RETRY_DELAY = 5
+
+CACHE_LOOKUPS = Counter(
+    "cache_lookups_total",
+    "Cache lookups by key namespace and result (local, redis, stale, miss, error)",
+    ["namespace", "result"],
+)
+
+
+class _Entry:
+    __slots__ = ("value", "fresh_until", "expires_at")
+
+    def __init__(self, value: Any, fresh_until: float, expires_at: float):
+        self.value = value
+        # Unix times: served as is until fresh_until, served stale until expires_at
+        self.fresh_until = fresh_until
+        self.expires_at = expires_at
+
+
+def _namespace(key: str) -> str:
+    return key.split(':', 1)[0]
 
 
 class _cache:
+    def __init__(self):
+        self._local: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        # Stale values served while they are recomputed
+        self._refreshing: Dict[str, Any] = {}
+        # Bumped on every invalidation, results computed across one are not stored
+        self._epoch = 0
+        self._listener: Optional[asyncio.Task] = None
+        self._listener_loop = None
+        self._subscribed = False
+        self._counts: Dict[str, int] = defaultdict(int)
+
+    def _count(self, key: str, result: str):
+        self._counts[result] += 1
+        CACHE_LOOKUPS.labels(namespace=_namespace(key), result=result).inc()
+
+    def stats(self) -> Dict[str, Any]:
+        """Lookup counts of this process by result, and the size of the local tier."""
+        return {"lookups": dict(self._counts), "local_entries": len(self._local), "local_enabled": self._subscribed}
+
+    # Local tier
+
+    def _local_enabled(self) -> bool:
+        loop = asyncio.get_running_loop()
+        if self._listener is None or (self._listener.done() and self._listener_loop is loop):
+            self._listener_loop = loop
+            self._listener = asyncio.create_task(self._listen())
+        return self._subscribed and self._listener_loop is loop
+
+    def _local_get(self, key: str, now: float) -> Optional[_Entry]:
+        entry = self._local.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= now:
+            del self._local[key]
+            return None
+        self._local.move_to_end(key)
+        return entry
+
+    def _local_put(self, key: str, entry: _Entry, now: float):
+        if not self._local_enabled():
+            return
+        local = _Entry(entry.value, entry.fresh_until, min(entry.expires_at, now + LOCAL_MAX_TTL))
+        self._local[key] = local
+        self._local.move_to_end(key)
+        while len(self._local) > LOCAL_MAX_ENTRIES:
+            self._local.popitem(last=False)
+
+    def _drop_local(self, key: Optional[str] = None):
+        self._epoch += 1
+        if key is None:
+            self._local.clear()
+            self._refreshing.clear()
+        else:
+            self._local.pop(key, None)
+            self._refreshing.pop(key, None)
+
+    async def _listen(self):
+        while True:
+            subscription = None
+            try:
+                subscription = await get_pubsub_multiplexer().subscribe(CACHE_INVALIDATION_CHANNEL)
+                # Entries may have been invalidated while not subscribed
+                self._drop_local()
+                self._subscribed = True
+                async for _, key in subscription:
+                    # No key: invalidations may have been missed
+                    self._drop_local(key)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Cache invalidation listener failed, local cache disabled: {str(e)}")
+            finally:
+                self._subscribed = False
+                self._drop_local()
+                if subscription is not None:
+                    try:
+                        await subscription.close()
+                    except Exception:
+                        pass
+            await asyncio.sleep(INVALIDATION_RETRY_DELAY)
+
+    # Redis tier
+
+    @staticmethod
+    def _encode(entry: _Entry) -> str:
+        return json.dumps({"v": entry.value, "f": entry.fresh_until, "e": entry.expires_at})
+
+    @staticmethod
+    def _decode(raw: Optional[str]) -> Optional[_Entry]:
+        if raw is None:
+            return None
+        data = json.loads(raw)
+        return _Entry(data["v"], data["f"], data["e"])
+
+    async def _lookup(self, key: str) -> Optional[_Entry]:
+        now = time.time()
+        entry = self._local_get(key, now)
+        if entry is not None:
+            self._count(key, "local" if entry.fresh_until > now else "stale")
+            return entry
+        try:
+            redis_client = await redis.get_client()
+            entry = self._decode(await redis_client.get(CACHE_PREFIX + key))
+        except Exception as e:
+            logger.warning(f"Cache read failed for {key}: {str(e)}")
+            self._count(key, "error")
+            return None
+        if entry is None:
+            self._count(key, "miss")
+            return None
+        self._count(key, "redis" if entry.fresh_until > now else "stale")
+        self._local_put(key, entry, now)
+        return entry
+
+    # Public API
+
     async def get(self, key: str):
-        redis = await get_client()
-        key = f"cache:{key}"
-        result = await redis.get(key)
-        if result:
-            return json.loads(result)
-        return None
-
-    async def set(self, key: str, value: Any, ttl: int = 15 * 60):
-        redis = await get_client()
-        key = f"cache:{key}"
-        await redis.set(key, json.dumps(value), ex=ttl)
+        """Get a cached value, None if it is missing."""
+        entry = await self._lookup(key)
+        return entry.value if entry is not None else None
+
+    async def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """Get several cached values with a single MGET, missing keys are left out."""
+        now = time.time()
+        values: Dict[str, Any] = {}
+        remote = []
+        for key in dict.fromkeys(keys):
+            entry = self._local_get(key, now)
+            if entry is not None:
+                self._count(key, "local" if entry.fresh_until > now else "stale")
+                values[key] = entry.value
+            else:
+                remote.append(key)
+        if not remote:
+            return values
+
+        try:
+            redis_client = await redis.get_client()
+            raw_values = await redis_client.mget([CACHE_PREFIX + key for key in remote])
+        except Exception as e:
+            logger.warning(f"Cache read failed for {len(remote)} keys: {str(e)}")
+            for key in remote:
+                self._count(key, "error")
+            return values
+        for key, raw in zip(remote, raw_values):
+            entry = self._decode(raw)
+            if entry is None:
+                self._count(key, "miss")
+                continue
+            self._count(key, "redis" if entry.fresh_until > now else "stale")
+            self._local_put(key, entry, now)
+            values[key] = entry.value
+        return values
+
+    async def set(self, key: str, value: Any, ttl: int = DEFAULT_TTL, stale_ttl: int = 0):
+        """Cache a value for ttl seconds, then serve it stale for stale_ttl more seconds."""
+        await self.set_many({key: value}, ttl=ttl, stale_ttl=stale_ttl)
+
+    async def set_many(self, values: Dict[str, Any], ttl: int = DEFAULT_TTL, stale_ttl: int = 0):
+        """Cache several values in a single round trip."""
+        now = time.time()
+        entries = {key: _Entry(value, now + ttl, now + ttl + stale_ttl) for key, value in values.items()}
+        redis_client = await redis.get_client()
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for key, entry in entries.items():
+                pipe.set(CACHE_PREFIX + key, self._encode(entry), ex=ttl + stale_ttl)
+            await pipe.execute()
+        for key, entry in entries.items():
+            self._local_put(key, entry, now)
 
     async def invalidate(self, key: str):
-        redis = await get_client()
-        key = f"cache:{key}"
-        await redis.delete(key)
+        """Delete a cached value, in Redis and in the memory of every process."""
+        self._drop_local(key)
+        redis_client = await redis.get_client()
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.delete(CACHE_PREFIX + key)
+            pipe.publish(CACHE_INVALIDATION_CHANNEL, key)
+            await pipe.execute()
+
+    delete = invalidate
+
+    async def get_or_compute(
+        self,
+        key: str,
+        compute: Callable[[], Awaitable[Any]],
+        ttl: int = DEFAULT_TTL,
+        stale_ttl: int = 0,
+        cache_none: bool = True
+    ):
+        """Get a cached value, computing and caching it if it is missing.
+
+        Concurrent callers share a single computation. A stale value is
+        returned right away while it is recomputed in the background.
+        Exceptions raised by compute are not cached.
+        """
+        future = self._inflight.get(key)
+        if future is None:
+            entry = await self._lookup(key)
+            if entry is not None:
+                if entry.fresh_until <= time.time() and key not in self._inflight:
+                    self._refreshing[key] = entry.value
+                    self._compute(key, compute, ttl, stale_ttl, cache_none)
+                return entry.value
+            future = self._compute(key, compute, ttl, stale_ttl, cache_none)
+        elif key in self._refreshing:
+            return self._refreshing[key]
+        # Callers that give up must not cancel the computation for the others
+        return await asyncio.shield(future)
+
+    def _compute(self, key, compute, ttl, stale_ttl, cache_none) -> asyncio.Future:
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._compute_and_store(key, compute, ttl, stale_ttl, cache_none))
+            self._inflight[key] = future
+            future.add_done_callback(functools.partial(self._computed, key))
+        return future
+
+    def _computed(self, key: str, future: asyncio.Future):
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+            self._refreshing.pop(key, None)
+        # Retrieve errors of refreshes nobody waits for
+        if not future.cancelled() and future.exception() is not None:
+            logger.debug(f"Computing cached value {key} failed: {future.exception()}")
+
+    async def _compute_and_store(self, key, compute, ttl, stale_ttl, cache_none):
+        epoch = self._epoch
+        value = await compute()
+        if (value is not None or cache_none) and epoch == self._epoch:
+            try:
+                await self.set(key, value, ttl=ttl, stale_ttl=stale_ttl)
+            except Exception as e:
+                logger.warning(f"Cache write failed for {key}: {str(e)}")
+        return value
 
 
 Cache = _cache()
+
+
+def cached(key: str, ttl: int = DEFAULT_TTL, stale_ttl: int = 0, cache_none: bool = True):
+    """Cache the result of an async function with ``Cache.get_or_compute``.
+
+    Args:
+        key: Cache key template, formatted with the arguments of the function,
+            e.g. "monthly_usage:{user_id}"
+        ttl: Seconds the result is fresh
+        stale_ttl: Seconds a result is still served while it is recomputed
+        cache_none: Whether a None result is cached
+
+    The wrapper has an ``invalidate(*args, **kwargs)`` coroutine that
+    invalidates the entry for the given arguments.
+    """
+    def decorator(fn):
+        signature = inspect.signature(fn)
+
+        def cache_key(args, kwargs) -> str:
+            bound = signature.bind_partial(*args, **kwargs)
+            bound.apply_defaults()
+            return key.format(**bound.arguments)
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            return await Cache.get_or_compute(
+                cache_key(args, kwargs), lambda: fn(*args, **kwargs),
+                ttl=ttl, stale_ttl=stale_ttl, cache_none=cache_none
+            )
+
+        async def invalidate(*args, **kwargs):
+            await Cache.invalidate(cache_key(args, kwargs))
+
+        wrapper.invalidate = invalidate
+        return wrapper
+    return decorator
@@ -15,6 +15,7 @@ Usage:
 """
 
 import os
+import json
 from enum import Enum
 from typing import Dict, Any, Optional, get_type_hints, Union
 from dotenv import load_dotenv
@@ -238,6 +239,18 @@ class Configuration:
     OPENROUTER_API_BASE: Optional[str] = "https://openrouter.ai/api/v1"
     OR_SITE_URL: Optional[str] = "https://kortix.ai"
     OR_APP_NAME: Optional[str] = "Kortix AI"    
+    # Milliseconds a streamed LLM call waits for its first token before the
+    # OpenRouter fallback is started alongside it, for models without their own
+    # ttft_budget_ms in utils/constants.py (0 disables hedging)
+    LLM_HEDGE_TTFT_MS: int = 10000
+    # Shared rate limits per provider and API key, in requests and estimated
+    # input tokens per minute (see services/llm_governor.py). They depend on the
+    # keys of each deployment, set them as JSON in the environment, e.g.
+    # LLM_RATE_LIMITS='{"anthropic": {"rpm": 4000, "tpm": 2000000}}'.
+    # Providers not listed are not limited.
+    LLM_RATE_LIMITS: Dict[str, Dict[str, int]] = {}
+    # Seconds an LLM call waits for its provider's rate limits before trying its fallback
+    LLM_RATE_LIMIT_WAIT_SECONDS: int = 10
     
     # AWS Bedrock credentials
     AWS_ACCESS_KEY_ID: Optional[str] = None
@@ -296,6 +309,38 @@ class Configuration:
     API_KEY_SECRET: str = "default-secret-key-change-in-production"
     API_KEY_LAST_USED_THROTTLE_SECONDS: int = 900
     
+    # Agent response streaming: consecutive content chunks are merged for up to
+    # this many milliseconds (0 disables) or until they reach this size
+    RESPONSE_COALESCE_WINDOW_MS: int = 30
+    RESPONSE_COALESCE_MAX_BYTES: int = 2048
+    # Transport of agent run responses to viewers: list, dual or stream
+    # (see services/response_transport.py for the migration steps)
+    AGENT_RESPONSE_TRANSPORT: str = "list"
+    # Store agent run responses compressed with zstd
+    AGENT_RESPONSE_COMPRESSION: bool = False
+    # Model writing the summary checkpoints of long threads, empty for the model of the thread.
+    # Set it only to a model whose provider key is configured
+    CONTEXT_SUMMARY_MODEL: str = ""
+    
+    # Agent runs a worker process runs at once. Keep it below dramatiq --threads
+    # (4 in the compose files): a run holds its thread, so the limit only takes
+    # effect if a thread is left to pass on the runs the process has no room for
+    WORKER_MAX_CONCURRENT_RUNS: int = 3
+    # Worker processes stop admitting runs while their event loop lags behind
+    # by more than this, or while they use more memory than this (0 disables)
+    WORKER_MAX_LOOP_LAG_MS: int = 500
+    WORKER_MAX_MEMORY_MB: int = 0
+    # Seconds a run waits to be admitted before it is requeued for another worker,
+    # and times a run is requeued before it fails (0 to requeue it until a worker
+    # has room)
+    WORKER_ADMISSION_WAIT_SECONDS: int = 5
+    WORKER_MAX_REQUEUES: int = 0
+    # First port worker processes serve their Prometheus metrics on, one port each (0 disables)
+    WORKER_METRICS_PORT: int = 0
+    # Agent runs sent to the workers at once across all accounts (0 for no limit),
+    # should match the runs all workers can run at once
+    AGENT_RUN_DISPATCH_CAPACITY: int = 0
+    
     # Agent execution limits (can be overridden via environment variable)
     _MAX_PARALLEL_AGENT_RUNS_ENV: Optional[str] = None
     
@@ -394,6 +439,16 @@ class Configuration:
                 elif expected_type == EnvMode:
                     # Already handled for ENV_MODE
                     pass
+                elif getattr(expected_type, '__origin__', None) is dict:
+                    # Mappings are given as JSON objects
+                    try:
+                        value = json.loads(env_val)
+                    except json.JSONDecodeError:
+                        value = None
+                    if isinstance(value, dict):
+                        setattr(self, key, value)
+                    else:
+                        logger.warning(f"Invalid value for {key}: {env_val}, using default")
                 else:
                     # String or other type
                     setattr(self, key, env_val)
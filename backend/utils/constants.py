@@ -9,6 +9,7 @@ MODELS = {
             "output_cost_per_million_tokens": 15.00
         },
         "context_window": 200_000,  # 200k tokens
+        "ttft_budget_ms": 8000,  # hedged with the OpenRouter fallback after this
         "tier_availability": ["paid"]
     },
     # "openrouter/deepseek/deepseek-chat": {
@@ -59,6 +60,7 @@ MODELS = {
             "output_cost_per_million_tokens": 15.00
         },
         "context_window": 128_000,  # 128k tokens
+        "ttft_budget_ms": 15000,  # hedged with the OpenRouter fallback after this
         "tier_availability": ["paid"]
     },
     
@@ -70,6 +72,7 @@ MODELS = {
             "output_cost_per_million_tokens": 10.00
         },
         "context_window": 2_000_000,  # 2M tokens
+        "ttft_budget_ms": 12000,  # hedged with the OpenRouter fallback after this
         "tier_availability": ["paid"]
     },
     # "openai/gpt-4o": {
@@ -121,6 +124,7 @@ MODELS = {
             "output_cost_per_million_tokens": 15.00
         },
         "context_window": 200_000,  # 200k tokens
+        "ttft_budget_ms": 8000,  # hedged with the OpenRouter fallback after this
         "tier_availability": ["paid"]
     },
     "anthropic/claude-3-5-sonnet-latest": {
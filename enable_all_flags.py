@@ -80,6 +80,10 @@ async def enable_all_flags():
         
         print(f"✅ Enabled: {flag}")
     
+    # Notify running backends, which reload their flags on a new version
+    version = await r.incr("feature_flags:version")
+    await r.publish("feature_flags:changes", version)
+    
     # Also set in the Edge Config format
     edge_config = {flag: True for flag in flags}
     await r.set("edge_config:flags", json.dumps(edge_config))
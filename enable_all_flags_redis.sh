@@ -48,6 +48,10 @@ for flag in "${FLAGS[@]}"; do
     docker exec sunadev-redis-1 redis-cli SET "edge_flag:$flag" "true" > /dev/null
 done
 
+# Notify running backends, which reload their flags on a new version
+VERSION=$(docker exec sunadev-redis-1 redis-cli INCR "feature_flags:version")
+docker exec sunadev-redis-1 redis-cli PUBLISH "feature_flags:changes" "$VERSION" > /dev/null
+
 # Create a JSON object with all flags enabled
 JSON_FLAGS="{"
 for i in "${!FLAGS[@]}"; do
@@ -1,13 +1,39 @@
-from typing import AsyncGenerator
+import json
+import asyncio
+from typing import AsyncGenerator, Optional
 import httpx
 
+RETRYABLE_STATUS_CODES = (502, 503, 504)
+# Statuses and control signals the server ends the stream of a run with
+TERMINAL_STATUSES = ("completed", "failed", "stopped", "error", "STOP", "END_STREAM", "ERROR")
 
-async def stream_from_url(url: str, **kwargs) -> AsyncGenerator[str, None]:
+
+def _is_terminal(line: str) -> bool:
+    """Whether a line is the data of a status event that ends the stream."""
+    if not line.startswith("data:"):
+        return False
+    try:
+        data = json.loads(line[5:].strip())
+    except ValueError:
+        return False
+    return isinstance(data, dict) and data.get("type") == "status" and data.get("status") in TERMINAL_STATUSES
+
+
+async def stream_from_url(
+    url: str, max_reconnects: int = 5, reconnect_delay: float = 1.0, **kwargs
+) -> AsyncGenerator[str, None]:
     """
     Helper function that takes a URL and returns an async generator yielding lines.
 
+    If the connection drops, or the stream ends before a terminal status or
+    control event, the stream is reopened with the id of the last server-sent
+    event received (Last-Event-ID), so the server only replays the events that
+    were missed.
+
     Args:
         url: The URL to stream from
+        max_reconnects: Reconnection attempts in a row before the error is raised
+        reconnect_delay: Delay before the first reconnection attempt, doubled on each one
         **kwargs: Additional arguments to pass to httpx.AsyncClient.stream()
 
     Yields:
@@ -21,10 +47,58 @@ async def stream_from_url(url: str, **kwargs) -> AsyncGenerator[str, None]:
         pool=30.0,  # 30 seconds to get connection from pool
     )
 
+    last_event_id: Optional[str] = None
+    received_lines = False
+    ended = False
+    attempts = 0
+
     async with httpx.AsyncClient(timeout=timeout) as client:
-        async with client.stream("GET", url, **kwargs) as response:
-            response.raise_for_status()
+        while True:
+            request_kwargs = dict(kwargs)
+            if last_event_id is not None:
+                request_kwargs["headers"] = {
+                    **(kwargs.get("headers") or {}),
+                    "Last-Event-ID": last_event_id,
+                }
+            try:
+                async with client.stream("GET", url, **request_kwargs) as response:
+                    response.raise_for_status()
+
+                    # Lines of an event are yielded together once its blank
+                    # line is received, a reconnection never repeats part of it
+                    event_lines = []
+                    event_id = None
+                    async for line in response.aiter_lines():
+                        if line.strip():  # Only yield non-empty lines
+                            line = line.strip()
+                            if line.startswith("id:"):
+                                event_id = line[3:].strip()
+                            event_lines.append(line)
+                            continue
+                        if event_id is not None:
+                            last_event_id, event_id = event_id, None
+                        for event_line in event_lines:
+                            received_lines = True
+                            ended = ended or _is_terminal(event_line)
+                            attempts = 0
+                            yield event_line
+                        event_lines = []
 
-            async for line in response.aiter_lines():
-                if line.strip():  # Only yield non-empty lines
-                    yield line.strip()
+                    for event_line in event_lines:
+                        ended = ended or _is_terminal(event_line)
+                        yield event_line
+                if ended:
+                    return
+                # Closed cleanly before the end of the run, e.g. by a proxy
+                error = httpx.RemoteProtocolError("Stream closed before the end of the agent run")
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                # Gateway errors are expected while the server is being redeployed
+                if isinstance(e, httpx.HTTPStatusError) and e.response.status_code not in RETRYABLE_STATUS_CODES:
+                    raise
+                error = e
+            # Without an event id the stream cannot be resumed without
+            # repeating the lines already yielded
+            if attempts >= max_reconnects or (received_lines and last_event_id is None):
+                raise error
+            await asyncio.sleep(reconnect_delay * 2**attempts)
+            attempts += 1